@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load benchmark: the full bot against local OpenRouter and Telegram stubs
+
+Usage: python benchmarks/bench_load.py [--chats 200] [--rate 200] [--duration 20]
+           [--trigger-ratio 0.05] [--latency 1.0] [--ttft 0.3] [--error-rate 0.0]
+
+Feeds synthetic group messages into the application's update queue at a
+fixed rate and reports throughput, handle_message and reply latency
+percentiles, memory growth and event-loop lag. Any other bot setting can
+be changed through the usual environment variables (e.g. STREAM_RESPONSES).
+"""
+
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import StubOpenRouter, StubTelegram
+
+WORDS = "привет как дела что нового сегодня погода отлично норм кстати слушай а вот".split()
+
+def percentile(samples: list, value: float) -> float:
+    """Get a percentile (0-100) of the samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * value / 100), len(ordered) - 1)]
+
+def format_latencies(samples: list) -> str:
+    """Format p50/p95/p99/max in milliseconds"""
+    return "  ".join(f"{name} {1000 * value:8.1f} ms" for name, value in (
+        ('p50', percentile(samples, 50)), ('p95', percentile(samples, 95)),
+        ('p99', percentile(samples, 99)), ('max', max(samples, default=0.0))))
+
+def rss_bytes() -> int:
+    """Current resident set size, falling back to the peak where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def measure_loop_lag(samples: list, interval: float = 0.01):
+    """Record how late the event loop wakes up a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(loop.time() - started - interval, 0.0))
+
+def make_update(update_id: int, chat_id: int, rng: random.Random, trigger: bool) -> dict:
+    """Build a raw group message update"""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 20))]
+    if trigger:
+        words.insert(rng.randint(0, len(words)), "братик")
+    user_id = rng.randint(1, 50)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': -100_000 - chat_id, 'type': 'supergroup', 'title': f'chat {chat_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'},
+            'text': ' '.join(words)
+        }
+    }
+
+async def run(args):
+    openrouter = StubOpenRouter(latency=args.latency, ttft=args.ttft, tokens=args.tokens,
+                                error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    telegram = StubTelegram(latency=args.telegram_latency)
+    await openrouter.start()
+    await telegram.start()
+
+    db_dir = tempfile.TemporaryDirectory()
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:bench',
+        'OPENROUTER_API_KEY': 'bench',
+        'OPENROUTER_BASE_URL': openrouter.url,
+        'TELEGRAM_API_BASE_URL': telegram.url,
+        'MEMORY_DB_PATH': os.path.join(db_dir.name, 'bench.db') if args.sqlite else ''
+    })
+    # Synthetic users trigger far more often than the default limits allow
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+
+    # Imported after the environment is set up
+    from telegram import Update
+    from main import TelegramBot
+
+    bot = TelegramBot()
+
+    handle_latencies = []
+    handle_message = bot.handle_message
+
+    @functools.wraps(handle_message)
+    async def timed_handle_message(update, context):
+        started = time.perf_counter()
+        await handle_message(update, context)
+        handle_latencies.append(time.perf_counter() - started)
+
+    bot.handle_message = timed_handle_message
+    application = bot.build_application(with_updater=False)
+    await bot.start_application(application)
+
+    loop_lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(loop_lag))
+    rng = random.Random(args.seed)
+    sent_at = {}
+    rss_before = rss_bytes()
+
+    total = int(args.rate * args.duration)
+    started = time.perf_counter()
+    for index in range(total):
+        # Pace against the schedule, not the previous send, so lag does not accumulate
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        trigger = rng.random() < args.trigger_ratio
+        data = make_update(index + 1, rng.randrange(args.chats), rng, trigger)
+        if trigger:
+            sent_at[data['update_id']] = time.perf_counter()
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    send_elapsed = time.perf_counter() - started
+
+    # Drain: wait for queued updates and in-flight generations
+    deadline = time.perf_counter() + args.drain_timeout
+    while time.perf_counter() < deadline:
+        stats = bot.chat_scheduler.get_stats()
+        if len(handle_latencies) >= total and not stats['active_chats']:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    rss_after = rss_bytes()
+
+    lag_task.cancel()
+    memory_stats = bot.message_memory.get_memory_stats()
+    scheduler_stats = bot.chat_scheduler.get_stats()
+    await bot.stop_application(application)
+    await telegram.stop()
+    await openrouter.stop()
+    db_dir.cleanup()
+
+    reply_latencies = [telegram.replies[i] - sent_at[i] for i in sent_at if i in telegram.replies]
+
+    print(f"messages:        {total} to {args.chats} chats at {args.rate:.0f} msg/s "
+          f"(sent in {send_elapsed:.1f}s, {total / send_elapsed:.0f} msg/s achieved)")
+    print(f"handled:         {len(handle_latencies)} in {elapsed:.1f}s ({len(handle_latencies) / elapsed:.0f} msg/s)")
+    print(f"triggers:        {len(sent_at)}, answered directly {len(reply_latencies)} "
+          f"(others coalesced, shed or failed)")
+    print(f"shed:            {scheduler_stats['deadline']} past the queue deadline, "
+          f"{scheduler_stats['queue_full']} on a full queue")
+    print(f"handle_message:  {format_latencies(handle_latencies)}")
+    print(f"reply latency:   {format_latencies(reply_latencies)}")
+    print(f"event-loop lag:  {format_latencies(loop_lag)}")
+    print(f"memory growth:   {(rss_after - rss_before) / 2**20:.1f} MiB RSS, "
+          f"{memory_stats['total_chats']} chats / {memory_stats['total_messages']} messages held")
+    print(f"openrouter stub: {openrouter.stats}")
+    print(f"telegram stub:   {telegram.stats}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=200, help='messages per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of traffic')
+    parser.add_argument('--trigger-ratio', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=1.0, help='OpenRouter response time, seconds')
+    parser.add_argument('--ttft', type=float, default=0.3, help='OpenRouter time to first token, seconds')
+    parser.add_argument('--tokens', type=int, default=40, help='tokens per generated response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='Bot API response time, seconds')
+    parser.add_argument('--sqlite', action='store_true', help='persist memory to a temporary SQLite file')
+    parser.add_argument('--drain-timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark: bytes per stored message, legacy dicts vs MessageRecord
+
+Usage: python benchmarks/bench_memory.py [--chats 1000] [--messages 200]
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from collections import deque, defaultdict
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_memory import MessageMemory
+from message_record import MessageRecord
+
+USERNAMES = [f"user_{i}" for i in range(20)]
+WORDS = "привет братик как дела что нового сегодня погода отлично норм кстати".split()
+
+def make_message(rng: random.Random, message_id: int):
+    """Generate synthetic message fields"""
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+    # Build usernames at runtime, as Telegram updates do, so they are distinct objects
+    username = "".join(rng.choice(USERNAMES))
+    return rng.randint(1, 10**9), username, text, datetime.now(timezone.utc), message_id
+
+def measure(build) -> int:
+    """Measure bytes retained by the structure returned from build()"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    structure = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del structure
+    return after - before
+
+def build_legacy(chats: int, messages: int, seed: int):
+    """Baseline storage: defaultdict of deques holding dicts with ISO timestamps"""
+    rng = random.Random(seed)
+    memories = defaultdict(lambda: deque(maxlen=messages))
+    for chat_id in range(chats):
+        for message_id in range(messages):
+            user_id, username, text, date, message_id = make_message(rng, message_id)
+            memories[chat_id].append({
+                'user_id': user_id,
+                'username': username,
+                'text': text,
+                'timestamp': date.isoformat(),
+                'message_id': message_id,
+                'is_bot': False
+            })
+    return memories
+
+def build_compact(chats: int, messages: int, seed: int):
+    """Current storage: MessageMemory ring buffers of MessageRecord"""
+    rng = random.Random(seed)
+    memory = MessageMemory(max_messages_per_chat=messages, max_cached_chats=chats)
+
+    async def fill():
+        for chat_id in range(chats):
+            for message_id in range(messages):
+                user_id, username, text, date, message_id = make_message(rng, message_id)
+                await memory.add_message(chat_id, MessageRecord(user_id, username, text, int(date.timestamp()), message_id))
+
+    asyncio.run(fill())
+    return memory
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    total = args.chats * args.messages
+    legacy = measure(lambda: build_legacy(args.chats, args.messages, args.seed))
+    compact = measure(lambda: build_compact(args.chats, args.messages, args.seed))
+
+    print(f"{args.chats} chats x {args.messages} messages = {total} messages")
+    print(f"legacy dict records:  {legacy / total:8.1f} bytes/message  ({legacy / 2**20:.1f} MiB)")
+    print(f"MessageRecord:        {compact / total:8.1f} bytes/message  ({compact / 2**20:.1f} MiB)")
+    print(f"saving:               {100 * (1 - compact / legacy):8.1f} %")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Retrieval benchmark: index update and search latency, memory per chat
+
+Usage: python benchmarks/bench_retrieval.py [--messages 200] [--searches 2000] [--no-numpy]
+
+Fills one chat with synthetic messages plus a few planted facts, then
+times incremental adds and top-k searches and checks that questions about
+the planted facts find them. Reports which backend (NumPy or pure Python)
+was used.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vector_index
+from message_record import MessageRecord
+from vector_index import HashingEmbedder, VectorIndex
+
+WORDS = ("привет как дела что нового сегодня погода отлично норм кстати слушай вечером пойдем "
+         "смотрел футбол работа устал выходные купил телефон музыка кино").split()
+
+FACTS = [
+    ("Мой кот Барсик обожает есть сырую рыбу", "что любит есть кот?"),
+    ("Встреча выпускников будет в субботу в ресторане на набережной", "где будет встреча выпускников?"),
+    ("Пароль от вайфая на даче записан на холодильнике", "где пароль от вайфая?"),
+]
+
+def percentile(samples: list, value: float) -> float:
+    """Get a percentile (0-100) of the samples"""
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * value / 100), len(ordered) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--searches', type=int, default=2000)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--exclude-recent', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-numpy', action='store_true', help='benchmark the pure-Python backend')
+    args = parser.parse_args()
+
+    if not args.no_numpy:
+        vector_index.load_numpy()
+    rng = random.Random(args.seed)
+    history = []
+    fact_positions = set(rng.sample(range(args.messages - args.exclude_recent), len(FACTS)))
+    facts = iter(FACTS)
+    for seq in range(args.messages):
+        text = next(facts)[0] if seq in fact_positions else " ".join(
+            rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+        record = MessageRecord(rng.randint(1, 20), f"user{seq % 20}", text, 0, seq)
+        record.seq = seq
+        history.append(record)
+
+    index = VectorIndex(capacity=args.messages, embedder=HashingEmbedder(stop_words=['братик']))
+    tracemalloc.start()
+    index.search(1, "братик привет", history, exclude_recent=args.exclude_recent)
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The first search of a chat builds its index from the history
+    index.drop(1)
+    started = time.perf_counter()
+    index.search(1, "братик привет", history, exclude_recent=args.exclude_recent)
+    build_seconds = time.perf_counter() - started
+
+    add_latencies = []
+    for seq in range(args.messages, args.messages + args.searches):
+        record = MessageRecord(1, "user", " ".join(rng.choice(WORDS) for _ in range(8)), 0, seq)
+        record.seq = seq
+        started = time.perf_counter()
+        index.add(1, record)
+        add_latencies.append(time.perf_counter() - started)
+    # The adds overwrote the planted facts in the ring, so index the history again
+    index.drop(1)
+    index.search(1, "братик привет", history, exclude_recent=args.exclude_recent)
+
+    search_latencies = []
+    queries = [question for _, question in FACTS] + [" ".join(rng.choice(WORDS) for _ in range(6))]
+    for number in range(args.searches):
+        started = time.perf_counter()
+        index.search(1, queries[number % len(queries)], history, k=args.top_k, exclude_recent=args.exclude_recent)
+        search_latencies.append(time.perf_counter() - started)
+
+    found = sum(any(record.text == fact for record in index.search(
+        1, question, history, k=args.top_k, exclude_recent=args.exclude_recent)) for fact, question in FACTS)
+
+    print(f"backend:         {'NumPy' if vector_index.np is not None else 'pure Python'}, "
+          f"{index.embedder.dim} dims")
+    print(f"index build:     {1000 * build_seconds:.2f} ms for {args.messages} messages, "
+          f"{index_bytes / 1024:.0f} KiB per chat")
+    print(f"add:             p50 {1e6 * percentile(add_latencies, 50):.1f} us  p99 {1e6 * percentile(add_latencies, 99):.1f} us")
+    print(f"search (top-{args.top_k}):  p50 {1e6 * percentile(search_latencies, 50):.1f} us  "
+          f"p99 {1e6 * percentile(search_latencies, 99):.1f} us")
+    print(f"planted facts:   {found}/{len(FACTS)} retrieved")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: import time of the bot with a budget
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--budget-ms 30] [--init-budget-ms 50]
+
+Imports main in fresh interpreters under `python -X importtime` and reports
+the total plus the slowest top-level imports. Most of the total is aiohttp
+and python-telegram-bot, which the bot cannot start without and whose cost
+varies a lot with the host, so the budget applies to the bot's own share:
+importing main with those already loaded. Also checks that the import has
+no side effects (no threads started, logging left unconfigured, no optional
+subsystem such as sqlite3 or NumPy loaded) and times constructing
+TelegramBot. Children run with the default configuration in a temporary
+directory, where the default MEMORY_DB_PATH creates its SQLite file; the
+constructor is also timed with MEMORY_DB_PATH='' (memory only). Exits with
+status 1 when a budget is exceeded or the import has side effects; the
+"Startup budget" CI workflow (.github/workflows/startup.yml) runs it on
+every push.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Required third-party stack, preloaded to measure the bot's own import cost
+REQUIRED = "import asyncio, aiohttp, aiohttp.web, telegram, telegram.ext"
+
+# Modules of optional subsystems that importing main must not load
+OPTIONAL = ('sqlite3', 'memory_storage', 'numpy', 'vector_index', 'conversation_summarizer',
+            'response_cache', 'rate_limiter', 'cluster')
+
+# Runs in the child after the timed import
+PROBE = f"""
+import main
+import logging, sys, threading, time
+loaded = [name for name in {OPTIONAL!r} if name in sys.modules]
+threads, handlers = threading.active_count(), len(logging.getLogger().handlers)
+started = time.perf_counter()
+main.TelegramBot()
+print(threads, handlers, ','.join(loaded) or '-', time.perf_counter() - started)
+"""
+
+def run_child(preload: bool = False, db_path: str = None) -> tuple:
+    """Import main in a fresh interpreter, optionally after the required stack.
+
+    Uses the default configuration unless db_path overrides MEMORY_DB_PATH.
+    Returns main's cumulative import time and the cumulative times of its
+    direct imports in ms, the thread and root log handler counts and the
+    optional modules loaded after the import, and the TelegramBot()
+    construction time in ms.
+    """
+    env = {name: value for name, value in os.environ.items() if name != 'MEMORY_DB_PATH'}
+    env.update(TELEGRAM_BOT_TOKEN='bench', OPENROUTER_API_KEY='bench', PYTHONPATH=ROOT)
+    if db_path is not None:
+        env['MEMORY_DB_PATH'] = db_path
+    code = f"{REQUIRED}\n{PROBE}" if preload else PROBE
+    # Files the bot creates, such as the default message_memory.db, stay out of the checkout
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                                capture_output=True, text=True, check=True)
+
+    # importtime prints a module after everything it imported, indented by depth
+    children, pending = {}, {}
+    total = None
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            pending[name.strip()] = int(cumulative_us) / 1000
+        elif depth == 0:
+            if name == 'main':
+                total, children = int(cumulative_us) / 1000, pending
+            pending = {}
+
+    threads, handlers, loaded, init_seconds = result.stdout.split()
+    loaded = [] if loaded == '-' else loaded.split(',')
+    return total, children, int(threads), int(handlers), loaded, 1000 * float(init_seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=30.0,
+                        help='median import time budget for main without the required stack')
+    parser.add_argument('--init-budget-ms', type=float, default=50.0,
+                        help='median TelegramBot() budget, with and without SQLite')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    totals, owns, inits, memory_inits, children = [], [], [], [], {}
+    side_effects = set()
+    for _ in range(args.runs):
+        total, imports, threads, handlers, loaded, init = run_child()
+        totals.append(total)
+        owns.append(run_child(preload=True)[0])
+        inits.append(init)
+        *_, memory_threads, memory_handlers, memory_loaded, memory_init = run_child(db_path='')
+        memory_inits.append(memory_init)
+        for name, milliseconds in imports.items():
+            children.setdefault(name, []).append(milliseconds)
+        for thread_count in (threads, memory_threads):
+            if thread_count != 1:
+                side_effects.add(f"{thread_count - 1} thread(s) started")
+        if handlers or memory_handlers:
+            side_effects.add("logging configured")
+        for name in (*loaded, *memory_loaded):
+            side_effects.add(f"{name} imported")
+
+    own = statistics.median(owns)
+    init = statistics.median(inits)
+    memory_init = statistics.median(memory_inits)
+    print(f"import main:     median {statistics.median(totals):.0f} ms (min {min(totals):.0f}, "
+          f"max {max(totals):.0f}) over {args.runs} runs")
+    print(f"  own share:     median {own:.1f} ms (min {min(owns):.1f}, max {max(owns):.1f}), "
+          f"budget {args.budget_ms:.0f} ms")
+    print(f"TelegramBot():   median {init:.1f} ms with the default SQLite memory, {memory_init:.1f} ms "
+          f"with MEMORY_DB_PATH='', budget {args.init_budget_ms:.0f} ms")
+    print("slowest imports:")
+    slowest = sorted(((statistics.median(times), name) for name, times in children.items()), reverse=True)
+    for milliseconds, name in slowest[:args.top]:
+        print(f"  {milliseconds:7.1f} ms  {name}")
+    print(f"side effects:    {', '.join(sorted(side_effects)) or 'none'}")
+
+    failures = []
+    if own > args.budget_ms:
+        failures.append(f"import time {own:.1f} ms exceeds {args.budget_ms:.0f} ms")
+    if max(init, memory_init) > args.init_budget_ms:
+        failures.append(f"TelegramBot() {max(init, memory_init):.1f} ms exceeds {args.init_budget_ms:.0f} ms")
+    if side_effects:
+        failures.append("importing main has side effects")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
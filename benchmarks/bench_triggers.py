@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trigger matching benchmark: lowercase-and-search vs the precompiled TriggerEngine
+
+Usage: python benchmarks/bench_triggers.py [--messages 100000] [--trigger-ratio 0.02] [--repeat 5]
+
+Both matchers look for the same words, the defaults 'братик' and 'bratik'.
+They take turns running over all messages --repeat times and each one's
+fastest pass is reported, since a single pass is dominated by scheduling
+noise.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from triggers import TriggerEngine
+
+WORDS = "привет как дела что нового сегодня погода отлично норм кстати слушай Братан вот".split()
+
+def make_messages(count: int, trigger_ratio: float, seed: int) -> list:
+    """Generate group messages, a fraction of them mentioning the bot"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+        if rng.random() < trigger_ratio:
+            words.insert(rng.randint(0, len(words)), rng.choice(["Братик,", "братику", "bratik"]))
+        messages.append(" ".join(words))
+    return messages
+
+def timed(matchers: list, messages: list, repeat: int) -> list:
+    """Run each matcher over all messages repeat times in turn, returning (fastest seconds, matches) per matcher"""
+    results = [(None, 0)] * len(matchers)
+    for _ in range(repeat):
+        for index, match in enumerate(matchers):
+            started = time.perf_counter()
+            matched = sum(1 for text in messages if match(text))
+            elapsed = time.perf_counter() - started
+            best = results[index][0]
+            results[index] = (elapsed if best is None else min(best, elapsed), matched)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--trigger-ratio', type=float, default=0.02)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.trigger_ratio, args.seed)
+    engine = TriggerEngine(['братик', 'bratik'])
+
+    def legacy_match(text: str) -> bool:
+        lowered = text.lower()
+        return "братик" in lowered or "bratik" in lowered
+
+    (legacy, legacy_matched), (engine_time, engine_matched) = timed(
+        [legacy_match, lambda text: engine.matches(1, text)], messages, args.repeat)
+
+    print(f"{args.messages} messages, {args.trigger_ratio:.0%} mention the bot")
+    print(f"lower() + 'in':   {1e9 * legacy / args.messages:8.0f} ns/message  ({legacy_matched} matched)")
+    print(f"TriggerEngine:    {1e9 * engine_time / args.messages:8.0f} ns/message  ({engine_matched} matched)")
+    print(f"TriggerEngine / lower() + 'in': {engine_time / legacy:.2f}x")
+
+if __name__ == '__main__':
+    main()
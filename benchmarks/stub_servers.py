@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stub servers for the OpenRouter chat completions API and the Telegram Bot API
+
+Used by the load benchmark so the bot can be exercised without live services.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+WORDS = "конечно братан смотри тут все просто давай разберемся по порядку вот так".split()
+
+class _StubServer:
+    """Base class running an aiohttp app on a local port"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def build_app(self) -> web.Application:
+        raise NotImplementedError
+
+    async def start(self):
+        """Start listening; port 0 picks a free port"""
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"{type(self).__name__} listening on {self.url}")
+
+    async def stop(self):
+        """Stop listening"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+class StubOpenRouter(_StubServer):
+    """Chat completions endpoint with configurable latency and failures.
+
+    Non-streaming responses arrive after latency seconds. Streams send the
+    first token after ttft seconds and spread the remaining tokens over the
+    rest of latency. error_rate of requests fail with a 500 and
+    rate_limit_rate with a 429 carrying a Retry-After of retry_after.
+    Outcomes scripted per model with script() take precedence over the
+    random ones, and every request's model and arrival time is logged.
+    """
+
+    def __init__(self, latency: float = 1.0, ttft: float = 0.3, tokens: int = 40,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, retry_after: str = '1',
+                 seed: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.ttft = min(ttft, latency)
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._scripts: Dict[str, List] = {}
+        self.log: List[tuple] = []
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0, 'rate_limited': 0}
+
+    def script(self, model: str, *outcomes):
+        """Queue the outcomes of the next requests for a model.
+
+        Each outcome is an int HTTP status to fail with (200 answers
+        normally) or a float latency in seconds for a normal answer.
+        """
+        self._scripts.setdefault(model, []).extend(outcomes)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/chat/completions', self.handle_completion)
+        return app
+
+    def _usage(self, messages: List[Dict]) -> Dict[str, int]:
+        """Rough token usage for the request"""
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in messages) // 4
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': self.tokens,
+                'total_tokens': prompt_tokens + self.tokens}
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.stats['requests'] += 1
+        self.log.append((payload.get('model'), time.monotonic()))
+
+        status, latency = 200, self.latency
+        script = self._scripts.get(payload.get('model'))
+        if script:
+            outcome = script.pop(0)
+            if isinstance(outcome, float):
+                latency = outcome
+            else:
+                status = outcome
+        else:
+            roll = self._rng.random()
+            if roll < self.error_rate:
+                status = 500
+            elif roll < self.error_rate + self.rate_limit_rate:
+                status = 429
+
+        if status == 429:
+            self.stats['rate_limited'] += 1
+            return web.json_response({'error': {'message': 'rate limited', 'code': 429}}, status=429,
+                                     headers={'Retry-After': self.retry_after})
+        if status != 200:
+            self.stats['errors'] += 1
+            await asyncio.sleep(self.ttft)
+            return web.json_response({'error': {'message': 'stub failure', 'code': status}}, status=status)
+
+        words = [self._rng.choice(WORDS) for _ in range(self.tokens)]
+        usage = self._usage(payload.get('messages', []))
+
+        if not payload.get('stream'):
+            await asyncio.sleep(latency)
+            return web.json_response({
+                'model': payload.get('model'),
+                'choices': [{'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                'usage': usage
+            })
+
+        self.stats['streams'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await response.write(b": OPENROUTER PROCESSING\n\n")
+        await asyncio.sleep(self.ttft)
+
+        interval = max(latency - self.ttft, 0.0) / max(len(words) - 1, 1)
+        for index, word in enumerate(words):
+            if index:
+                await asyncio.sleep(interval)
+            chunk = {'choices': [{'delta': {'content': word + ' '}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+class StubTelegram(_StubServer):
+    """Minimal Telegram Bot API answering the methods the bot calls.
+
+    Records when each reply is sent so the benchmark can measure the time
+    from an incoming message to the bot's answer.
+    """
+
+    def __init__(self, latency: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.bot_user = {'id': 1000000, 'is_bot': True, 'first_name': 'Братик', 'username': 'bratik_bench_bot'}
+        self.replies: Dict[int, float] = {}
+        self.stats = {'sendMessage': 0, 'editMessageText': 0, 'sendChatAction': 0, 'other': 0}
+        self._next_message_id = 10**9
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle_method)
+        return app
+
+    def _message(self, params: Dict[str, str], message_id: Optional[int] = None) -> Dict:
+        """Build a Message object for a sent or edited message"""
+        if message_id is None:
+            self._next_message_id += 1
+            message_id = self._next_message_id
+        chat_id = int(params.get('chat_id', 0))
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private', 'title': 'bench'},
+            'from': self.bot_user,
+            'text': params.get('text', '')
+        }
+
+    def _reply_to(self, params: Dict[str, str]) -> Optional[int]:
+        """Get the id of the message a sent message replies to"""
+        if params.get('reply_parameters'):
+            return json.loads(params['reply_parameters']).get('message_id')
+        if params.get('reply_to_message_id'):
+            return int(params['reply_to_message_id'])
+        return None
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = self.bot_user
+        elif method == 'sendMessage':
+            reply_to = self._reply_to(params)
+            if reply_to is not None:
+                self.replies.setdefault(reply_to, time.perf_counter())
+            result = self._message(params)
+        elif method == 'editMessageText':
+            result = self._message(params, int(params.get('message_id', 0)))
+        else:
+            result = True
+
+        self.stats[method if method in self.stats else 'other'] += 1
+        return web.json_response({'ok': True, 'result': result})
@@ -5,7 +5,9 @@ Bot configuration with environment variables
 """
 
 import os
+import json
 import logging
+import tempfile
 
 logger = logging.getLogger(__name__)
 
@@ -13,14 +15,124 @@ class BotConfig:
     def __init__(self):
         self.telegram_bot_token = self._get_env_var('TELEGRAM_BOT_TOKEN')
         self.openrouter_api_key = self._get_env_var('OPENROUTER_API_KEY')
+        # Bot API endpoint override, e.g. a local Bot API server or a benchmark stub
+        self.telegram_api_base_url = os.getenv('TELEGRAM_API_BASE_URL') or None
+        
+        # Deployment mode: 'polling' or 'webhook'
+        self.bot_mode = os.getenv('BOT_MODE', 'polling').strip().lower()
+        self.port = self._get_int_env('PORT', 5000)
+        self.webhook_path = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+        self.webhook_secret = os.getenv('WEBHOOK_SECRET') or None
+        self.webhook_url = self._get_env_var('WEBHOOK_URL') if self.bot_mode == 'webhook' else os.getenv('WEBHOOK_URL')
+        
+        # Multi-process mode: WORKERS > 1 runs an ingest process plus worker processes
+        # that share chat state through the SQLite memory database
+        self.workers = self._get_int_env('WORKERS', 1)
+        self.cluster_socket_dir = os.getenv('CLUSTER_SOCKET_DIR', tempfile.gettempdir())
         
         # OpenRouter configuration
-        self.openrouter_base_url = "https://openrouter.ai/api/v1"
-        self.model_name = "deepseek/deepseek-r1"
+        self.openrouter_base_url = os.getenv('OPENROUTER_BASE_URL', "https://openrouter.ai/api/v1")
+        self.model_name = os.getenv('OPENROUTER_MODEL', "deepseek/deepseek-r1")
+        self.fallback_models = self._get_list_env('OPENROUTER_FALLBACK_MODELS', ["deepseek/deepseek-chat"])
+        self.openrouter_timeout = self._get_float_env('OPENROUTER_TIMEOUT', 30.0)
+        self.openrouter_max_retries = self._get_int_env('OPENROUTER_MAX_RETRIES', 2)
+        self.openrouter_retry_base_delay = self._get_float_env('OPENROUTER_RETRY_BASE_DELAY', 0.5)
+        self.openrouter_retry_max_delay = self._get_float_env('OPENROUTER_RETRY_MAX_DELAY', 8.0)
+        self.circuit_breaker_threshold = self._get_int_env('CIRCUIT_BREAKER_THRESHOLD', 5)
+        self.circuit_breaker_reset_timeout = self._get_float_env('CIRCUIT_BREAKER_RESET_TIMEOUT', 30.0)
+        # Latency percentile after which a duplicate request is sent (0 disables hedging)
+        self.hedge_percentile = self._get_float_env('OPENROUTER_HEDGE_PERCENTILE', 0.0) or None
+        
+        # Reasoning tokens count against the 600-token budget: cap them (REASONING_MAX_TOKENS)
+        # or set an effort level, and leave them out of the response
+        self.reasoning_max_tokens = self._get_int_env('REASONING_MAX_TOKENS', 0)
+        self.reasoning_effort = os.getenv('REASONING_EFFORT', '').strip().lower() or None
+        self.reasoning_exclude = self._get_bool_env('REASONING_EXCLUDE', True)
+        # Non-reasoning model for short chit-chat (empty FAST_MODEL disables it)
+        self.fast_model = os.getenv('FAST_MODEL', 'deepseek/deepseek-chat').strip() or None
+        self.fast_model_max_chars = self._get_int_env('FAST_MODEL_MAX_CHARS', 80)
+        
+        # OpenRouter connection pool
+        self.openrouter_pool_limit = self._get_int_env('OPENROUTER_POOL_LIMIT', 100)
+        self.openrouter_pool_limit_per_host = self._get_int_env('OPENROUTER_POOL_LIMIT_PER_HOST', 20)
+        self.openrouter_dns_cache_ttl = self._get_int_env('OPENROUTER_DNS_CACHE_TTL', 300)
+        self.openrouter_keepalive_timeout = self._get_float_env('OPENROUTER_KEEPALIVE_TIMEOUT', 60.0)
         
         # Bot configuration
         self.max_context_messages = 200
         self.max_response_length = 4000  # Telegram message limit is ~4096 chars
+        # Words that make the bot respond; chats can override them with /triggers
+        self.trigger_words = self._get_list_env('TRIGGER_WORDS', ['братик', 'bratik'])
+        
+        # Prompt context: history is added newest-first until the token budget is spent
+        self.context_token_budget = self._get_int_env('CONTEXT_TOKEN_BUDGET', 2000)
+        self.context_max_messages = self._get_int_env('CONTEXT_MAX_MESSAGES', 30)
+        self.context_drop_current_message = self._get_bool_env('CONTEXT_DROP_CURRENT_MESSAGE', True)
+        
+        # Retrieval of older messages related to the question (NumPy speeds it up if installed)
+        self.retrieval_enabled = self._get_bool_env('RETRIEVAL_ENABLED', True)
+        self.retrieval_top_k = self._get_int_env('RETRIEVAL_TOP_K', 5)
+        self.retrieval_token_budget = self._get_int_env('RETRIEVAL_TOKEN_BUDGET', 300)
+        self.retrieval_min_score = self._get_float_env('RETRIEVAL_MIN_SCORE', 0.3)
+        self.retrieval_max_chats = self._get_int_env('RETRIEVAL_MAX_CHATS', 200)
+        
+        # Rolling summaries of older messages in long chats
+        self.summary_enabled = self._get_bool_env('SUMMARY_ENABLED', True)
+        self.summary_threshold = self._get_int_env('SUMMARY_THRESHOLD', 80)
+        self.summary_keep_recent = self._get_int_env('SUMMARY_KEEP_RECENT', 30)
+        
+        # Opt-in response cache for repeated prompts ('chat' or 'global' scope)
+        self.response_cache_enabled = self._get_bool_env('RESPONSE_CACHE_ENABLED', False)
+        self.response_cache_size = self._get_int_env('RESPONSE_CACHE_SIZE', 1000)
+        self.response_cache_ttl = self._get_float_env('RESPONSE_CACHE_TTL', 3600)
+        self.response_cache_scope = os.getenv('RESPONSE_CACHE_SCOPE', 'chat')
+        self.response_cache_context_messages = self._get_int_env('RESPONSE_CACHE_CONTEXT_MESSAGES', 2)
+        
+        # Memory persistence (empty MEMORY_DB_PATH keeps memory in RAM only)
+        self.memory_db_path = os.getenv('MEMORY_DB_PATH', 'message_memory.db')
+        self.memory_flush_interval = self._get_float_env('MEMORY_FLUSH_INTERVAL', 1.0)
+        self.memory_cached_chats = self._get_int_env('MEMORY_CACHED_CHATS', 1000)
+        
+        # Memory eviction: idle chats and chats over the global message cap
+        self.memory_idle_ttl = self._get_float_env('MEMORY_IDLE_TTL', 24 * 3600)
+        self.memory_max_total_messages = self._get_int_env('MEMORY_MAX_TOTAL_MESSAGES', 200000)
+        self.memory_evict_interval = self._get_float_env('MEMORY_EVICT_INTERVAL', 10.0)
+        
+        # Streaming configuration
+        self.stream_responses = self._get_bool_env('STREAM_RESPONSES', True)
+        self.stream_edit_interval = self._get_float_env('STREAM_EDIT_INTERVAL', 1.0)  # Telegram edit rate limit
+        self.stream_min_chars = self._get_int_env('STREAM_MIN_CHARS', 20)
+        
+        # Generation scheduling
+        self.max_concurrent_generations = self._get_int_env('MAX_CONCURRENT_GENERATIONS', 8)
+        self.max_coalesced_triggers = self._get_int_env('MAX_COALESCED_TRIGGERS', 5)
+        # Overload: triggers waiting for a slot beyond the queue size or the deadline
+        # get a short busy reply (a deadline of 0 disables it)
+        self.generation_queue_size = self._get_int_env('GENERATION_QUEUE_SIZE', 100)
+        self.generation_queue_deadline = self._get_float_env('GENERATION_QUEUE_DEADLINE', 15.0) or None
+        
+        # Rate limits and rolling 24h token quotas of the default tier (0 disables a limit)
+        self.rate_limit_enabled = self._get_bool_env('RATE_LIMIT_ENABLED', True)
+        self.user_rate_per_minute = self._get_float_env('USER_RATE_PER_MINUTE', 5)
+        self.user_burst = self._get_int_env('USER_BURST', 3)
+        self.chat_rate_per_minute = self._get_float_env('CHAT_RATE_PER_MINUTE', 20)
+        self.chat_burst = self._get_int_env('CHAT_BURST', 10)
+        self.user_daily_tokens = self._get_int_env('USER_DAILY_TOKENS', 50000)
+        self.chat_daily_tokens = self._get_int_env('CHAT_DAILY_TOKENS', 300000)
+        # Extra tiers as JSON overrides of the default, e.g. {"vip": {"user_daily_tokens": 0}},
+        # assigned with "id:tier" lists
+        self.rate_limit_tiers = self._get_json_env('RATE_LIMIT_TIERS', {})
+        self.rate_limit_user_tiers = self._get_assignments_env('RATE_LIMIT_USER_TIERS')
+        self.rate_limit_chat_tiers = self._get_assignments_env('RATE_LIMIT_CHAT_TIERS')
+        
+        # Background maintenance on the event loop (an interval of 0 disables a task)
+        self.maintenance_jitter = self._get_float_env('MAINTENANCE_JITTER', 0.1)
+        self.stats_log_interval = self._get_float_env('STATS_LOG_INTERVAL', 300.0)
+        self.quota_save_interval = self._get_float_env('QUOTA_SAVE_INTERVAL', 300.0)
+        # Close the OpenRouter pool after this many idle seconds; it reopens on the next request
+        self.openrouter_idle_close = self._get_float_env('OPENROUTER_IDLE_CLOSE', 900.0)
+        self.keep_alive_url = os.getenv('REPL_URL') or None
+        self.keep_alive_interval = self._get_float_env('KEEP_ALIVE_INTERVAL', 300.0)
         
         logger.info("Bot configuration loaded successfully")
 
@@ -32,6 +144,79 @@ class BotConfig:
             raise ValueError(f"Environment variable {var_name} is required!")
         return value
 
+    def _get_bool_env(self, var_name: str, default: bool) -> bool:
+        """Get optional boolean environment variable"""
+        value = os.getenv(var_name)
+        if value is None or value == '':
+            return default
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+    def _get_int_env(self, var_name: str, default: int) -> int:
+        """Get optional integer environment variable"""
+        value = os.getenv(var_name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            logger.warning(f"Invalid integer for {var_name}: {value!r}, using {default}")
+            return default
+
+    def _get_float_env(self, var_name: str, default: float) -> float:
+        """Get optional float environment variable"""
+        value = os.getenv(var_name)
+        if not value:
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            logger.warning(f"Invalid number for {var_name}: {value!r}, using {default}")
+            return default
+
+    def _get_list_env(self, var_name: str, default: list) -> list:
+        """Get optional comma-separated list environment variable"""
+        value = os.getenv(var_name)
+        if value is None:
+            return default
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    def _get_json_env(self, var_name: str, default: dict) -> dict:
+        """Get optional JSON object environment variable"""
+        value = os.getenv(var_name)
+        if not value:
+            return default
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            logger.warning(f"Invalid JSON for {var_name}, using {default}")
+            return default
+        if not isinstance(parsed, dict):
+            logger.warning(f"{var_name} must be a JSON object, using {default}")
+            return default
+        return parsed
+
+    def _get_assignments_env(self, var_name: str) -> dict:
+        """Get optional comma-separated 'id:name' pairs as a dict keyed by integer id"""
+        assignments = {}
+        for item in self._get_list_env(var_name, []):
+            entity_id, _, name = item.partition(':')
+            try:
+                assignments[int(entity_id)] = name.strip()
+            except ValueError:
+                logger.warning(f"Invalid entry in {var_name}: {item!r}")
+        return assignments
+
+    def get_reasoning_options(self) -> dict:
+        """Get the OpenRouter reasoning request options"""
+        options = {}
+        if self.reasoning_max_tokens > 0:
+            options['max_tokens'] = self.reasoning_max_tokens
+        elif self.reasoning_effort:
+            options['effort'] = self.reasoning_effort
+        if self.reasoning_exclude:
+            options['exclude'] = True
+        return options
+
     def get_openrouter_headers(self) -> dict:
         """Get headers for OpenRouter API requests"""
         return {
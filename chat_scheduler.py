@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-chat generation scheduling with request coalescing and priority admission
+"""
+
+import asyncio
+import heapq
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Reasons a batch of triggers is shed instead of answered
+SHED_DEADLINE, SHED_QUEUE_FULL = 'deadline', 'queue_full'
+
+def trigger_priority(reason: str, private: bool) -> int:
+    """Get the scheduling priority of a trigger; lower runs first.
+
+    Direct replies to the bot come before name mentions, and within each
+    kind private chats come before groups.
+    """
+    return (0 if reason == 'reply' else 2) + (0 if private else 1)
+
+class _Waiter:
+    """A chat worker waiting for a generation slot"""
+
+    __slots__ = ('priority', 'seq', 'future')
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+class ChatScheduler:
+    """Runs at most one generation per chat and bounds them globally.
+
+    Triggers submitted while a chat already has a generation pending or in
+    flight are collected and handed to the handler as a single batch, so one
+    upstream call answers all of them. Batches for a chat are processed in
+    submission order by a single worker task per chat.
+
+    When all max_concurrent slots are busy, chats wait in a priority queue
+    ordered by their most urgent pending trigger. A chat that waits longer
+    than queue_deadline seconds for a slot is shed, and so is the least
+    urgent chat, waiting or with follow-ups behind its generation, when
+    more than max_queue_size triggers are pending. The wait is counted from
+    when the chat joins the queue, so triggers that coalesced behind the
+    chat's own generation get the full deadline.
+    Shed batches go to shed_handler (e.g. a short "busy" reply) instead of
+    the upstream, so overload turns into quick refusals rather than
+    ever-growing latency for everyone.
+    """
+
+    def __init__(self, handler: Callable[[int, List[Any]], Awaitable[None]],
+                 max_concurrent: int = 8, max_batch_size: int = 5,
+                 max_queue_size: int = 100, queue_deadline: Optional[float] = 15.0,
+                 shed_handler: Optional[Callable[[int, List[Any], str], Awaitable[None]]] = None):
+        self._handler = handler
+        self._shed_handler = shed_handler
+        self.max_concurrent = max_concurrent
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.queue_deadline = queue_deadline
+        # chat_id -> [(priority, submitted_at, item)] in submission order
+        self._pending: Dict[int, List[Tuple[int, float, Any]]] = {}
+        self._pending_count = 0
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._shed_tasks: Set[asyncio.Task] = set()
+        self._free_slots = max_concurrent
+        # Heap of (priority, seq, chat_id); entries whose seq no longer matches
+        # the chat's waiter are stale and skipped
+        self._queue: List[Tuple[int, int, int]] = []
+        self._waiters: Dict[int, _Waiter] = {}
+        self._seq = 0
+        self._in_flight = 0
+        self._stats = {'admitted': 0, SHED_DEADLINE: 0, SHED_QUEUE_FULL: 0}
+
+        logger.info(f"ChatScheduler initialized with max {max_concurrent} concurrent generations, "
+                    f"queue of {max_queue_size} triggers")
+
+    def submit(self, chat_id: int, item: Any, priority: int = 0):
+        """Queue a trigger for a chat, starting its worker if needed"""
+        entry = (priority, asyncio.get_running_loop().time(), item)
+        if self._pending_count >= self.max_queue_size and not self._make_room(priority):
+            self._shed_later(chat_id, [entry], SHED_QUEUE_FULL)
+            return
+
+        self._pending.setdefault(chat_id, []).append(entry)
+        self._pending_count += 1
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._run_chat(chat_id))
+            return
+
+        logger.info(f"Coalescing trigger in chat {chat_id}, {len(self._pending[chat_id])} pending")
+        waiter = self._waiters.get(chat_id)
+        if waiter is not None and priority < waiter.priority:
+            # A more urgent trigger moves the waiting chat up the queue
+            self._seq += 1
+            waiter.priority, waiter.seq = priority, self._seq
+            heapq.heappush(self._queue, (priority, self._seq, chat_id))
+
+    def _make_room(self, priority: int) -> bool:
+        """Shed the least urgent pending chat if it is less urgent than priority.
+
+        Follow-ups coalesced behind a chat's in-flight generation count towards
+        max_queue_size too, so those chats are candidates as well as waiting
+        ones. On a tie the newest waiting chat goes first, since follow-ups
+        will be answered by a single call as soon as the generation ends.
+        """
+        victim, victim_key = None, None
+        for chat_id, pending in self._pending.items():
+            waiter = self._waiters.get(chat_id)
+            if waiter is not None:
+                key = (waiter.priority, -waiter.seq)
+            else:
+                key = (min(entry[0] for entry in pending), float('-inf'))
+            if victim_key is None or key > victim_key:
+                victim, victim_key = chat_id, key
+        if victim is None or victim_key[0] <= priority:
+            return False
+
+        waiter = self._waiters.pop(victim, None)
+        self._shed_later(victim, self._take_pending(victim), SHED_QUEUE_FULL)
+        if waiter is not None:
+            waiter.future.set_result(SHED_QUEUE_FULL)
+        return True
+
+    def _take_pending(self, chat_id: int, count: Optional[int] = None) -> List[Tuple[int, float, Any]]:
+        """Remove up to count of a chat's oldest pending triggers"""
+        pending = self._pending.pop(chat_id, [])
+        if count is not None and len(pending) > count:
+            self._pending[chat_id] = pending[count:]
+            pending = pending[:count]
+        self._pending_count -= len(pending)
+        return pending
+
+    async def _acquire(self, chat_id: int, queued_at: float) -> Optional[str]:
+        """Wait for a generation slot; returns None once granted, or the shed reason.
+
+        The deadline counts from queued_at, when the chat started waiting.
+        """
+        if self._free_slots > 0 and not self._waiters:
+            self._free_slots -= 1
+            return None
+
+        loop = asyncio.get_running_loop()
+        pending = self._pending[chat_id]
+        self._seq += 1
+        waiter = _Waiter(min(entry[0] for entry in pending), self._seq, loop.create_future())
+        self._waiters[chat_id] = waiter
+        heapq.heappush(self._queue, (waiter.priority, waiter.seq, chat_id))
+
+        timeout = None
+        if self.queue_deadline is not None:
+            timeout = max(queued_at + self.queue_deadline - loop.time(), 0.0)
+        try:
+            await asyncio.wait((waiter.future,), timeout=timeout)
+        finally:
+            if not waiter.future.done():
+                # Deadline passed or the worker was cancelled
+                self._waiters.pop(chat_id, None)
+                waiter.future.set_result(SHED_DEADLINE)
+        return waiter.future.result()
+
+    def _keeps_slot(self, chat_id: int) -> bool:
+        """Check whether a chat's follow-up triggers are more urgent than every waiting chat.
+
+        A chat finishing a generation is not in the queue, so without this a
+        less urgent chat would take its slot ahead of its pending follow-ups.
+        """
+        pending = self._pending.get(chat_id)
+        if not pending:
+            return False
+        priority = min(entry[0] for entry in pending)
+        while self._queue:
+            top_priority, seq, waiting_chat = self._queue[0]
+            waiter = self._waiters.get(waiting_chat)
+            if waiter is not None and waiter.seq == seq:
+                return priority < top_priority
+            heapq.heappop(self._queue)
+        return True
+
+    def _release(self):
+        """Hand a freed slot to the most urgent waiting chat"""
+        while self._queue:
+            _, seq, chat_id = heapq.heappop(self._queue)
+            waiter = self._waiters.get(chat_id)
+            if waiter is None or waiter.seq != seq:
+                continue
+            del self._waiters[chat_id]
+            waiter.future.set_result(None)
+            return
+        self._free_slots += 1
+
+    async def _run_chat(self, chat_id: int):
+        """Process pending batches for a chat until none are left"""
+        loop = asyncio.get_running_loop()
+        holding = False
+        try:
+            while self._pending.get(chat_id):
+                queued_at = loop.time()
+                shed_reason = None if holding else await self._acquire(chat_id, queued_at)
+                holding = False
+                if shed_reason == SHED_DEADLINE:
+                    await self._shed(chat_id, self._take_pending(chat_id), shed_reason)
+                if shed_reason is not None:
+                    # Triggers bumped for lack of room were already shed
+                    continue
+
+                try:
+                    # Take the batch only once a slot is free, so triggers that
+                    # arrive while waiting are coalesced into the same call
+                    batch = self._take_pending(chat_id, self.max_batch_size)
+                    metrics.QUEUE_WAIT_SECONDS.observe(loop.time() - queued_at)
+                    self._stats['admitted'] += len(batch)
+
+                    self._in_flight += 1
+                    try:
+                        await self._handler(chat_id, [item for _, _, item in batch])
+                    except Exception as e:
+                        logger.error(f"Error generating response for chat {chat_id}: {e}")
+                    finally:
+                        self._in_flight -= 1
+                finally:
+                    holding = self._keeps_slot(chat_id)
+                    if not holding:
+                        self._release()
+        finally:
+            if holding:
+                self._release()
+            self._workers.pop(chat_id, None)
+
+    def _shed_later(self, chat_id: int, batch: List[Tuple[int, float, Any]], reason: str):
+        """Shed triggers from synchronous code"""
+        task = asyncio.create_task(self._shed(chat_id, batch, reason))
+        self._shed_tasks.add(task)
+        task.add_done_callback(self._shed_tasks.discard)
+
+    async def _shed(self, chat_id: int, batch: List[Tuple[int, float, Any]], reason: str):
+        """Refuse a batch of triggers without generating a response"""
+        if not batch:
+            return
+        self._stats[reason] += len(batch)
+        metrics.SHED_TRIGGERS.inc(len(batch), reason=reason)
+        logger.warning(f"Shedding {len(batch)} triggers in chat {chat_id}: {reason}")
+
+        if self._shed_handler is not None:
+            try:
+                await self._shed_handler(chat_id, [item for _, _, item in batch], reason)
+            except Exception as e:
+                logger.error(f"Error refusing triggers in chat {chat_id}: {e}")
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get scheduler statistics"""
+        return {
+            **self._stats,
+            'in_flight': self._in_flight,
+            'active_chats': len(self._workers),
+            'waiting_chats': len(self._waiters),
+            'pending_triggers': self._pending_count
+        }
+
+    async def shutdown(self):
+        """Cancel all chat workers and wait for them to finish"""
+        workers = [*self._workers.values(), *self._shed_tasks]
+        for task in workers:
+            task.cancel()
+
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        self._pending.clear()
+        self._pending_count = 0
+        logger.info(f"ChatScheduler stopped, cancelled {len(workers)} workers")
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-process deployment: an update-ingest process sharding chats across workers
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+import metrics
+from bot_config import BotConfig
+from webhook_server import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry a chat object, in the order they are checked
+_CHAT_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'business_message', 'edited_business_message', 'my_chat_member',
+    'chat_member', 'chat_join_request', 'message_reaction', 'message_reaction_count',
+    'chat_boost', 'removed_chat_boost'
+)
+
+def shard_key(update_data: Dict[str, Any]) -> int:
+    """Get the key that decides which worker handles an update.
+
+    Updates are keyed by chat id so every update of a chat lands on the same
+    worker, in order. Updates without a chat fall back to the sender or the
+    update id.
+    """
+    for field in _CHAT_FIELDS:
+        chat = (update_data.get(field) or {}).get('chat')
+        if chat:
+            return chat['id']
+
+    callback_query = update_data.get('callback_query') or {}
+    chat = (callback_query.get('message') or {}).get('chat')
+    if chat:
+        return chat['id']
+
+    for value in update_data.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from']['id']
+
+    return update_data.get('update_id', 0)
+
+def worker_socket_path(config: BotConfig, index: int) -> str:
+    """Unix socket path of a worker"""
+    return os.path.join(config.cluster_socket_dir, f"bratik-worker-{index}.sock")
+
+def worker_metrics_path(config: BotConfig, index: int) -> str:
+    """Unix socket path of a worker's probe and metrics server"""
+    return os.path.join(config.cluster_socket_dir, f"bratik-worker-{index}-metrics.sock")
+
+class ShardRouter:
+    """Forwards raw updates to worker processes over Unix sockets.
+
+    Each worker has one ordered stream connection, so updates of a chat
+    arrive at its worker in the order they were routed.
+    """
+
+    def __init__(self, socket_paths: List[str], connect_timeout: float = 30.0):
+        self.socket_paths = socket_paths
+        self.connect_timeout = connect_timeout
+        self._writers: List[Optional[asyncio.StreamWriter]] = [None] * len(socket_paths)
+        self._locks = [asyncio.Lock() for _ in socket_paths]
+        self._routed = [0] * len(socket_paths)
+
+    async def _connect(self, index: int) -> asyncio.StreamWriter:
+        """Connect to a worker, waiting for it to start listening"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_paths[index])
+                logger.info(f"Connected to worker {index}")
+                return writer
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() >= deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+    async def connect_all(self):
+        """Connect to every worker"""
+        for index in range(len(self.socket_paths)):
+            async with self._locks[index]:
+                if self._writers[index] is None:
+                    self._writers[index] = await self._connect(index)
+
+    async def route(self, update_data: Dict[str, Any]):
+        """Send an update to the worker owning its chat"""
+        index = shard_key(update_data) % len(self.socket_paths)
+        line = json.dumps(update_data, ensure_ascii=False).encode('utf-8') + b'\n'
+
+        async with self._locks[index]:
+            writer = self._writers[index]
+            if writer is None or writer.is_closing():
+                writer = self._writers[index] = await self._connect(index)
+
+            try:
+                writer.write(line)
+                await writer.drain()
+            except (ConnectionError, OSError):
+                # Worker restarted; reconnect once and resend
+                self._writers[index] = None
+                writer = self._writers[index] = await self._connect(index)
+                writer.write(line)
+                await writer.drain()
+
+        self._routed[index] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get per-worker routing counters"""
+        return {'routed_per_worker': list(self._routed)}
+
+    async def close(self):
+        """Close all worker connections"""
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+        self._writers = [None] * len(self.socket_paths)
+
+def _worker_main(index: int, socket_path: str, metrics_path: str):
+    """Entry point of a worker process"""
+    # Imported here so the ingest process never loads the bot's subsystems
+    from main import TelegramBot, configure_logging
+
+    configure_logging()
+    bot = TelegramBot()
+    asyncio.run(run_worker(bot, index, socket_path, metrics_path))
+
+async def run_worker(bot, index: int, socket_path: str, metrics_path: Optional[str] = None):
+    """Process updates routed to this worker until terminated.
+
+    With metrics_path, the worker's /health, /ready and /metrics are served
+    on that Unix socket for the ingest process to collect.
+    """
+    application = bot.build_application(with_updater=False)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while line := await reader.readline():
+            try:
+                update = Update.de_json(json.loads(line), application.bot)
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.error(f"Worker {index} got an invalid update: {e}")
+                continue
+            await application.update_queue.put(update)
+        writer.close()
+
+    await bot.start_application(application)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    logger.info(f"Worker {index} listening on {socket_path}")
+
+    metrics_server = None
+    if metrics_path is not None:
+        if os.path.exists(metrics_path):
+            os.unlink(metrics_path)
+        metrics_server = WebhookServer(None, webhook_path=None, path=metrics_path)
+        await metrics_server.start()
+        metrics_server.set_ready(True)
+
+    try:
+        await stop_event.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await bot.stop_application(application)
+        for path in (socket_path, metrics_path):
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+
+class Cluster:
+    """Supervises worker processes and feeds them updates.
+
+    The ingest process serves /health, /ready and /metrics on the configured
+    port in both polling and webhook mode. /metrics collects every worker's
+    metrics from its metrics socket and adds a worker label to them.
+    """
+
+    def __init__(self, config: BotConfig):
+        self.config = config
+        self.socket_paths = [worker_socket_path(config, index) for index in range(config.workers)]
+        self.metrics_paths = [worker_metrics_path(config, index) for index in range(config.workers)]
+        self.router = ShardRouter(self.socket_paths)
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * config.workers
+        self._workers_up = [0] * config.workers
+        metrics.REGISTRY.callback(
+            'bratik_cluster_routed_updates_total', 'Updates routed to each worker',
+            lambda: {str(index): count for index, count in enumerate(self.router.get_stats()['routed_per_worker'])},
+            'counter', ('worker',))
+        metrics.REGISTRY.callback(
+            'bratik_cluster_worker_up', 'Whether the last metrics scrape of each worker succeeded',
+            lambda: {str(index): up for index, up in enumerate(self._workers_up)}, 'gauge', ('worker',))
+
+    def _start_worker(self, index: int):
+        """Spawn a worker process"""
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.socket_paths[index], self.metrics_paths[index]),
+            name=f"bratik-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    async def _supervise(self):
+        """Restart workers that exit unexpectedly"""
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self._start_worker(index)
+
+    async def _poll_updates(self, stop_event: asyncio.Event):
+        """Long-poll Telegram and route updates (polling mode)"""
+        async with Bot(self.config.telegram_bot_token) as bot:
+            await bot.delete_webhook()
+            offset = None
+            while not stop_event.is_set():
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+                except TelegramError as e:
+                    logger.error(f"Error polling updates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+
+                try:
+                    for update in updates:
+                        await self.router.route(update.to_dict())
+                        offset = update.update_id + 1
+                except Exception as e:
+                    # E.g. a worker being restarted; the next poll fetches the
+                    # update again from the same offset
+                    logger.error(f"Error routing update, retrying: {e}")
+                    await asyncio.sleep(1)
+
+    async def _scrape_worker(self, index: int) -> Optional[str]:
+        """Fetch a worker's metrics, or None if it does not answer"""
+        try:
+            connector = aiohttp.UnixConnector(path=self.metrics_paths[index])
+            async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=5)) as session:
+                async with session.get('http://worker/metrics') as response:
+                    response.raise_for_status()
+                    return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.warning(f"Cannot collect metrics of worker {index}: {e}")
+            return None
+
+    async def render_metrics(self) -> str:
+        """Render the ingest metrics merged with those of every worker"""
+        scraped = await asyncio.gather(*(self._scrape_worker(index) for index in range(self.config.workers)))
+        renderings = {}
+        for index, text in enumerate(scraped):
+            self._workers_up[index] = int(text is not None)
+            if text is not None:
+                renderings[str(index)] = text
+        return metrics.merge_renderings({None: metrics.REGISTRY.render(), **renderings}, 'worker')
+
+    def _on_poller_done(self, task: asyncio.Task, stop_event: asyncio.Event):
+        """Stop the ingest process if polling ends unexpectedly, so it gets restarted"""
+        if task.cancelled() or stop_event.is_set():
+            return
+        logger.error(f"Update polling stopped: {task.exception()!r}, shutting down")
+        stop_event.set()
+
+    async def run(self):
+        """Run the ingest process until terminated"""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        for index in range(self.config.workers):
+            self._start_worker(index)
+        supervisor = asyncio.create_task(self._supervise())
+
+        webhook = self.config.bot_mode == 'webhook'
+        server = WebhookServer(
+            None,
+            port=self.config.port,
+            webhook_path=self.config.webhook_path if webhook else None,
+            secret_token=self.config.webhook_secret,
+            dispatch=self.router.route,
+            render_metrics=self.render_metrics
+        )
+        poller = None
+        try:
+            await self.router.connect_all()
+
+            if webhook:
+                await server.start()
+                async with Bot(self.config.telegram_bot_token) as bot:
+                    await bot.set_webhook(
+                        url=self.config.webhook_url.rstrip('/') + self.config.webhook_path,
+                        secret_token=self.config.webhook_secret,
+                        allowed_updates=Update.ALL_TYPES
+                    )
+            else:
+                # As in single-process polling, updates do not depend on the HTTP server
+                try:
+                    await server.start()
+                except OSError as e:
+                    logger.warning(f"Cannot serve /health and /metrics on port {self.config.port}: {e}")
+                poller = asyncio.create_task(self._poll_updates(stop_event))
+                poller.add_done_callback(lambda task: self._on_poller_done(task, stop_event))
+            server.set_ready(True)
+
+            logger.info(f"Cluster ingest running with {self.config.workers} workers")
+            await stop_event.wait()
+        finally:
+            logger.info("Shutting down cluster...")
+            for task in (supervisor, poller):
+                if task is not None:
+                    task.cancel()
+            await server.stop()
+            await self.router.close()
+
+            for process in self._processes:
+                if process is not None and process.is_alive():
+                    process.terminate()
+            for process in self._processes:
+                if process is not None:
+                    process.join(timeout=15)
+
+def run_cluster(config: BotConfig):
+    """Run the bot as an ingest process plus config.workers worker processes"""
+    asyncio.run(Cluster(config).run())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token-budgeted prompt assembly from chat history
+"""
+
+import logging
+from typing import Dict, Iterable, List, Sequence
+
+from message_record import MessageRecord
+
+logger = logging.getLogger(__name__)
+
+# Approximate per-message cost of role and formatting tokens in the chat template
+MESSAGE_OVERHEAD_TOKENS = 4
+
+RETRIEVED_HEADER = "\n\nСообщения из более ранней переписки, связанные с вопросом:\n"
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the token count of a text without a tokenizer.
+
+    BPE tokenizers average about 4 UTF-8 bytes per token: ~4 characters for
+    Latin text and ~2 for Cyrillic, which is 2 bytes per character. Encoding
+    runs in C, so this is cheap even for pasted logs.
+    """
+    return len(text.encode('utf-8')) // 4 + 1
+
+def record_tokens(record: MessageRecord) -> int:
+    """Get the token estimate of a stored message, caching it on the record"""
+    if record.token_count < 0:
+        record.token_count = estimate_tokens(f"{record.username}: {record.text}") + MESSAGE_OVERHEAD_TOKENS
+    return record.token_count
+
+class ContextBuilder:
+    """Builds chat completion prompts that fit a token budget.
+
+    History is added newest-first until the budget or the message limit is
+    reached, then emitted in chronological order. Older messages found by
+    retrieval get up to retrieval_token_budget of the budget first.
+    """
+
+    def __init__(self, token_budget: int = 2000, max_messages: int = 30, drop_current_message: bool = True,
+                 retrieval_token_budget: int = 300):
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.drop_current_message = drop_current_message
+        self.retrieval_token_budget = retrieval_token_budget
+
+        logger.info(f"ContextBuilder initialized with {token_budget} token budget")
+
+    def build(self, system_prompt: str, history: Sequence[MessageRecord], current_message: str,
+              current_message_ids: Iterable[int] = (), min_seq: int = -1,
+              retrieved: Sequence[MessageRecord] = ()) -> List[Dict[str, str]]:
+        """Build prompt messages from system prompt, chat history and current message.
+
+        current_message_ids are the stored ids of the message(s) being answered;
+        with drop_current_message they are skipped in history, since the
+        current message is appended separately at the end. Messages with
+        seq <= min_seq are already covered by a summary and are left out.
+        retrieved are relevant older messages, best first; they are quoted in
+        the system prompt even if a summary covers them.
+        """
+        excluded = set(current_message_ids) if self.drop_current_message else set()
+        remaining = (self.token_budget
+                     - estimate_tokens(system_prompt) - estimate_tokens(current_message)
+                     - 2 * MESSAGE_OVERHEAD_TOKENS)
+
+        # Retrieved messages are quoted in the system prompt, in chronological order
+        recalled = []
+        recall_remaining = min(self.retrieval_token_budget, remaining) - estimate_tokens(RETRIEVED_HEADER)
+        for record in retrieved:
+            cost = record_tokens(record)
+            if cost <= recall_remaining:
+                recall_remaining -= cost
+                recalled.append(record)
+        if recalled:
+            recalled.sort(key=lambda record: record.seq)
+            recalled_text = "\n".join(f"{record.username}: {record.text}" for record in recalled)
+            system_prompt += RETRIEVED_HEADER + recalled_text
+            remaining -= estimate_tokens(RETRIEVED_HEADER + recalled_text)
+
+        selected = []
+        for record in reversed(history):
+            if len(selected) >= self.max_messages or record.seq <= min_seq:
+                break
+            if (record.message_id in excluded and not record.is_bot) or record in recalled:
+                continue
+
+            cost = record_tokens(record)
+            if cost > remaining:
+                break
+
+            remaining -= cost
+            selected.append(record)
+
+        context_messages = [{"role": "system", "content": system_prompt}]
+        for record in reversed(selected):
+            context_messages.append({
+                "role": "assistant" if record.is_bot else "user",
+                "content": f"{record.username}: {record.text}"
+            })
+        context_messages.append({"role": "user", "content": current_message})
+
+        logger.debug(f"Built context with {len(selected)} history messages, {self.token_budget - remaining} tokens")
+        return context_messages
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rolling conversation summaries for long-running chats
+"""
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Dict, Optional
+
+from context_builder import estimate_tokens
+from message_memory import MessageMemory
+from openrouter_client import OpenRouterClient
+from text_formatting import strip_reasoning
+
+if TYPE_CHECKING:
+    from rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """Ты ведешь краткий конспект группового чата на русском языке.
+Обнови конспект, добавив в него важное из новых сообщений: темы, факты, договоренности, кто что сказал.
+Пиши сжато, не более 150 слов, без вступлений. Верни только обновленный конспект."""
+
+class ConversationSummarizer:
+    """Folds older chat messages into a stored running summary.
+
+    Once a chat has threshold messages that the summary does not cover yet,
+    everything except the newest keep_recent of them is summarized in a
+    background task, so the prompt keeps older context at a flat size.
+    With a rate_limiter, summary tokens are charged to the chat's daily
+    quota and chats that used it up are not summarized.
+    """
+
+    def __init__(self, client: OpenRouterClient, memory: MessageMemory,
+                 threshold: int = 80, keep_recent: int = 30, max_concurrent: int = 2,
+                 rate_limiter: Optional['RateLimiter'] = None):
+        self.client = client
+        self.memory = memory
+        self.rate_limiter = rate_limiter
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+        logger.info(f"ConversationSummarizer initialized: threshold {threshold}, keep recent {keep_recent}")
+
+    async def maybe_schedule(self, chat_id: int):
+        """Start a summary update for a chat if enough new messages accumulated"""
+        if chat_id in self._tasks:
+            return
+        if self.rate_limiter is not None and self.rate_limiter.chat_over_quota(chat_id):
+            return
+
+        newest = await self.memory.get_recent_messages(chat_id, 1)
+        if not newest:
+            return
+
+        _, summarized_seq = await self.memory.get_summary(chat_id)
+        if newest[0].seq - summarized_seq < self.threshold:
+            return
+
+        task = asyncio.create_task(self._summarize(chat_id))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+
+    async def _summarize(self, chat_id: int):
+        """Fold unsummarized messages older than the recent window into the summary"""
+        try:
+            async with self._semaphore:
+                summary, summarized_seq = await self.memory.get_summary(chat_id)
+                history = await self.memory.get_chat_messages(chat_id)
+
+                # Copy the slice to fold now, since the view must not outlive new appends
+                to_fold = [record for record in history[:max(len(history) - self.keep_recent, 0)]
+                           if record.seq > summarized_seq]
+                if not to_fold:
+                    return
+
+                transcript = "\n".join(f"{record.username}: {record.text}" for record in to_fold)
+                previous = summary or "(пока пусто)"
+                messages = [
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": f"Текущий конспект:\n{previous}\n\nНовые сообщения:\n{transcript}"}
+                ]
+
+                logger.info(f"Summarizing {len(to_fold)} messages in chat {chat_id}")
+                usage = {}
+                new_summary = await self.client.generate_response(messages, max_tokens=400, usage=usage)
+                self._charge_usage(chat_id, messages, new_summary, usage)
+                new_summary = strip_reasoning(new_summary) if new_summary else new_summary
+                if not new_summary:
+                    logger.warning(f"Summary generation failed for chat {chat_id}")
+                    return
+
+                # Skip the update if the chat was cleared while generating
+                last_folded = to_fold[-1]
+                if not any(record is last_folded for record in await self.memory.get_chat_messages(chat_id)):
+                    return
+
+                await self.memory.set_summary(chat_id, new_summary, last_folded.seq, summarized_seq)
+
+        except Exception as e:
+            logger.error(f"Error summarizing chat {chat_id}: {e}")
+
+    def _charge_usage(self, chat_id: int, messages: list, response: Optional[str], usage: Dict[str, int]):
+        """Charge a summary's tokens to the daily quota of its chat"""
+        if self.rate_limiter is None:
+            return
+        tokens = usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+        if not tokens and response:
+            # The API reported no usage; fall back to the local estimate
+            tokens = sum(estimate_tokens(m['content']) for m in messages) + estimate_tokens(response)
+        self.rate_limiter.record_usage(chat_id, (), tokens)
+
+    async def shutdown(self):
+        """Cancel running summary tasks"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -7,32 +7,249 @@ Responds to "Братик" mentions and replies with context memory
 
 import logging
 import asyncio
-import os
-import json
+import functools
+import signal
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.constants import ParseMode
-import threading
+from telegram.error import BadRequest, RetryAfter
 import time
 
 from bot_config import BotConfig
 from openrouter_client import OpenRouterClient
 from message_memory import MessageMemory
-from keep_alive import keep_alive_thread
+from message_record import MessageRecord
+from chat_scheduler import ChatScheduler, trigger_priority
+from context_builder import ContextBuilder, estimate_tokens
+from triggers import TriggerEngine
+from prompt_classifier import is_small_talk
+from text_formatting import format_reply, strip_reasoning
+from webhook_server import WebhookServer
+from keep_alive import keep_alive_ping
+from maintenance import MaintenanceScheduler
+import metrics
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Optional subsystems (SQLite storage, retrieval, summaries, response cache,
+# rate limiting, cluster mode) are imported only when enabled, keeping the
+# import of this module cheap and free of side effects
 logger = logging.getLogger(__name__)
 
 class TelegramBot:
-    def __init__(self):
-        self.config = BotConfig()
-        self.openrouter_client = OpenRouterClient(self.config.openrouter_api_key)
-        self.message_memory = MessageMemory()
+    RATE_LIMIT_MESSAGES = {
+        'user_rate': "Притормози, братан, не так часто. Попробуй через минуту.",
+        'chat_rate': "В чате слишком много вопросов подряд, дайте мне минуту.",
+        'user_quota': "Ты исчерпал свой лимит на сегодня. Возвращайся позже!",
+        'chat_quota': "Лимит чата на сегодня исчерпан. Возвращайтесь позже!"
+    }
+    BUSY_MESSAGE = "Я сейчас завален вопросами, братан. Спроси чуть позже!"
+    INTERRUPTED_NOTE = "(Ответ оборвался из-за ошибки, спроси ещё раз.)"
+
+    def __init__(self, config: BotConfig = None):
+        self.config = config or BotConfig()
+        self.openrouter_client = OpenRouterClient(
+            self.config.openrouter_api_key,
+            base_url=self.config.openrouter_base_url,
+            model=self.config.model_name,
+            fallback_models=self.config.fallback_models,
+            max_retries=self.config.openrouter_max_retries,
+            retry_base_delay=self.config.openrouter_retry_base_delay,
+            retry_max_delay=self.config.openrouter_retry_max_delay,
+            request_timeout=self.config.openrouter_timeout,
+            breaker_threshold=self.config.circuit_breaker_threshold,
+            breaker_reset_timeout=self.config.circuit_breaker_reset_timeout,
+            hedge_percentile=self.config.hedge_percentile,
+            pool_limit=self.config.openrouter_pool_limit,
+            pool_limit_per_host=self.config.openrouter_pool_limit_per_host,
+            dns_cache_ttl=self.config.openrouter_dns_cache_ttl,
+            keepalive_timeout=self.config.openrouter_keepalive_timeout,
+            reasoning=self.config.get_reasoning_options() or None,
+            fast_model=self.config.fast_model
+        )
+        storage = None
+        if self.config.memory_db_path:
+            from memory_storage import SQLiteStorage
+            storage = SQLiteStorage(self.config.memory_db_path)
+        self.vector_index = None
+        if self.config.retrieval_enabled:
+            from vector_index import HashingEmbedder, VectorIndex
+            self.vector_index = VectorIndex(
+                capacity=self.config.max_context_messages,
+                max_chats=self.config.retrieval_max_chats,
+                # Trigger words appear in every question, so they carry no topic
+                embedder=HashingEmbedder(stop_words=self.config.trigger_words)
+            )
+        self.message_memory = MessageMemory(
+            max_messages_per_chat=self.config.max_context_messages,
+            storage=storage,
+            max_cached_chats=self.config.memory_cached_chats,
+            idle_ttl=self.config.memory_idle_ttl,
+            max_total_messages=self.config.memory_max_total_messages,
+            index=self.vector_index
+        )
+        self.response_cache = None
+        if self.config.response_cache_enabled:
+            from response_cache import ResponseCache
+            self.response_cache = ResponseCache(
+                max_entries=self.config.response_cache_size,
+                ttl=self.config.response_cache_ttl,
+                scope=self.config.response_cache_scope,
+                context_messages=self.config.response_cache_context_messages
+            )
+        self.rate_limiter = None
+        if self.config.rate_limit_enabled:
+            from rate_limiter import LimitTier, RateLimiter
+            default_tier = LimitTier(
+                'default',
+                user_rate_per_minute=self.config.user_rate_per_minute,
+                user_burst=self.config.user_burst,
+                chat_rate_per_minute=self.config.chat_rate_per_minute,
+                chat_burst=self.config.chat_burst,
+                user_daily_tokens=self.config.user_daily_tokens,
+                chat_daily_tokens=self.config.chat_daily_tokens
+            )
+            self.rate_limiter = RateLimiter(
+                default_tier,
+                tiers={name: default_tier.derive(name, overrides)
+                       for name, overrides in self.config.rate_limit_tiers.items()},
+                user_tiers=self.config.rate_limit_user_tiers,
+                chat_tiers=self.config.rate_limit_chat_tiers,
+                storage=storage
+            )
+        self.summarizer = None
+        if self.config.summary_enabled:
+            from conversation_summarizer import ConversationSummarizer
+            self.summarizer = ConversationSummarizer(
+                self.openrouter_client,
+                self.message_memory,
+                threshold=self.config.summary_threshold,
+                keep_recent=self.config.summary_keep_recent,
+                rate_limiter=self.rate_limiter
+            )
+        self.trigger_engine = TriggerEngine(self.config.trigger_words, storage=storage)
+        self.context_builder = ContextBuilder(
+            token_budget=self.config.context_token_budget,
+            max_messages=self.config.context_max_messages,
+            drop_current_message=self.config.context_drop_current_message,
+            retrieval_token_budget=self.config.retrieval_token_budget
+        )
+        self.chat_scheduler = ChatScheduler(
+            self.respond_to_triggers,
+            max_concurrent=self.config.max_concurrent_generations,
+            max_batch_size=self.config.max_coalesced_triggers,
+            max_queue_size=self.config.generation_queue_size,
+            queue_deadline=self.config.generation_queue_deadline,
+            shed_handler=self.reply_busy
+        )
+        self.maintenance = MaintenanceScheduler(jitter=self.config.maintenance_jitter)
         self.bot_username = None
+        self.http_server = None
+        self._warmup_task = None
+        self._schedule_maintenance()
+        self._register_metrics()
+
+    def _schedule_maintenance(self):
+        """Register periodic background work run on the event loop"""
+        config = self.config
+        maintenance = self.maintenance
+
+        if self.message_memory.storage is not None:
+            maintenance.add('memory_flush', self.message_memory.flush, config.memory_flush_interval)
+        maintenance.add('memory_evict', self.message_memory.evict, config.memory_evict_interval)
+
+        if self.rate_limiter is not None:
+            maintenance.add('rate_limit_prune', self.rate_limiter.prune, self.rate_limiter.idle_prune_interval)
+            if self.rate_limiter.storage is not None:
+                maintenance.add('quota_save', self._save_quotas, config.quota_save_interval, timeout=30)
+
+        if self.response_cache is not None:
+            maintenance.add('response_cache_purge', self.response_cache.purge_expired, config.response_cache_ttl)
+
+        # Checked twice per idle period, so the pool closes at most 1.5 periods after the last request
+        maintenance.add('openrouter_idle_close',
+                        functools.partial(self.openrouter_client.close_if_idle, config.openrouter_idle_close),
+                        config.openrouter_idle_close / 2, timeout=10)
+
+        if config.keep_alive_url:
+            maintenance.add('keep_alive', functools.partial(keep_alive_ping, config.keep_alive_url),
+                            config.keep_alive_interval, timeout=15)
+
+        maintenance.add('stats_log', self._log_stats, config.stats_log_interval)
+
+    async def _save_quotas(self):
+        """Persist token quotas, writing from the default executor"""
+        if not self.rate_limiter.restored:
+            return
+        rows, expired_before_hour = self.rate_limiter.snapshot_quotas()
+        try:
+            saved = await asyncio.to_thread(self.rate_limiter.storage.save_quotas, rows, expired_before_hour)
+        except Exception:
+            self.rate_limiter.requeue_quotas(rows)
+            raise
+        # Saved totals include usage recorded by other worker processes
+        self.rate_limiter.adopt_saved(saved)
+        logger.debug(f"Saved {len(rows)} token quotas")
+
+    def _log_stats(self):
+        """Log a snapshot of memory, generation and connection pool statistics"""
+        memory = self.message_memory.get_memory_stats()
+        scheduler = self.chat_scheduler.get_stats()
+        pool = self.openrouter_client.get_pool_stats()
+        logger.info(f"Stats: {memory['total_chats']} chats / {memory['total_messages']} messages in memory, "
+                    f"{memory['pending_writes']} pending writes; {scheduler['in_flight']} generations in flight, "
+                    f"{scheduler['pending_triggers']} triggers pending; {pool['requests']} OpenRouter requests, "
+                    f"{pool['reuse_ratio']:.0%} connections reused")
+
+    def _register_metrics(self):
+        """Expose subsystem statistics as metrics read at scrape time"""
+        registry = metrics.REGISTRY
+        memory_stats = self.message_memory.get_memory_stats
+        registry.callback('bratik_memory_chats', 'Chats held in memory',
+                          lambda: memory_stats()['total_chats'])
+        registry.callback('bratik_memory_messages', 'Messages held in memory',
+                          lambda: memory_stats()['total_messages'])
+        registry.callback('bratik_memory_pending_writes', 'Memory operations waiting to be flushed',
+                          lambda: memory_stats()['pending_writes'])
+        registry.callback('bratik_memory_evictions_total', 'Chats evicted from memory',
+                          lambda: {reason: memory_stats()['eviction'].get(f'evicted_{reason}', 0)
+                                   for reason in ('idle', 'capacity')},
+                          'counter', ('reason',))
+
+        scheduler_stats = self.chat_scheduler.get_stats
+        registry.callback('bratik_generations_in_flight', 'Responses being generated',
+                          lambda: scheduler_stats()['in_flight'])
+        registry.callback('bratik_pending_triggers', 'Triggers waiting for a generation slot',
+                          lambda: scheduler_stats()['pending_triggers'])
+        registry.callback('bratik_generation_queue_depth', 'Chats queued for a generation slot',
+                          lambda: scheduler_stats()['waiting_chats'])
+
+        pool_stats = self.openrouter_client.get_pool_stats
+        registry.callback('bratik_openrouter_connections_total', 'OpenRouter connections by kind',
+                          lambda: {'created': pool_stats()['connections_created'],
+                                   'reused': pool_stats()['connections_reused']},
+                          'counter', ('kind',))
+
+        if self.rate_limiter is not None:
+            limiter_stats = self.rate_limiter.get_stats
+            registry.callback('bratik_rate_limited_total', 'Triggers rejected by rate limits and quotas',
+                              lambda: {reason: limiter_stats()[reason]
+                                       for reason in ('user_rate', 'chat_rate', 'user_quota', 'chat_quota')},
+                              'counter', ('reason',))
+
+        if self.response_cache is not None:
+            cache_stats = self.response_cache.get_stats
+            registry.callback('bratik_response_cache_lookups_total', 'Response cache lookups by result',
+                              lambda: {result: cache_stats()[result] for result in ('hits', 'misses', 'shared')},
+                              'counter', ('result',))
+            registry.callback('bratik_response_cache_entries', 'Cached responses',
+                              lambda: cache_stats()['entries'])
+
+        if self.vector_index is not None:
+            index_stats = self.vector_index.get_stats
+            registry.callback('bratik_retrieval_searches_total', 'Retrieval index searches',
+                              lambda: index_stats()['searches'], 'counter')
+            registry.callback('bratik_retrieval_hits_total', 'Older messages added to prompts by retrieval',
+                              lambda: index_stats()['hits'], 'counter')
+            registry.callback('bratik_retrieval_indexed_chats', 'Chats held in the retrieval index',
+                              lambda: index_stats()['indexed_chats'])
         
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
@@ -55,17 +272,44 @@ class TelegramBot:
 /start - Запуск бота
 /help - Эта справка
 /clear_memory - Очистить память чата
+/triggers - Слова, на которые я откликаюсь (админы могут изменить)
         """
         await update.message.reply_text(help_text)
 
     async def clear_memory_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Clear chat memory"""
         chat_id = update.effective_chat.id
-        self.message_memory.clear_chat_memory(chat_id)
+        await self.message_memory.clear_chat_memory(chat_id)
         await update.message.reply_text("Память чата очищена!")
 
+    async def triggers_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show or change the chat's trigger words: /triggers [слово, слово | reset]"""
+        chat = update.effective_chat
+        await self.trigger_engine.load_chat(chat.id)
+        if not context.args:
+            words = self.trigger_engine.get_chat_triggers(chat.id)
+            await update.message.reply_text(
+                "Откликаюсь на: " + (", ".join(words) if words else "только ответы на мои сообщения")
+            )
+            return
+
+        if chat.type != 'private':
+            member = await context.bot.get_chat_member(chat.id, update.effective_user.id)
+            if member.status not in ('administrator', 'creator'):
+                await update.message.reply_text("Менять слова могут только админы чата.")
+                return
+
+        argument = " ".join(context.args)
+        if argument.strip().lower() == 'reset':
+            await self.trigger_engine.reset_chat_triggers(chat.id)
+        else:
+            await self.trigger_engine.set_chat_triggers(chat.id, argument.split(','))
+        words = self.trigger_engine.get_chat_triggers(chat.id)
+        await update.message.reply_text("Теперь откликаюсь на: " + (", ".join(words) or "только ответы"))
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle all messages"""
+        started = time.perf_counter()
         try:
             message = update.message
             if not message or not message.text:
@@ -77,142 +321,478 @@ class TelegramBot:
             message_text = message.text
             
             # Store message in memory
-            self.message_memory.add_message(chat_id, {
-                'user_id': user_id,
-                'username': username,
-                'text': message_text,
-                'timestamp': message.date.isoformat(),
-                'message_id': message.message_id,
-                'is_bot': False
-            })
+            await self.message_memory.add_message(chat_id, MessageRecord(
+                user_id=user_id,
+                username=username,
+                text=message_text,
+                timestamp=int(message.date.timestamp()),
+                message_id=message.message_id,
+                is_bot=False
+            ))
+            if self.summarizer is not None:
+                await self.summarizer.maybe_schedule(chat_id)
 
             # Check if bot should respond
-            should_respond = False
+            trigger_reason = None
+            replied_to = message.reply_to_message
             
-            # Check for "Братик" mention (case insensitive)
-            if "братик" in message_text.lower():
-                should_respond = True
-                logger.info(f"Triggered by 'Братик' mention in chat {chat_id}")
-            
-            # Check if this is a reply to bot's message
-            if message.reply_to_message and message.reply_to_message.from_user.id == context.bot.id:
-                should_respond = True
+            # Check if this is a reply to bot's message (cheapest check first)
+            if replied_to and replied_to.from_user and replied_to.from_user.id == context.bot.id:
+                trigger_reason = 'reply'
                 logger.info(f"Triggered by reply to bot message in chat {chat_id}")
+            
+            # Check for trigger words such as "Братик" (one precompiled pass)
+            else:
+                await self.trigger_engine.load_chat(chat_id)
+                if self.trigger_engine.matches(chat_id, message_text):
+                    trigger_reason = 'mention'
+                    logger.info(f"Triggered by trigger word in chat {chat_id}")
+
+            if trigger_reason:
+                metrics.TRIGGERS.inc(reason=trigger_reason)
+
+                # Enforce limits before anything reaches the scheduler or OpenRouter
+                if self.rate_limiter is not None:
+                    limited = self.rate_limiter.check(chat_id, user_id)
+                    if limited is not None:
+                        logger.info(f"Rate limited user {user_id} in chat {chat_id}: {limited}")
+                        if self.rate_limiter.should_notify(user_id, limited):
+                            await message.reply_text(self.RATE_LIMIT_MESSAGES[limited])
+                        return
 
-            if should_respond:
                 # Show typing indicator
                 await context.bot.send_chat_action(chat_id=chat_id, action="typing")
                 
-                # Get chat context
-                chat_history = self.message_memory.get_chat_messages(chat_id)
-                
-                # Generate response using OpenRouter
-                response = await self.generate_response(message_text, chat_history, username)
-                
-                if response:
-                    # Send response
-                    sent_message = await message.reply_text(
-                        response,
-                        parse_mode=ParseMode.MARKDOWN if self._is_markdown_safe(response) else None
-                    )
-                    
-                    # Store bot's response in memory
-                    self.message_memory.add_message(chat_id, {
-                        'user_id': context.bot.id,
-                        'username': self.bot_username or 'Братик',
-                        'text': response,
-                        'timestamp': sent_message.date.isoformat(),
-                        'message_id': sent_message.message_id,
-                        'is_bot': True
-                    })
-                else:
-                    await message.reply_text("Извините, произошла ошибка при генерации ответа.")
+                # Hand off to the per-chat scheduler; triggers arriving while a
+                # generation is pending are answered together in one call
+                self.chat_scheduler.submit(chat_id, {
+                    'message': message,
+                    'bot': context.bot,
+                    'user_id': user_id,
+                    'username': username,
+                    'text': message_text,
+                    'received_at': started
+                }, priority=trigger_priority(trigger_reason, update.effective_chat.type == 'private'))
                     
         except Exception as e:
             logger.error(f"Error handling message: {e}")
+            metrics.ERRORS.inc(stage='handle_message')
             try:
                 await update.message.reply_text("Произошла ошибка при обработке сообщения.")
             except:
                 pass
+        finally:
+            metrics.HANDLE_MESSAGE_SECONDS.observe(time.perf_counter() - started)
 
-    async def generate_response(self, current_message: str, chat_history: list, username: str) -> str:
-        """Generate AI response using OpenRouter"""
+    async def respond_to_triggers(self, chat_id: int, triggers: list):
+        """Generate one response for a batch of coalesced triggers"""
+        trigger = triggers[-1]
+        message = trigger['message']
+        bot = trigger['bot']
+        
         try:
-            # Prepare context from chat history
-            context_messages = []
+            if len(triggers) == 1:
+                username = trigger['username']
+                current_message = trigger['text']
+            else:
+                usernames = list(dict.fromkeys(t['username'] for t in triggers))
+                username = ", ".join(usernames)
+                current_message = "\n".join(f"{t['username']}: {t['text']}" for t in triggers)
+                logger.info(f"Answering {len(triggers)} coalesced triggers in chat {chat_id}")
             
-            # Add system message
-            system_prompt = f"""Ты - дружелюбный помощник по имени Братик. Ты общаешься на русском языке в неформальном стиле.
-Отвечай естественно и по делу, учитывая контекст предыдущих сообщений в чате.
-Пользователь {username} обратился к тебе."""
-
-            context_messages.append({
-                "role": "system",
-                "content": system_prompt
-            })
+            # Get chat context
+            chat_history = await self.message_memory.get_chat_messages(chat_id)
+            current_message_ids = tuple(t['message'].message_id for t in triggers)
             
-            # Add recent chat history for context (last 10 messages to avoid token limit)
-            recent_history = chat_history[-10:] if len(chat_history) > 10 else chat_history
+            context_messages = await self._build_context_messages(current_message, chat_history, username,
+                                                            current_message_ids, chat_id)
+            sent_message = None
+            usage = {}
+            generated = False
+            partial = None
+            # Short chit-chat skips the reasoning model
+            fast = bool(self.config.fast_model) and is_small_talk(current_message, self.config.fast_model_max_chars)
             
-            for msg in recent_history:
-                role = "assistant" if msg['is_bot'] else "user"
-                context_messages.append({
-                    "role": role,
-                    "content": f"{msg['username']}: {msg['text']}"
-                })
+            async def produce_response():
+                nonlocal sent_message, generated, partial
+                generated = True
+                if self.config.stream_responses:
+                    # Stream response, editing a single message as tokens arrive
+                    response, sent_message, complete = await self._stream_reply(message, context_messages,
+                                                                                usage, fast)
+                    if not complete:
+                        # A cut-off reply is shown with a note but never cached or stored
+                        partial = response
+                        return None
+                    return response
+                # Generate response using OpenRouter
+                response = await self.openrouter_client.generate_response(context_messages, usage=usage, fast=fast)
+                return strip_reasoning(response) if response else response
+            
+            if self.response_cache is not None:
+                cache_key = self.response_cache.make_key(chat_id, current_message, chat_history, current_message_ids)
+                response = await self.response_cache.get_or_compute(cache_key, produce_response)
+            else:
+                response = await produce_response()
+            
+            if generated and self.rate_limiter is not None:
+                self._charge_usage(chat_id, triggers, context_messages, response or partial, usage)
             
-            # Add current message
-            context_messages.append({
-                "role": "user",
-                "content": current_message
-            })
+            if partial is not None:
+                # The user already sees the cut-off text with INTERRUPTED_NOTE
+                metrics.ERRORS.inc(stage='generation')
+                return
             
-            # Generate response
-            response = await self.openrouter_client.generate_response(context_messages)
-            return response
+            if response and sent_message is None:
+                # Send response (cached, shared or non-streamed)
+                sent_message = await self._send_reply(message, response)
             
+            if response and sent_message:
+                # Store bot's response in memory
+                await self.message_memory.add_message(chat_id, MessageRecord(
+                    user_id=bot.id,
+                    username=self.bot_username or 'Братик',
+                    text=response,
+                    timestamp=int(sent_message.date.timestamp()),
+                    message_id=sent_message.message_id,
+                    is_bot=True
+                ))
+                if self.summarizer is not None:
+                    await self.summarizer.maybe_schedule(chat_id)
+                metrics.RESPONSE_SECONDS.observe(time.perf_counter() - triggers[0]['received_at'])
+            elif sent_message:
+                metrics.ERRORS.inc(stage='generation')
+                await sent_message.edit_text("Извините, произошла ошибка при генерации ответа.")
+            else:
+                metrics.ERRORS.inc(stage='generation')
+                await message.reply_text("Извините, произошла ошибка при генерации ответа.")
+                
         except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return None
+            logger.error(f"Error responding in chat {chat_id}: {e}")
+            metrics.ERRORS.inc(stage='respond')
+            try:
+                await message.reply_text("Произошла ошибка при обработке сообщения.")
+            except:
+                pass
+
+    async def reply_busy(self, chat_id: int, triggers: list, reason: str):
+        """Answer triggers shed under overload with a short busy reply"""
+        await triggers[-1]['message'].reply_text(self.BUSY_MESSAGE)
 
-    def _is_markdown_safe(self, text: str) -> bool:
-        """Check if text is safe for Markdown parsing"""
-        markdown_chars = ['*', '_', '`', '[', ']', '(', ')']
-        return not any(char in text for char in markdown_chars)
+    def _charge_usage(self, chat_id: int, triggers: list, context_messages: list, response, usage: dict):
+        """Charge a generation's tokens to the daily quotas of its chat and users"""
+        tokens = usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+        if not tokens:
+            # The API reported no usage; fall back to the local estimate
+            tokens = sum(estimate_tokens(m['content']) for m in context_messages) + estimate_tokens(response or '')
+        self.rate_limiter.record_usage(chat_id, [t['user_id'] for t in triggers], tokens)
+
+    async def _build_context_messages(self, current_message: str, chat_history, username: str,
+                                current_message_ids: tuple = (), chat_id: int = None) -> list:
+        """Build the chat completion prompt from chat history"""
+        system_prompt = f"""Ты - дружелюбный помощник по имени Братик. Ты общаешься на русском языке в неформальном стиле.
+Отвечай естественно и по делу, учитывая контекст предыдущих сообщений в чате.
+Пользователь {username} обратился к тебе."""
+
+        # Prepend the rolling summary of older messages, if any
+        summarized_seq = -1
+        if chat_id is not None and self.summarizer is not None:
+            summary, summarized_seq = await self.message_memory.get_summary(chat_id)
+            if summary:
+                system_prompt += f"\n\nКраткое содержание более ранней переписки в чате:\n{summary}"
+
+        # Older messages related to the question, beyond the recent window
+        retrieved = ()
+        if chat_id is not None and self.vector_index is not None:
+            retrieved = self.vector_index.search(chat_id, current_message, chat_history,
+                                                 k=self.config.retrieval_top_k,
+                                                 exclude_recent=self.config.context_max_messages,
+                                                 min_score=self.config.retrieval_min_score)
+
+        # Fill the token budget with the newest history messages
+        return self.context_builder.build(system_prompt, chat_history, current_message,
+                                          current_message_ids, min_seq=summarized_seq, retrieved=retrieved)
+
+    async def _stream_reply(self, message, context_messages: list, usage: dict = None, fast: bool = False):
+        """Stream a response into a reply message with rate-limited edits.
+        
+        The first message is sent as soon as enough tokens have arrived and is
+        then edited at most once per stream_edit_interval seconds, since
+        Telegram throttles frequent edits of the same message. Previews are
+        plain text; the final text is formatted and split like other replies.
+        Returns (response_text, sent_message, complete); the first two may be
+        None on failure. If the stream broke off after some text, that text is
+        sent with INTERRUPTED_NOTE appended and complete is False.
+        """
+        loop = asyncio.get_running_loop()
+        sent_message = None
+        shown_text = ""
+        buffer = []
+        last_edit = 0.0
+        complete = True
+        
+        try:
+            async for delta in self.openrouter_client.stream_response(context_messages, usage=usage, fast=fast):
+                buffer.append(delta)
+                text = strip_reasoning("".join(buffer)).strip()
+                
+                if sent_message is None:
+                    if len(text) < self.config.stream_min_chars:
+                        continue
+                    sent_message = await message.reply_text(self._truncate_for_telegram(text))
+                    shown_text = text
+                    last_edit = loop.time()
+                elif loop.time() - last_edit >= self.config.stream_edit_interval and text != shown_text:
+                    await self._edit_streamed_message(sent_message, text)
+                    shown_text = text
+                    last_edit = loop.time()
+        except Exception as e:
+            logger.error(f"Error while streaming response: {e}")
+            complete = False
+        
+        response = strip_reasoning("".join(buffer)).strip()
+        if not response:
+            return None, sent_message, True
+        
+        # Final formatted text: edit the preview, then send any overflow parts
+        final_text = response if complete else f"{response}\n\n{self.INTERRUPTED_NOTE}"
+        sent_message = await self._send_reply(message, final_text, sent_message)
+        return response, sent_message, complete
+
+    async def _send_reply(self, message, text: str, sent_message=None):
+        """Send a reply as MarkdownV2, split into several messages if it is too long.
+        
+        With sent_message (a streaming preview), the first part is edited into
+        it. Parts Telegram cannot parse are resent as plain text. Returns the
+        first message of the reply.
+        """
+        for index, (part, parse_mode, plain_text) in enumerate(
+                format_reply(text, self.config.max_response_length)):
+            if index == 0 and sent_message is not None:
+                await self._edit_streamed_message(sent_message, part, parse_mode, plain_text, final=True)
+                continue
+            
+            if index == 0:
+                send = message.reply_text
+            else:
+                send = functools.partial(message.get_bot().send_message, message.chat_id)
+            try:
+                sent = await send(part, parse_mode=parse_mode)
+            except BadRequest as e:
+                if parse_mode is None:
+                    raise
+                logger.warning(f"Telegram rejected formatted reply, sending plain text: {e}")
+                sent = await send(plain_text)
+            if sent_message is None:
+                sent_message = sent
+        return sent_message
+
+    async def _edit_streamed_message(self, sent_message, text: str, parse_mode=None, plain_text: str = None,
+                                     final: bool = False, attempts: int = 3):
+        """Edit a streamed message, ignoring transient edit failures.
+
+        A rate limited preview edit is dropped, since the next one replaces
+        it anyway. The final edit waits out the limit and retries, then
+        falls back to sending the text as a new message, so the user never
+        keeps a truncated preview.
+        """
+        try:
+            # Formatted parts are already sized by format_reply; cutting them could break escapes
+            await sent_message.edit_text(text if parse_mode else self._truncate_for_telegram(text),
+                                         parse_mode=parse_mode)
+        except BadRequest as e:
+            if parse_mode is not None and plain_text is not None and "parse" in str(e).lower():
+                logger.warning(f"Telegram rejected formatted edit, using plain text: {e}")
+                await self._edit_streamed_message(sent_message, plain_text, final=final, attempts=attempts)
+                return
+            # "Message is not modified" and similar are harmless while streaming
+            logger.debug(f"Skipped streaming edit: {e}")
+        except RetryAfter as e:
+            # PTB 22.2+ may give a timedelta here; the int form is deprecated
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            if not final:
+                logger.warning(f"Streaming edit rate limited, retry after {retry_after}s")
+                return
+            if attempts > 1:
+                logger.warning(f"Final streaming edit rate limited, retrying after {retry_after}s")
+                await asyncio.sleep(retry_after)
+                await self._edit_streamed_message(sent_message, text, parse_mode, plain_text,
+                                                  final=True, attempts=attempts - 1)
+                return
+            logger.warning("Final streaming edit still rate limited, sending the reply as a new message")
+            send = functools.partial(sent_message.get_bot().send_message, sent_message.chat_id)
+            try:
+                await send(text, parse_mode=parse_mode)
+            except BadRequest:
+                if parse_mode is None:
+                    raise
+                await send(plain_text)
+
+    def _truncate_for_telegram(self, text: str) -> str:
+        """Truncate text to the configured Telegram message length"""
+        limit = self.config.max_response_length
+        return text if len(text) <= limit else text[:limit - 1] + "…"
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle errors"""
         logger.error(f"Exception while handling an update: {context.error}")
+        metrics.ERRORS.inc(stage='update')
 
     async def post_init(self, application: Application):
         """Post initialization hook"""
-        bot_info = await application.bot.get_me()
-        self.bot_username = bot_info.username
+        await self.openrouter_client.start()
+        # Application.initialize() already fetched the bot's user with getMe
+        self.bot_username = application.bot.username
         logger.info(f"Bot started: @{self.bot_username}")
 
-    def run(self):
-        """Run the bot"""
-        # Start keep-alive thread
-        keep_alive = threading.Thread(target=keep_alive_thread, daemon=True)
-        keep_alive.start()
-        logger.info("Keep-alive thread started")
+        if self.http_server is not None and not self.http_server.running:
+            # Polling mode: the HTTP server only serves probes and metrics,
+            # so the bot keeps working without it
+            try:
+                await self.http_server.start()
+                self.http_server.set_ready(True)
+            except OSError as e:
+                logger.warning(f"Cannot serve /health and /metrics on port {self.config.port}: {e}")
+
+        self.maintenance.start()
+        # Non-critical initialization finishes while updates are already served
+        self._warmup_task = asyncio.create_task(self._warm_up())
 
-        # Build application
-        application = Application.builder().token(self.config.telegram_bot_token).post_init(self.post_init).build()
+    async def _warm_up(self):
+        """Restore token quotas and load the NumPy retrieval backend in the background"""
+        started = time.perf_counter()
+        if self.rate_limiter is not None and not self.rate_limiter.restored:
+            try:
+                rows = await asyncio.to_thread(self.rate_limiter.storage.load_quotas)
+            except Exception as e:
+                logger.error(f"Error loading token quotas: {e}")
+                rows = []
+            self.rate_limiter.restore(rows)
+        if self.vector_index is not None:
+            from vector_index import load_numpy
+            await asyncio.to_thread(load_numpy)
+        logger.info(f"Background initialization finished in {time.perf_counter() - started:.2f}s")
+
+    async def post_shutdown(self, application: Application):
+        """Post shutdown hook"""
+        if self._warmup_task is not None and not self._warmup_task.done():
+            await self._warmup_task
+        await self.maintenance.shutdown()
+        await self.chat_scheduler.shutdown()
+        if self.summarizer is not None:
+            await self.summarizer.shutdown()
+        await self.openrouter_client.close()
+        if self.rate_limiter is not None:
+            self.rate_limiter.save()
+        await self.message_memory.close()
+        if self.http_server is not None and self.config.bot_mode == 'polling':
+            await self.http_server.stop()
+
+    def build_application(self, with_updater: bool = True) -> Application:
+        """Build the Telegram application with all handlers registered"""
+        builder = (
+            Application.builder()
+            .token(self.config.telegram_bot_token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
+        if self.config.telegram_api_base_url:
+            builder = builder.base_url(self.config.telegram_api_base_url.rstrip('/') + '/bot')
+        if not with_updater:
+            # Updates are pushed to update_queue by our own webhook server
+            builder = builder.updater(None)
+        application = builder.build()
 
         # Add handlers
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("clear_memory", self.clear_memory_command))
+        application.add_handler(CommandHandler("triggers", self.triggers_command))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         
         # Add error handler
         application.add_error_handler(self.error_handler)
+        return application
+
+    def run(self):
+        """Run the bot"""
+        if self.config.bot_mode == 'webhook':
+            asyncio.run(self.run_webhook())
+            return
+
+        # Polling mode serves /health, /ready and /metrics without the webhook route
+        self.http_server = WebhookServer(None, port=self.config.port, webhook_path=None)
+        application = self.build_application()
 
         # Run the bot
         logger.info("Starting bot...")
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+    async def run_webhook(self):
+        """Run the bot in webhook mode on a single asyncio HTTP server"""
+        application = self.build_application(with_updater=False)
+        server = self.http_server = WebhookServer(
+            application,
+            port=self.config.port,
+            webhook_path=self.config.webhook_path,
+            secret_token=self.config.webhook_secret
+        )
+
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        # Serve /health right away; /ready flips once updates can be processed
+        await server.start()
+        try:
+            await self.start_application(application)
+            # Updates can be processed now; Telegram delivers them once the webhook is set
+            server.set_ready(True)
+
+            await application.bot.set_webhook(
+                url=self.config.webhook_url.rstrip('/') + self.config.webhook_path,
+                secret_token=self.config.webhook_secret,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Bot started in webhook mode")
+
+            await stop_event.wait()
+        finally:
+            logger.info("Shutting down webhook mode...")
+            server.set_ready(False)
+            await self.stop_application(application)
+            await server.stop()
+
+    async def start_application(self, application: Application):
+        """Initialize and start an application fed through update_queue"""
+        await application.initialize()
+        await self.post_init(application)
+        await application.start()
+
+    async def stop_application(self, application: Application):
+        """Stop and shut down an application started with start_application"""
+        if application.running:
+            await application.stop()
+        await self.post_shutdown(application)
+        await application.shutdown()
+
+def configure_logging():
+    """Configure logging of a bot process"""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
 if __name__ == '__main__':
-    bot = TelegramBot()
-    bot.run()
+    configure_logging()
+    config = BotConfig()
+    if config.workers > 1:
+        # Ingest process: shard updates by chat across worker processes
+        from cluster import run_cluster
+        run_cluster(config)
+    else:
+        bot = TelegramBot(config)
+        bot.run()
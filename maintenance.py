@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Periodic background tasks scheduled on the bot's event loop
+"""
+
+import asyncio
+import inspect
+import logging
+import random
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TASK_SECONDS = metrics.REGISTRY.histogram(
+    'bratik_maintenance_task_seconds', 'Duration of maintenance task runs', ('task',))
+TASK_RUNS = metrics.REGISTRY.counter(
+    'bratik_maintenance_runs_total', 'Maintenance task runs by outcome', ('task', 'outcome'))
+
+class PeriodicTask:
+    """A function run every interval seconds.
+
+    func may be a coroutine function or a plain function; plain functions
+    run on the event loop unless in_thread is set, for blocking I/O.
+    """
+
+    def __init__(self, name: str, func: Callable[[], Any], interval: float, jitter: float = 0.1,
+                 timeout: Optional[float] = None, in_thread: bool = False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.in_thread = in_thread
+        self.stats = {'runs': 0, 'errors': 0, 'timeouts': 0, 'skipped': 0, 'last_duration': 0.0}
+
+    async def run_once(self):
+        """Run the task once, applying the timeout"""
+        if inspect.iscoroutinefunction(self.func):
+            call = self.func()
+        elif self.in_thread:
+            call = asyncio.to_thread(self.func)
+        else:
+            call = None
+
+        if call is None:
+            self.func()
+        elif self.timeout is not None:
+            await asyncio.wait_for(call, self.timeout)
+        else:
+            await call
+
+class MaintenanceScheduler:
+    """Runs periodic tasks on the event loop without extra threads.
+
+    Each task has its own runner coroutine. Start times are jittered so
+    tasks with equal intervals do not fire together. A run that takes
+    longer than its interval makes the runner skip the missed slots
+    instead of starting runs back to back, and one task failing or timing
+    out never affects the others.
+    """
+
+    def __init__(self, jitter: float = 0.1):
+        self.jitter = jitter
+        self._tasks: List[PeriodicTask] = []
+        self._runners: List[asyncio.Task] = []
+
+    def add(self, name: str, func: Callable[[], Any], interval: float, timeout: Optional[float] = None,
+            in_thread: bool = False) -> Optional[PeriodicTask]:
+        """Register a periodic task; a non-positive interval disables it"""
+        if interval <= 0:
+            logger.info(f"Maintenance task {name} disabled")
+            return None
+        task = PeriodicTask(name, func, interval, self.jitter, timeout, in_thread)
+        self._tasks.append(task)
+        if self._runners:
+            self._runners.append(asyncio.create_task(self._run(task), name=f"maintenance-{name}"))
+        return task
+
+    def start(self):
+        """Start running all registered tasks on the current event loop"""
+        if self._runners:
+            return
+        self._runners = [asyncio.create_task(self._run(task), name=f"maintenance-{task.name}")
+                         for task in self._tasks]
+        logger.info(f"Maintenance scheduler started with {len(self._tasks)} tasks")
+
+    async def _run(self, task: PeriodicTask):
+        """Run a task at its interval until cancelled"""
+        loop = asyncio.get_running_loop()
+        # Random phase so tasks registered together spread out
+        next_run = loop.time() + task.interval * random.uniform(task.jitter, 1.0)
+
+        while True:
+            jitter = task.interval * task.jitter * random.uniform(-1.0, 1.0)
+            await asyncio.sleep(max(next_run + jitter - loop.time(), 0.0))
+
+            started = loop.time()
+            outcome = 'ok'
+            try:
+                await task.run_once()
+            except asyncio.TimeoutError:
+                outcome = 'timeout'
+                task.stats['timeouts'] += 1
+                logger.warning(f"Maintenance task {task.name} timed out after {task.timeout}s")
+            except Exception as e:
+                outcome = 'error'
+                task.stats['errors'] += 1
+                logger.error(f"Maintenance task {task.name} failed: {e}")
+
+            duration = loop.time() - started
+            task.stats['runs'] += 1
+            task.stats['last_duration'] = duration
+            TASK_SECONDS.observe(duration, task=task.name)
+            TASK_RUNS.inc(task=task.name, outcome=outcome)
+
+            # Overrun protection: skip slots that passed while the task ran
+            next_run += task.interval
+            now = loop.time()
+            if next_run <= now:
+                missed = int((now - next_run) // task.interval) + 1
+                next_run += missed * task.interval
+                task.stats['skipped'] += missed
+                TASK_RUNS.inc(missed, task=task.name, outcome='skipped')
+                logger.warning(f"Maintenance task {task.name} overran its interval, skipped {missed} runs")
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get run statistics per task"""
+        return {task.name: dict(task.stats) for task in self._tasks}
+
+    async def shutdown(self):
+        """Cancel all task runners and wait for them to stop"""
+        runners = self._runners
+        self._runners = []
+        for runner in runners:
+            runner.cancel()
+        if runners:
+            await asyncio.gather(*runners, return_exceptions=True)
+        logger.info("Maintenance scheduler stopped")
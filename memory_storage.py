@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent storage backends for message memory
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from typing import Any, Iterable, List, Optional, Tuple
+
+from message_record import MessageRecord, to_epoch
+
+logger = logging.getLogger(__name__)
+
+# Write operations queued by MessageMemory: (operation, chat_id, message_data)
+# where operation is 'add', 'clear' or 'summary' and data is a MessageRecord,
+# None or a (summary, summarized_seq) tuple respectively
+WriteOperation = Tuple[str, int, Any]
+
+# Rolling token quota: (scope, entity_id, hour, hourly_slots) where scope is 'user' or 'chat'
+QuotaRow = Tuple[str, int, int, List[int]]
+
+def merge_quota_slots(hour: int, slots: List[int], other_hour: int, other_slots: List[int]) -> Tuple[int, List[int]]:
+    """Add two rolling quotas, returning the later hour and the summed slots.
+
+    Slot i of a quota last updated at hour h holds the latest hour <= h
+    that is i modulo the slot count; slots that fell out of the window
+    ending at the later hour are dropped.
+    """
+    size = len(slots)
+    merged_hour = max(hour, other_hour)
+    merged = [0] * size
+    for last_hour, hourly in ((hour, slots), (other_hour, other_slots)):
+        for index, tokens in enumerate(hourly[:size]):
+            if last_hour - (last_hour - index) % size > merged_hour - size:
+                merged[index] += tokens
+    return merged_hour, merged
+
+class MemoryStorage:
+    """Base class for message memory storage backends"""
+
+    def load_chat(self, chat_id: int, limit: int) -> List[MessageRecord]:
+        """Load the most recent messages of a chat, oldest first"""
+        raise NotImplementedError
+
+    def load_summary(self, chat_id: int) -> Optional[Tuple[str, int]]:
+        """Load the rolling summary of a chat and the seq it covers"""
+        raise NotImplementedError
+
+    def write_batch(self, operations: Iterable[WriteOperation], keep_per_chat: int):
+        """Apply a batch of write operations atomically"""
+        raise NotImplementedError
+
+    def load_quotas(self) -> List[QuotaRow]:
+        """Load saved token quotas"""
+        return []
+
+    def save_quotas(self, rows: Iterable[QuotaRow], expired_before_hour: int) -> List[QuotaRow]:
+        """Add usage deltas to the saved quotas and drop quotas last used before expired_before_hour.
+
+        Returns the saved totals of the quotas in rows.
+        """
+        return list(rows)
+
+    def load_chat_triggers(self, chat_id: int) -> Optional[List[str]]:
+        """Load a chat's custom trigger words, or None if it uses the defaults"""
+        return None
+
+    def save_chat_triggers(self, chat_id: int, words: Optional[List[str]]):
+        """Save a chat's custom trigger words; None returns it to the defaults"""
+
+    def close(self):
+        """Release storage resources"""
+
+class SQLiteStorage(MemoryStorage):
+    """SQLite storage in WAL mode.
+
+    Uses separate connections for reads and writes so lazy chat loads on the
+    bot's thread are not blocked by a background batch commit.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._write_conn = self._connect()
+        self._read_conn = self._connect()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+        with self._write_lock:
+            self._write_conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    username TEXT,
+                    text TEXT NOT NULL,
+                    timestamp INTEGER,
+                    message_id INTEGER,
+                    is_bot INTEGER NOT NULL DEFAULT 0,
+                    seq INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, id);
+                CREATE TABLE IF NOT EXISTS summaries (
+                    chat_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    summarized_seq INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS token_quotas (
+                    scope TEXT NOT NULL,
+                    entity_id INTEGER NOT NULL,
+                    hour INTEGER NOT NULL,
+                    slots TEXT NOT NULL,
+                    PRIMARY KEY (scope, entity_id)
+                );
+                CREATE TABLE IF NOT EXISTS chat_triggers (
+                    chat_id INTEGER PRIMARY KEY,
+                    words TEXT NOT NULL
+                );
+            """)
+            columns = {row[1] for row in self._write_conn.execute("PRAGMA table_info(messages)")}
+            if 'seq' not in columns:
+                self._write_conn.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+            self._write_conn.commit()
+
+        logger.info(f"SQLiteStorage opened at {db_path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection configured for WAL mode"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is crash-safe in WAL mode; only the last commits may be lost on power failure
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def load_chat(self, chat_id: int, limit: int) -> List[MessageRecord]:
+        """Load the most recent messages of a chat, oldest first"""
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                "SELECT user_id, username, text, timestamp, message_id, is_bot, seq FROM messages "
+                "WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, limit)
+            ).fetchall()
+
+        records = []
+        for index, (user_id, username, text, timestamp, message_id, is_bot, seq) in enumerate(reversed(rows)):
+            record = MessageRecord(user_id, username, text, to_epoch(timestamp), message_id, bool(is_bot))
+            # Rows written before sequence numbers existed fall back to their position
+            record.seq = seq if seq is not None else index
+            records.append(record)
+        return records
+
+    def load_summary(self, chat_id: int) -> Optional[Tuple[str, int]]:
+        """Load the rolling summary of a chat and the seq it covers"""
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT summary, summarized_seq FROM summaries WHERE chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+
+        return (row[0], row[1]) if row else None
+
+    def write_batch(self, operations: Iterable[WriteOperation], keep_per_chat: int):
+        """Apply a batch of write operations in a single transaction"""
+        touched_chats = set()
+
+        with self._write_lock:
+            with self._write_conn:
+                for operation, chat_id, data in operations:
+                    if operation == 'add':
+                        self._write_conn.execute(
+                            "INSERT INTO messages (chat_id, user_id, username, text, timestamp, message_id, is_bot, seq) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (chat_id, data.user_id, data.username, data.text,
+                             data.timestamp, data.message_id, int(data.is_bot), data.seq)
+                        )
+                        touched_chats.add(chat_id)
+                    elif operation == 'clear':
+                        self._write_conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                        self._write_conn.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+                        touched_chats.discard(chat_id)
+                    elif operation == 'summary':
+                        summary, summarized_seq = data
+                        self._write_conn.execute(
+                            "INSERT OR REPLACE INTO summaries (chat_id, summary, summarized_seq) VALUES (?, ?, ?)",
+                            (chat_id, summary, summarized_seq)
+                        )
+
+                # Trim chats back to the per-chat limit
+                for chat_id in touched_chats:
+                    self._write_conn.execute(
+                        "DELETE FROM messages WHERE chat_id = ? AND id <= ("
+                        "SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (chat_id, chat_id, keep_per_chat)
+                    )
+
+    def load_quotas(self) -> List[QuotaRow]:
+        """Load saved token quotas"""
+        with self._read_lock:
+            rows = self._read_conn.execute("SELECT scope, entity_id, hour, slots FROM token_quotas").fetchall()
+        return [(scope, entity_id, hour, json.loads(slots)) for scope, entity_id, hour, slots in rows]
+
+    def save_quotas(self, rows: Iterable[QuotaRow], expired_before_hour: int) -> List[QuotaRow]:
+        """Add usage deltas to the saved quotas and drop expired ones in a single transaction.
+
+        Rows hold the usage recorded since the last save, not totals (all
+        zero to just read a total back), and are added slot-wise to what is
+        stored, so worker processes sharing the database sum their usage
+        instead of overwriting each other's. The write transaction is taken
+        up front (BEGIN IMMEDIATE) so no other process can write between the
+        read and the update. Returns the saved totals of the quotas in rows.
+        """
+        merged = []
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM token_quotas WHERE hour < ?", (expired_before_hour,))
+                for scope, entity_id, hour, slots in rows:
+                    saved = conn.execute(
+                        "SELECT hour, slots FROM token_quotas WHERE scope = ? AND entity_id = ?",
+                        (scope, entity_id)
+                    ).fetchone()
+                    if saved is not None:
+                        hour, slots = merge_quota_slots(saved[0], json.loads(saved[1]), hour, slots)
+                    elif not any(slots):
+                        continue
+                    conn.execute(
+                        "INSERT OR REPLACE INTO token_quotas (scope, entity_id, hour, slots) VALUES (?, ?, ?, ?)",
+                        (scope, entity_id, hour, json.dumps(slots))
+                    )
+                    merged.append((scope, entity_id, hour, slots))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return merged
+
+    def load_chat_triggers(self, chat_id: int) -> Optional[List[str]]:
+        """Load a chat's custom trigger words, or None if it uses the defaults"""
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT words FROM chat_triggers WHERE chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_chat_triggers(self, chat_id: int, words: Optional[List[str]]):
+        """Save a chat's custom trigger words; None returns it to the defaults"""
+        with self._write_lock:
+            with self._write_conn:
+                if words is None:
+                    self._write_conn.execute("DELETE FROM chat_triggers WHERE chat_id = ?", (chat_id,))
+                else:
+                    self._write_conn.execute(
+                        "INSERT OR REPLACE INTO chat_triggers (chat_id, words) VALUES (?, ?)",
+                        (chat_id, json.dumps(words, ensure_ascii=False))
+                    )
+
+    def close(self):
+        """Close database connections"""
+        with self._write_lock:
+            self._write_conn.close()
+        with self._read_lock:
+            self._read_conn.close()
+        logger.info("SQLiteStorage closed")
@@ -4,110 +4,412 @@
 Message memory management for maintaining chat context
 """
 
+import asyncio
 import logging
-from collections import deque, defaultdict
-from typing import Dict, List, Any
-import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+from message_record import HistoryView, MessageRecord, RingBuffer
+
+if TYPE_CHECKING:
+    # Only for annotations: storage and retrieval are optional and loaded by their users
+    from memory_storage import MemoryStorage
+    from vector_index import VectorIndex
 
 logger = logging.getLogger(__name__)
 
+class ChatState:
+    """Messages and rolling summary of one chat held in memory"""
+
+    __slots__ = ('messages', 'summary', 'last_access')
+
+    def __init__(self, messages: RingBuffer, summary: Optional[Tuple[str, int]] = None):
+        self.messages = messages
+        # (summary text, seq of last summarized message)
+        self.summary = summary
+        self.last_access = time.monotonic()
+
 class MessageMemory:
-    def __init__(self, max_messages_per_chat: int = 200):
+    """Per-chat message history with write-behind persistence.
+
+    Owned by one event loop and never blocks it. Every chat is its own
+    ChatState, so a chat already in memory is served without locks or
+    awaits; only a cold chat awaits its load from storage, and concurrent
+    requests for the same chat share that load. Totals are kept up to date
+    on every change, so statistics are O(1). Use ThreadSafeMessageMemory to
+    access the memory from another thread.
+    """
+
+    def __init__(self, max_messages_per_chat: int = 200, storage: Optional['MemoryStorage'] = None,
+                 max_cached_chats: int = 1000, idle_ttl: Optional[float] = None,
+                 max_total_messages: Optional[int] = None, eviction_batch_size: int = 100,
+                 index: Optional['VectorIndex'] = None):
         self.max_messages_per_chat = max_messages_per_chat
-        self._chat_memories = defaultdict(lambda: deque(maxlen=self.max_messages_per_chat))
-        self._lock = threading.Lock()
-        
+        self.storage = storage
+        self.max_cached_chats = max_cached_chats
+        self.idle_ttl = idle_ttl
+        self.max_total_messages = max_total_messages
+        self.eviction_batch_size = eviction_batch_size
+        # Retrieval index kept in step with the chats held in memory
+        self.index = index
+
+        # Chats in least-recently-used order, so eviction candidates are
+        # always at the front. With a storage backend evicted chats are
+        # loaded back lazily on next access; without one they are dropped.
+        self._chats: "OrderedDict[int, ChatState]" = OrderedDict()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._total_messages = 0
+        self._eviction_stats = {
+            'evicted_idle': 0,
+            'evicted_capacity': 0,
+            'evicted_messages': 0,
+            'eviction_runs': 0
+        }
+
+        # Write-behind buffer of (operation, chat_id, message_data) tuples,
+        # written by flush() which the owner calls periodically
+        self._pending_writes: List[tuple] = []
+        # Storage reads and writes take turns, so a cold load sees every
+        # message either in the database or in the pending buffer
+        self._io_lock = asyncio.Lock()
+
         logger.info(f"MessageMemory initialized with max {max_messages_per_chat} messages per chat")
-    
-    def add_message(self, chat_id: int, message_data: Dict[str, Any]):
+
+    async def _get_chat(self, chat_id: int) -> ChatState:
+        """Get the state of a chat, loading it from storage on first access"""
+        state = self._chats.get(chat_id)
+        if state is not None:
+            self._chats.move_to_end(chat_id)
+            state.last_access = time.monotonic()
+            return state
+
+        if self.storage is None:
+            state = ChatState(RingBuffer(self.max_messages_per_chat))
+            self._insert_chat(chat_id, state)
+            return state
+
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.ensure_future(self._load_chat(chat_id))
+        # A cancelled caller must not cancel the load other callers wait for
+        return await asyncio.shield(loading)
+
+    async def _load_chat(self, chat_id: int) -> ChatState:
+        """Load a cold chat from storage and apply writes not flushed yet"""
+        try:
+            async with self._io_lock:
+                messages, summary = await asyncio.to_thread(self._read_chat, chat_id)
+
+                state = ChatState(RingBuffer(self.max_messages_per_chat, messages), summary)
+                for operation, op_chat_id, data in self._pending_writes:
+                    if op_chat_id != chat_id:
+                        continue
+                    if operation == 'clear':
+                        state.messages.clear()
+                        state.summary = None
+                    elif operation == 'summary':
+                        state.summary = data
+                    else:
+                        state.messages.append(data)
+
+                self._insert_chat(chat_id, state)
+                logger.debug(f"Loaded {len(state.messages)} messages for chat {chat_id} from storage")
+                return state
+        finally:
+            del self._loading[chat_id]
+
+    def _read_chat(self, chat_id: int) -> Tuple[List[MessageRecord], Optional[Tuple[str, int]]]:
+        """Read a chat's messages and summary from storage (runs in a worker thread)"""
+        return self.storage.load_chat(chat_id, self.max_messages_per_chat), self.storage.load_summary(chat_id)
+
+    def _insert_chat(self, chat_id: int, state: ChatState):
+        """Add a chat as most recently used, evicting over the chat cap"""
+        self._chats[chat_id] = state
+        self._total_messages += len(state.messages)
+
+        # Insertions can only overshoot the chat cap by one, so this stays O(1)
+        while len(self._chats) > self.max_cached_chats:
+            self._evict_oldest('evicted_capacity')
+
+    def _evict_oldest(self, reason: str):
+        """Evict the least recently used chat"""
+        chat_id, state = self._chats.popitem(last=False)
+        if self.index is not None:
+            self.index.drop(chat_id)
+        self._total_messages -= len(state.messages)
+        self._eviction_stats[reason] += 1
+        self._eviction_stats['evicted_messages'] += len(state.messages)
+
+    async def add_message(self, chat_id: int, message_data: Union[MessageRecord, Dict[str, Any]]):
         """Add a message to chat memory"""
         try:
-            with self._lock:
-                self._chat_memories[chat_id].append(message_data)
-                
-            logger.debug(f"Added message to chat {chat_id}, total messages: {len(self._chat_memories[chat_id])}")
-            
+            if not isinstance(message_data, MessageRecord):
+                message_data = MessageRecord.from_dict(message_data)
+
+            state = await self._get_chat(chat_id)
+            chat = state.messages
+
+            # Per-chat sequence numbers let summaries mark what they cover
+            newest = chat.last()
+            message_data.seq = newest.seq + 1 if newest is not None else 0
+
+            # A cold chat can be evicted again before its loader resumes
+            if chat.append(message_data) is None and self._chats.get(chat_id) is state:
+                self._total_messages += 1
+            if self.storage is not None:
+                self._pending_writes.append(('add', chat_id, message_data))
+            if self.index is not None:
+                self.index.add(chat_id, message_data)
+
+            logger.debug(f"Added message to chat {chat_id}, total messages: {len(chat)}")
+
         except Exception as e:
             logger.error(f"Error adding message to memory: {e}")
-    
-    def get_chat_messages(self, chat_id: int) -> List[Dict[str, Any]]:
-        """Get all messages for a specific chat"""
+
+    async def get_chat_messages(self, chat_id: int) -> HistoryView:
+        """Get a view of all messages for a specific chat"""
         try:
-            with self._lock:
-                messages = list(self._chat_memories[chat_id])
-            
+            state = await self._get_chat(chat_id)
+            messages = state.messages.view()
+
             logger.debug(f"Retrieved {len(messages)} messages for chat {chat_id}")
             return messages
-            
+
         except Exception as e:
             logger.error(f"Error retrieving messages for chat {chat_id}: {e}")
-            return []
-    
-    def get_recent_messages(self, chat_id: int, count: int = 10) -> List[Dict[str, Any]]:
-        """Get recent messages for a specific chat"""
+            return RingBuffer(0).view()
+
+    async def get_recent_messages(self, chat_id: int, count: int = 10) -> HistoryView:
+        """Get a view of recent messages for a specific chat"""
         try:
-            with self._lock:
-                messages = list(self._chat_memories[chat_id])
-            
-            recent = messages[-count:] if len(messages) > count else messages
+            state = await self._get_chat(chat_id)
+            recent = state.messages.view(count)
+
             logger.debug(f"Retrieved {len(recent)} recent messages for chat {chat_id}")
             return recent
-            
+
         except Exception as e:
             logger.error(f"Error retrieving recent messages for chat {chat_id}: {e}")
-            return []
-    
-    def clear_chat_memory(self, chat_id: int):
+            return RingBuffer(0).view()
+
+    async def clear_chat_memory(self, chat_id: int):
         """Clear all messages for a specific chat"""
         try:
-            with self._lock:
-                if chat_id in self._chat_memories:
-                    self._chat_memories[chat_id].clear()
-            
+            state = self._chats.get(chat_id)
+            if state is not None:
+                self._total_messages -= len(state.messages)
+                state.messages.clear()
+                state.summary = None
+            if self.index is not None:
+                self.index.drop(chat_id)
+            # A chat being loaded applies this when the load finishes
+            if self.storage is not None:
+                self._pending_writes.append(('clear', chat_id, None))
+
             logger.info(f"Cleared memory for chat {chat_id}")
-            
+
         except Exception as e:
             logger.error(f"Error clearing memory for chat {chat_id}: {e}")
-    
-    def get_memory_stats(self) -> Dict[str, Any]:
-        """Get memory usage statistics"""
+
+    async def get_summary(self, chat_id: int) -> Tuple[Optional[str], int]:
+        """Get the rolling summary of a chat and the seq of the last message it covers"""
+        try:
+            state = await self._get_chat(chat_id)
+            return state.summary or (None, -1)
+
+        except Exception as e:
+            logger.error(f"Error retrieving summary for chat {chat_id}: {e}")
+            return None, -1
+
+    async def set_summary(self, chat_id: int, summary: str, summarized_seq: int, expected_seq: int) -> bool:
+        """Store a new rolling summary for a chat.
+
+        The update only applies if the chat's summary still covers
+        expected_seq, so a summary computed before a concurrent clear or
+        another summary update is discarded. Returns whether it was stored.
+        """
+        try:
+            state = self._chats.get(chat_id)
+            if state is None:
+                return False
+
+            newest = state.messages.last()
+            current_seq = (state.summary or (None, -1))[1]
+            if current_seq != expected_seq or newest is None or newest.seq < summarized_seq:
+                return False
+
+            state.summary = (summary, summarized_seq)
+            if self.storage is not None:
+                self._pending_writes.append(('summary', chat_id, state.summary))
+
+            logger.info(f"Updated summary for chat {chat_id} up to message seq {summarized_seq}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error storing summary for chat {chat_id}: {e}")
+            return False
+
+    def get_memory_stats(self, include_chat_details: bool = False) -> Dict[str, Any]:
+        """Get memory usage statistics.
+
+        Totals are O(1); per-chat message counts walk every chat, so they
+        are only included on request.
+        """
         try:
-            with self._lock:
-                stats = {
-                    'total_chats': len(self._chat_memories),
-                    'total_messages': sum(len(messages) for messages in self._chat_memories.values()),
-                    'chat_details': {
-                        chat_id: len(messages) 
-                        for chat_id, messages in self._chat_memories.items()
-                    }
-                }
-            
+            stats = {
+                'total_chats': len(self._chats),
+                'total_messages': self._total_messages,
+                'loading_chats': len(self._loading),
+                'pending_writes': len(self._pending_writes),
+                'eviction': dict(self._eviction_stats)
+            }
+            if include_chat_details:
+                stats['chat_details'] = {chat_id: len(state.messages) for chat_id, state in self._chats.items()}
+
             logger.debug(f"Memory stats: {stats['total_chats']} chats, {stats['total_messages']} total messages")
             return stats
-            
+
         except Exception as e:
             logger.error(f"Error getting memory stats: {e}")
-            return {'total_chats': 0, 'total_messages': 0, 'chat_details': {}}
-    
+            return {'total_chats': 0, 'total_messages': 0, 'loading_chats': 0, 'pending_writes': 0, 'eviction': {}}
+
     def cleanup_old_chats(self, keep_recent_chats: int = 100):
-        """Remove memory for oldest chats if too many chats are stored"""
+        """Remove memory for least recently used chats if too many chats are stored"""
         try:
-            with self._lock:
-                if len(self._chat_memories) > keep_recent_chats:
-                    # Sort by number of messages (keep more active chats)
-                    sorted_chats = sorted(
-                        self._chat_memories.items(),
-                        key=lambda x: len(x[1]),
-                        reverse=True
-                    )
-                    
-                    # Keep only the most active chats
-                    chats_to_remove = sorted_chats[keep_recent_chats:]
-                    
-                    for chat_id, _ in chats_to_remove:
-                        del self._chat_memories[chat_id]
-                    
-                    logger.info(f"Cleaned up {len(chats_to_remove)} old chats")
-            
+            excess = len(self._chats) - keep_recent_chats
+            for _ in range(max(excess, 0)):
+                self._evict_oldest('evicted_capacity')
+
+            if excess > 0:
+                logger.info(f"Cleaned up {excess} old chats")
+
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
+
+    def evict(self, max_chats: Optional[int] = None) -> int:
+        """Evict idle chats and chats over the global message cap.
+
+        Works from the least recently used end and stops after max_chats
+        evictions (eviction_batch_size by default), so a single call never
+        holds the event loop for long; the maintenance scheduler calls it
+        repeatedly.
+        """
+        budget = self.eviction_batch_size if max_chats is None else max_chats
+        evicted = 0
+
+        try:
+            self._eviction_stats['eviction_runs'] += 1
+            now = time.monotonic()
+
+            while evicted < budget and self._chats:
+                oldest = next(iter(self._chats.values()))
+
+                if self.idle_ttl is not None and now - oldest.last_access > self.idle_ttl:
+                    self._evict_oldest('evicted_idle')
+                elif self.max_total_messages is not None and self._total_messages > self.max_total_messages:
+                    self._evict_oldest('evicted_capacity')
+                else:
+                    break
+
+                evicted += 1
+
+            if evicted:
+                logger.info(f"Evicted {evicted} chats from memory")
+
+        except Exception as e:
+            logger.error(f"Error during eviction: {e}")
+
+        return evicted
+
+    async def flush(self):
+        """Write pending operations to storage in a single batch, off the event loop"""
+        if self.storage is None:
+            return
+
+        async with self._io_lock:
+            batch = self._pending_writes
+            if not batch:
+                return
+            self._pending_writes = []
+
+            try:
+                await asyncio.to_thread(self.storage.write_batch, batch, self.max_messages_per_chat)
+                logger.debug(f"Flushed {len(batch)} memory operations to storage")
+            except Exception as e:
+                logger.error(f"Error flushing memory to storage: {e}")
+                # Put the batch back in front so nothing is lost or reordered
+                self._pending_writes[:0] = batch
+
+    async def close(self):
+        """Flush pending writes and close the storage backend"""
+        if self.storage is None:
+            return
+
+        await self.flush()
+        await asyncio.to_thread(self.storage.close)
+        logger.info("MessageMemory closed")
+
+class ThreadSafeMessageMemory:
+    """Blocking access to a MessageMemory from threads other than its event loop.
+
+    Each call runs on the memory's loop through run_coroutine_threadsafe,
+    so the memory itself stays single-threaded. Histories are returned as
+    lists, since views must not be read off the loop. Calling it from the
+    loop's own thread would deadlock.
+    """
+
+    def __init__(self, memory: MessageMemory, loop: asyncio.AbstractEventLoop, timeout: float = 30.0):
+        self.memory = memory
+        self.loop = loop
+        self.timeout = timeout
+
+    def _call(self, coroutine) -> Any:
+        """Run a coroutine on the memory's loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(self.timeout)
+
+    @staticmethod
+    async def _as_list(coroutine) -> List[MessageRecord]:
+        """Copy a history view while still on the loop"""
+        return list(await coroutine)
+
+    @staticmethod
+    async def _run(function, *args) -> Any:
+        """Run a synchronous memory method on the loop"""
+        return function(*args)
+
+    def add_message(self, chat_id: int, message_data: Union[MessageRecord, Dict[str, Any]]):
+        """Add a message to chat memory"""
+        self._call(self.memory.add_message(chat_id, message_data))
+
+    def get_chat_messages(self, chat_id: int) -> List[MessageRecord]:
+        """Get a copy of all messages for a specific chat"""
+        return self._call(self._as_list(self.memory.get_chat_messages(chat_id)))
+
+    def get_recent_messages(self, chat_id: int, count: int = 10) -> List[MessageRecord]:
+        """Get a copy of recent messages for a specific chat"""
+        return self._call(self._as_list(self.memory.get_recent_messages(chat_id, count)))
+
+    def clear_chat_memory(self, chat_id: int):
+        """Clear all messages for a specific chat"""
+        self._call(self.memory.clear_chat_memory(chat_id))
+
+    def get_summary(self, chat_id: int) -> Tuple[Optional[str], int]:
+        """Get the rolling summary of a chat and the seq of the last message it covers"""
+        return self._call(self.memory.get_summary(chat_id))
+
+    def set_summary(self, chat_id: int, summary: str, summarized_seq: int, expected_seq: int) -> bool:
+        """Store a new rolling summary for a chat"""
+        return self._call(self.memory.set_summary(chat_id, summary, summarized_seq, expected_seq))
+
+    def get_memory_stats(self, include_chat_details: bool = False) -> Dict[str, Any]:
+        """Get memory usage statistics"""
+        return self._call(self._run(self.memory.get_memory_stats, include_chat_details))
+
+    def evict(self, max_chats: Optional[int] = None) -> int:
+        """Evict idle chats and chats over the global message cap"""
+        return self._call(self._run(self.memory.evict, max_chats))
+
+    def flush(self):
+        """Write pending operations to storage"""
+        self._call(self.memory.flush())
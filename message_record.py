@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact message records and per-chat ring buffers for message memory
+"""
+
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+class MessageRecord:
+    """A single stored chat message.
+
+    Uses __slots__ and an integer epoch timestamp instead of a dict with an
+    ISO string, which keeps thousands of chats x 200 messages small.
+    Usernames are interned since the same few names repeat in every chat.
+    token_count caches the prompt token estimate and is -1 until computed;
+    seq is the per-chat sequence number assigned by MessageMemory.
+    """
+
+    __slots__ = ('user_id', 'username', 'text', 'timestamp', 'message_id', 'is_bot', 'token_count', 'seq')
+
+    def __init__(self, user_id: Optional[int], username: Optional[str], text: str,
+                 timestamp: int = 0, message_id: Optional[int] = None, is_bot: bool = False):
+        self.user_id = user_id
+        self.username = sys.intern(username) if username else username
+        self.text = text
+        self.timestamp = timestamp
+        self.message_id = message_id
+        self.is_bot = is_bot
+        self.token_count = -1
+        self.seq = -1
+
+    @classmethod
+    def from_dict(cls, message_data: Dict[str, Any]) -> "MessageRecord":
+        """Build a record from the legacy dict representation"""
+        return cls(
+            user_id=message_data.get('user_id'),
+            username=message_data.get('username'),
+            text=message_data['text'],
+            timestamp=to_epoch(message_data.get('timestamp')),
+            message_id=message_data.get('message_id'),
+            is_bot=bool(message_data.get('is_bot'))
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the record to a plain dict"""
+        return {
+            'user_id': self.user_id,
+            'username': self.username,
+            'text': self.text,
+            'timestamp': self.timestamp,
+            'message_id': self.message_id,
+            'is_bot': self.is_bot
+        }
+
+    def __repr__(self) -> str:
+        return f"MessageRecord(user_id={self.user_id!r}, username={self.username!r}, message_id={self.message_id!r})"
+
+def to_epoch(timestamp: Union[int, float, str, datetime, None]) -> int:
+    """Convert a timestamp in any supported form to integer epoch seconds"""
+    if timestamp is None:
+        return 0
+    if isinstance(timestamp, datetime):
+        return int(timestamp.timestamp())
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    if timestamp.isdigit():
+        return int(timestamp)
+    return int(datetime.fromisoformat(timestamp).timestamp())
+
+class RingBuffer:
+    """Fixed-capacity message buffer that overwrites the oldest entry.
+
+    The backing list grows lazily up to capacity, so quiet chats do not pay
+    for 200 empty slots. Positions are addressed by an absolute append index,
+    which lets HistoryView detect entries that were overwritten.
+    """
+
+    __slots__ = ('capacity', '_items', '_appended', '_generation')
+
+    def __init__(self, capacity: int, items=()):
+        self.capacity = capacity
+        self._items: List[Any] = []
+        self._appended = 0
+        self._generation = 0
+
+        for item in items:
+            self.append(item)
+
+    def append(self, item: Any) -> Any:
+        """Append an item, returning the overwritten oldest item when full"""
+        overwritten = None
+        if len(self._items) < self.capacity:
+            self._items.append(item)
+        else:
+            position = self._appended % self.capacity
+            overwritten = self._items[position]
+            self._items[position] = item
+        self._appended += 1
+        return overwritten
+
+    def clear(self):
+        """Remove all items and invalidate existing views"""
+        self._items = []
+        self._appended = 0
+        self._generation += 1
+
+    def last(self) -> Any:
+        """Get the newest item, or None when empty"""
+        if not self._items:
+            return None
+        return self._items[(self._appended - 1) % self.capacity]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.view())
+
+    def view(self, count: Optional[int] = None) -> "HistoryView":
+        """Get a view of the newest count items (all items by default)"""
+        size = len(self._items)
+        if count is None or count > size:
+            count = size
+        return HistoryView(self, self._appended - count, max(count, 0), self._generation)
+
+class HistoryView:
+    """Read-only, copy-free sequence over a range of a RingBuffer.
+
+    A view is meant to be consumed right away. Reading an entry that has been
+    overwritten or cleared since the view was taken raises RuntimeError
+    instead of silently returning a newer message.
+    """
+
+    __slots__ = ('_buffer', '_first', '_length', '_generation')
+
+    def __init__(self, buffer: RingBuffer, first: int, length: int, generation: int):
+        self._buffer = buffer
+        self._first = first
+        self._length = length
+        self._generation = generation
+
+    def _get(self, index: int) -> Any:
+        """Get the item at a view-relative index without bounds checks"""
+        buffer = self._buffer
+        position = self._first + index
+        if buffer._generation != self._generation or position < buffer._appended - len(buffer._items):
+            raise RuntimeError("History view is stale: chat buffer changed since the view was taken")
+        return buffer._items[position % buffer.capacity]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("history view index out of range")
+        return self._get(index)
+
+    def __iter__(self) -> Iterator[Any]:
+        for index in range(self._length):
+            yield self._get(index)
+
+    def __reversed__(self) -> Iterator[Any]:
+        for index in range(self._length - 1, -1, -1):
+            yield self._get(index)
+
+    def __bool__(self) -> bool:
+        return self._length > 0
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prometheus-style metrics for the bot's hot paths
+"""
+
+import logging
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    """Format a label set in exposition syntax"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value: str) -> str:
+    """Escape a label value"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    """Format a sample value"""
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    """Base class for metrics with optional labels"""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        """Order label values by label name, rejecting unknown labels"""
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        """Render exposition lines including HELP and TYPE"""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}",
+                *self._render_samples()]
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase the counter"""
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Get the current value for a label set"""
+        return self._values.get(self._label_values(labels), 0)
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in list(self._values.items())]
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        """Set the gauge"""
+        self._values[self._label_values(labels)] = value
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in list(self._values.items())]
+
+class Histogram(_Metric):
+    """Bucketed distribution of observed values.
+
+    Observations land in a single bucket found by binary search; buckets
+    are made cumulative only when rendering.
+    """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts incl. +Inf, sum, count]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        """Record an observation"""
+        key = self._label_values(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in list(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class CallbackMetric(_Metric):
+    """Metric whose value is read from a callback at scrape time.
+
+    The callback returns a number, or a dict mapping a label value (for a
+    single label) to a number.
+    """
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Union[float, Dict[str, float]]],
+                 metric_type: str = 'gauge', labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.metric_type = metric_type
+        self.callback = callback
+
+    def _render_samples(self) -> List[str]:
+        value = self.callback()
+        if isinstance(value, dict):
+            return [f"{self.name}{_format_labels(self.labelnames, (label,))} {_format_value(sample)}"
+                    for label, sample in value.items() if sample is not None]
+        return [f"{self.name} {_format_value(value)}"]
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Register a metric, replacing any previous metric with the same name"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def callback(self, name: str, documentation: str, callback: Callable, metric_type: str = 'gauge',
+                 labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, metric_type, labelnames))
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Error rendering metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+def merge_renderings(renderings: Dict[Optional[str], str], label: str) -> str:
+    """Merge expositions of several processes into one.
+
+    renderings maps a value of label to a process's rendered metrics; its
+    samples get that label, except for the None entry, which is added
+    as is. Samples of a metric family are grouped under a single HELP and
+    TYPE, as the exposition format requires.
+    """
+    families: Dict[str, List[str]] = {}
+    for value, text in renderings.items():
+        extra = '' if value is None else f'{label}="{_escape(value)}"'
+        samples = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split(' ', 3)[2]
+                samples = families.get(name)
+                if samples is None:
+                    samples = families[name] = [line]
+                elif line.startswith('# TYPE ') and len(samples) == 1:
+                    samples.append(line)
+            elif line and not line.startswith('#') and samples is not None:
+                if extra:
+                    name, sep, rest = line.partition('{')
+                    if sep:
+                        line = f"{name}{{{extra},{rest}"
+                    else:
+                        name, _, rest = line.partition(' ')
+                        line = f"{name}{{{extra}}} {rest}"
+                samples.append(line)
+    return '\n'.join(line for samples in families.values() for line in samples) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+HANDLE_MESSAGE_SECONDS = REGISTRY.histogram(
+    'bratik_handle_message_seconds', 'Time spent in handle_message per incoming message')
+RESPONSE_SECONDS = REGISTRY.histogram(
+    'bratik_response_seconds', 'End-to-end time from trigger message to completed reply')
+OPENROUTER_REQUEST_SECONDS = REGISTRY.histogram(
+    'bratik_openrouter_request_seconds', 'OpenRouter request latency', ('model', 'stream'))
+OPENROUTER_TTFT_SECONDS = REGISTRY.histogram(
+    'bratik_openrouter_time_to_first_token_seconds', 'Time to first streamed token', ('model',))
+OPENROUTER_REQUESTS = REGISTRY.counter(
+    'bratik_openrouter_requests_total', 'OpenRouter requests by outcome', ('model', 'outcome'))
+TOKENS = REGISTRY.histogram(
+    'bratik_tokens_per_request', 'Prompt and completion tokens per request from API usage', ('direction',),
+    buckets=TOKEN_BUCKETS)
+TRIGGERS = REGISTRY.counter(
+    'bratik_triggers_total', 'Messages that triggered a response', ('reason',))
+ERRORS = REGISTRY.counter(
+    'bratik_errors_total', 'Errors by stage', ('stage',))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'bratik_generation_queue_wait_seconds', 'Time chats waited in the queue for a generation slot')
+SHED_TRIGGERS = REGISTRY.counter(
+    'bratik_shed_triggers_total', 'Triggers answered with a busy reply instead of a generation', ('reason',))
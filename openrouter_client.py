@@ -8,91 +8,493 @@ import aiohttp
 import asyncio
 import json
 import logging
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional, Sequence
+
+import metrics
+from resilience import (CircuitBreaker, LatencyTracker, StreamInterrupted, UpstreamError, backoff_delay,
+                        parse_retry_after)
 
 logger = logging.getLogger(__name__)
 
+# Client errors that would fail the same way on every model, so neither
+# retries nor fallback can help
+FATAL_STATUSES = {400, 401, 402, 403}
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+# Outcomes of a failed attempt
+RETRY, NEXT_MODEL, GIVE_UP = 'retry', 'next_model', 'give_up'
+
 class OpenRouterClient:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, base_url: str = "https://openrouter.ai/api/v1",
+                 model: str = "deepseek/deepseek-r1", fallback_models: Sequence[str] = (),
+                 max_retries: int = 2, retry_base_delay: float = 0.5, retry_max_delay: float = 8.0,
+                 request_timeout: float = 30.0, breaker_threshold: int = 5, breaker_reset_timeout: float = 30.0,
+                 hedge_percentile: Optional[float] = None, hedge_min_samples: int = 20,
+                 pool_limit: int = 100, pool_limit_per_host: int = 20, dns_cache_ttl: int = 300,
+                 keepalive_timeout: float = 60.0, reasoning: Optional[Dict] = None,
+                 fast_model: Optional[str] = None):
         self.api_key = api_key
-        self.base_url = "https://openrouter.ai/api/v1"
-        self.model = "deepseek/deepseek-r1"
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.models = list(dict.fromkeys([model, *fallback_models]))
+        # Non-reasoning model tried first for short chit-chat, falling back to the main chain
+        self.fast_model = fast_model
+        self.fast_models = list(dict.fromkeys([fast_model, *self.models])) if fast_model else self.models
+        # OpenRouter reasoning options, e.g. {"max_tokens": 200} or {"exclude": True}
+        self.reasoning = reasoning
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.request_timeout = request_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
         self.session = None
-        
+        self._last_used = 0.0
+
+        # Headers never change, so build them once and set them on the session
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/telegram-bot-sanych",
+            "X-Title": "Telegram Bot Sanych"
+        }
+        self._pool_stats = {
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0
+        }
+
+        self._breakers = {
+            name: CircuitBreaker(name, breaker_threshold, breaker_reset_timeout) for name in self.fast_models
+        }
+        self._latency = {name: LatencyTracker() for name in self.fast_models}
+
+        logger.info(f"OpenRouterClient initialized with models: {', '.join(self.models)}"
+                    + (f", fast model: {fast_model}" if fast_model else ""))
+
+    async def start(self):
+        """Create the shared HTTP session and connection pool"""
+        if self.session is not None and not self.session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self._headers,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            trace_configs=[self._build_trace_config()]
+        )
+        self._last_used = asyncio.get_running_loop().time()
+        logger.info(f"OpenRouter connection pool started: {self.pool_limit_per_host} connections per host")
+
+    def _build_trace_config(self) -> aiohttp.TraceConfig:
+        """Build trace hooks that count connection reuse"""
+        stats = self._pool_stats
+
+        async def on_request_start(session, context, params):
+            stats['requests'] += 1
+
+        async def on_connection_create_end(session, context, params):
+            stats['connections_created'] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            stats['connections_reused'] += 1
+
+        async def on_dns_cache_hit(session, context, params):
+            stats['dns_cache_hits'] += 1
+
+        async def on_dns_cache_miss(session, context, params):
+            stats['dns_cache_misses'] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
     async def _get_session(self):
-        """Get or create aiohttp session"""
+        """Get the shared session, starting it if start() was not called"""
         if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=30)
-            self.session = aiohttp.ClientSession(timeout=timeout)
+            await self.start()
+        self._last_used = asyncio.get_running_loop().time()
         return self.session
-    
-    async def generate_response(self, messages: List[Dict], max_tokens: int = 600) -> Optional[str]:
-        """Generate response using OpenRouter API"""
+
+    async def close_if_idle(self, idle_timeout: float) -> bool:
+        """Close the connection pool if no request used it for idle_timeout seconds.
+
+        Idle keep-alive connections are dropped by the connector on their
+        own; this also releases the session, DNS cache and connector of a
+        bot nobody talks to. The next request opens a new pool.
+        """
+        if self.session is None or self.session.closed:
+            return False
+        if asyncio.get_running_loop().time() - self._last_used < idle_timeout:
+            return False
+        await self.close()
+        return True
+
+    def _build_payload(self, messages: List[Dict], max_tokens: int, stream: bool) -> Dict:
+        """Build chat completion request payload (the model is set per attempt)"""
+        payload = {
+            "messages": messages,
+            "max_tokens": min(max_tokens, 600),  # Limit to 600 tokens to fit budget
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "frequency_penalty": 0.1,
+            "presence_penalty": 0.1,
+            "stream": stream,
+            # Ask for token counts, also sent as a final chunk when streaming
+            "usage": {"include": True}
+        }
+        if self.reasoning:
+            # Reasoning tokens count against max_tokens, so capping them leaves room for the answer
+            payload["reasoning"] = self.reasoning
+        return payload
+
+    def _record_usage(self, usage: Dict, sink: Optional[Dict[str, int]] = None):
+        """Record token counts reported in a response's usage field.
+
+        Counts are also added to sink, when given, so callers can charge the
+        tokens of every attempt, including retries and hedged duplicates.
+        """
+        if not isinstance(usage, dict):
+            return
+        for direction, field in (('prompt', 'prompt_tokens'), ('completion', 'completion_tokens')):
+            if isinstance(usage.get(field), int):
+                metrics.TOKENS.observe(usage[field], direction=direction)
+                if sink is not None:
+                    sink[field] = sink.get(field, 0) + usage[field]
+
+    def _http_error(self, model: str, status: int, error_text: str, retry_after: Optional[str]) -> UpstreamError:
+        """Classify a non-200 response"""
+        return UpstreamError(
+            f"{model} returned {status}: {error_text[:200]}",
+            status=status,
+            retryable=status in RETRYABLE_STATUSES,
+            retry_after=parse_retry_after(retry_after)
+        )
+
+    async def _handle_failure(self, model: str, error: UpstreamError, attempt: int) -> str:
+        """Record a failed attempt and decide what to do next, sleeping before a retry"""
+        breaker = self._breakers[model]
+        metrics.OPENROUTER_REQUESTS.inc(model=model, outcome='error')
+
+        if error.status in FATAL_STATUSES:
+            # The model answered; the request itself is bad
+            breaker.record_success()
+            logger.error(f"OpenRouter API error: {error}")
+            return GIVE_UP
+
+        breaker.record_failure()
+        logger.warning(f"OpenRouter attempt {attempt + 1} failed: {error}")
+
+        if not error.retryable or attempt >= self.max_retries:
+            return NEXT_MODEL
+
+        delay = backoff_delay(attempt, self.retry_base_delay, self.retry_max_delay)
+        if error.retry_after is not None:
+            if error.retry_after > self.retry_max_delay:
+                # Waiting that long is worse than switching to a fallback model
+                return NEXT_MODEL
+            delay = max(delay, error.retry_after)
+
+        await asyncio.sleep(delay)
+        return RETRY if breaker.allow_request() else NEXT_MODEL
+
+    async def generate_response(self, messages: List[Dict], max_tokens: int = 600,
+                                usage: Optional[Dict[str, int]] = None, fast: bool = False) -> Optional[str]:
+        """Generate response using OpenRouter API.
+
+        Retries transient failures with jittered exponential backoff, honoring
+        Retry-After, and falls back to the next configured model when a model
+        keeps failing or its circuit breaker is open. Returns None if every
+        model failed. Token usage reported by the API is added to usage.
+        With fast set, the fast model is tried before the main chain.
+        """
+        payload = self._build_payload(messages, max_tokens, stream=False)
+        logger.info(f"Sending request to OpenRouter with {len(messages)} messages")
+
+        for model in (self.fast_models if fast else self.models):
+            if not self._breakers[model].allow_request():
+                logger.info(f"Skipping {model}: circuit breaker open")
+                continue
+
+            attempt = 0
+            while True:
+                # Set once the attempt's outcome is recorded; otherwise, e.g. when
+                # cancelled, the finally clause frees a half-open breaker's trial slot
+                settled = False
+                try:
+                    content = await self._complete(model, payload, usage)
+                    self._breakers[model].record_success()
+                    settled = True
+                    metrics.OPENROUTER_REQUESTS.inc(model=model, outcome='success')
+                    logger.info(f"Generated response with {model}: {len(content)} characters")
+                    return content
+                except UpstreamError as e:
+                    settled = True
+                    outcome = await self._handle_failure(model, e, attempt)
+                except Exception as e:
+                    self._breakers[model].record_failure()
+                    settled = True
+                    logger.error(f"Unexpected error calling OpenRouter API: {e}")
+                    return None
+                finally:
+                    if not settled:
+                        self._breakers[model].release_trial()
+
+                if outcome == GIVE_UP:
+                    return None
+                if outcome == NEXT_MODEL:
+                    break
+                attempt += 1
+
+        logger.error("All OpenRouter models failed")
+        return None
+
+    async def _complete(self, model: str, payload: Dict, usage: Optional[Dict[str, int]] = None) -> str:
+        """Run one completion, hedging it when the model is slower than usual"""
+        loop = asyncio.get_running_loop()
+        tracker = self._latency[model]
+        started = loop.time()
+
+        hedge_after = None
+        if self.hedge_percentile and len(tracker) >= self.hedge_min_samples:
+            hedge_after = tracker.percentile(self.hedge_percentile)
+
+        if hedge_after is None:
+            content = await self._request(model, payload, usage)
+        else:
+            content = await self._hedged_request(model, payload, hedge_after, usage)
+
+        elapsed = loop.time() - started
+        tracker.record(elapsed)
+        metrics.OPENROUTER_REQUEST_SECONDS.observe(elapsed, model=model, stream='false')
+        return content
+
+    async def _hedged_request(self, model: str, payload: Dict, hedge_after: float,
+                              usage: Optional[Dict[str, int]] = None) -> str:
+        """Send a second identical request if the first one exceeds hedge_after seconds.
+
+        Whichever finishes first successfully wins and the other is cancelled.
+        """
+        tasks = {asyncio.create_task(self._request(model, payload, usage))}
         try:
-            session = await self._get_session()
-            
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://github.com/telegram-bot-sanych",
-                "X-Title": "Telegram Bot Sanych"
-            }
-            
-            payload = {
-                "model": self.model,
-                "messages": messages,
-                "max_tokens": min(max_tokens, 600),  # Limit to 600 tokens to fit budget
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "frequency_penalty": 0.1,
-                "presence_penalty": 0.1,
-                "stream": False
-            }
-            
-            logger.info(f"Sending request to OpenRouter with {len(messages)} messages")
-            
-            async with session.post(f"{self.base_url}/chat/completions", 
-                                  headers=headers, 
-                                  json=payload) as response:
-                
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    if "choices" in data and len(data["choices"]) > 0:
-                        content = data["choices"][0]["message"]["content"]
-                        logger.info(f"Generated response: {len(content)} characters")
-                        return content.strip()
-                    else:
-                        logger.error(f"No choices in response: {data}")
-                        return None
-                        
-                else:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                logger.info(f"Hedging request to {model} after {hedge_after:.1f}s")
+                tasks.add(asyncio.create_task(self._request(model, payload, usage)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _request(self, model: str, payload: Dict, usage: Optional[Dict[str, int]] = None) -> str:
+        """Send a single non-streaming completion request"""
+        session = await self._get_session()
+
+        try:
+            async with session.post(f"{self.base_url}/chat/completions",
+                                    json={**payload, "model": model}) as response:
+                if response.status != 200:
                     error_text = await response.text()
-                    logger.error(f"OpenRouter API error {response.status}: {error_text}")
-                    return None
-                    
+                    raise self._http_error(model, response.status, error_text, response.headers.get("Retry-After"))
+
+                data = await response.json(content_type=None)
+
         except asyncio.TimeoutError:
-            logger.error("Timeout while calling OpenRouter API")
-            return None
+            raise UpstreamError(f"Timeout while calling {model}")
         except aiohttp.ClientError as e:
-            logger.error(f"HTTP client error: {e}")
-            return None
+            raise UpstreamError(f"HTTP client error calling {model}: {e}")
         except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error calling OpenRouter API: {e}")
-            return None
-    
+            raise UpstreamError(f"JSON decode error from {model}: {e}")
+
+        if "error" in data:
+            # OpenRouter can report provider errors inside a 200 response
+            error = data["error"]
+            status = error.get("code") if isinstance(error.get("code"), int) else None
+            raise UpstreamError(f"{model} error: {error}", status=status,
+                                retryable=status is None or status in RETRYABLE_STATUSES)
+
+        self._record_usage(data.get("usage"), usage)
+
+        choices = data.get("choices") or []
+        content = (choices[0].get("message") or {}).get("content") if choices else None
+        if not content or not content.strip():
+            raise UpstreamError(f"No content in response from {model}: {str(data)[:200]}")
+
+        return content.strip()
+
+    async def stream_response(self, messages: List[Dict], max_tokens: int = 600,
+                              usage: Optional[Dict[str, int]] = None, fast: bool = False) -> AsyncIterator[str]:
+        """Stream response tokens from OpenRouter API as they arrive.
+
+        Yields content deltas parsed from the server-sent events stream.
+        Failures before the first token are retried and fall back to other
+        models like generate_response; once tokens have been yielded an error
+        raises StreamInterrupted, since the text so far is not a complete
+        answer. Callers should treat an empty stream as a failed generation. Token usage reported by the API is added to usage.
+        With fast set, the fast model is tried before the main chain.
+        """
+        payload = self._build_payload(messages, max_tokens, stream=True)
+        logger.info(f"Streaming request to OpenRouter with {len(messages)} messages")
+
+        loop = asyncio.get_running_loop()
+
+        for model in (self.fast_models if fast else self.models):
+            if not self._breakers[model].allow_request():
+                logger.info(f"Skipping {model}: circuit breaker open")
+                continue
+
+            attempt = 0
+            while True:
+                total_chars = 0
+                started = loop.time()
+                # As in generate_response: a consumer that stops iterating (GeneratorExit)
+                # or a cancellation must not leave a half-open breaker's trial slot taken
+                settled = False
+                try:
+                    async for delta in self._stream_once(model, payload, usage):
+                        if not total_chars:
+                            metrics.OPENROUTER_TTFT_SECONDS.observe(loop.time() - started, model=model)
+                        total_chars += len(delta)
+                        yield delta
+
+                    if total_chars:
+                        self._breakers[model].record_success()
+                        settled = True
+                        metrics.OPENROUTER_REQUESTS.inc(model=model, outcome='success')
+                        metrics.OPENROUTER_REQUEST_SECONDS.observe(loop.time() - started, model=model, stream='true')
+                        logger.info(f"Streamed response with {model}: {total_chars} characters")
+                        return
+                    raise UpstreamError(f"Empty stream from {model}")
+
+                except UpstreamError as e:
+                    settled = True
+                    if total_chars:
+                        self._breakers[model].record_failure()
+                        metrics.OPENROUTER_REQUESTS.inc(model=model, outcome='error')
+                        logger.error(f"Stream from {model} failed after {total_chars} characters: {e}")
+                        raise StreamInterrupted(str(e), total_chars) from e
+                    outcome = await self._handle_failure(model, e, attempt)
+                except Exception as e:
+                    self._breakers[model].record_failure()
+                    settled = True
+                    metrics.OPENROUTER_REQUESTS.inc(model=model, outcome='error')
+                    logger.error(f"Unexpected error streaming from {model}: {e}")
+                    if total_chars:
+                        raise StreamInterrupted(str(e), total_chars) from e
+                    return
+                finally:
+                    if not settled:
+                        self._breakers[model].release_trial()
+
+                if outcome == GIVE_UP:
+                    return
+                if outcome == NEXT_MODEL:
+                    break
+                attempt += 1
+
+        logger.error("All OpenRouter models failed to stream")
+
+    async def _stream_once(self, model: str, payload: Dict,
+                           usage: Optional[Dict[str, int]] = None) -> AsyncIterator[str]:
+        """Open a single streaming request and yield its content deltas"""
+        session = await self._get_session()
+
+        try:
+            async with session.post(f"{self.base_url}/chat/completions",
+                                    json={**payload, "model": model},
+                                    timeout=aiohttp.ClientTimeout(total=None, sock_read=self.request_timeout)) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise self._http_error(model, response.status, error_text, response.headers.get("Retry-After"))
+
+                async for delta in self._iter_sse_deltas(response, usage):
+                    yield delta
+
+        except asyncio.TimeoutError:
+            raise UpstreamError(f"Timeout while streaming from {model}")
+        except aiohttp.ClientError as e:
+            raise UpstreamError(f"HTTP client error while streaming from {model}: {e}")
+
+    async def _iter_sse_deltas(self, response: aiohttp.ClientResponse,
+                               usage: Optional[Dict[str, int]] = None) -> AsyncIterator[str]:
+        """Parse an SSE chat completion stream into content deltas"""
+        async for raw_line in response.content:
+            line = raw_line.strip()
+
+            # Blank lines separate events, lines starting with ':' are comments
+            # (OpenRouter sends ": OPENROUTER PROCESSING" keep-alives)
+            if not line or line.startswith(b":") or not line.startswith(b"data:"):
+                continue
+
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                return
+
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping malformed stream chunk: {e}")
+                continue
+
+            if "error" in chunk:
+                raise UpstreamError(f"OpenRouter stream error: {chunk['error']}")
+
+            if chunk.get("usage"):
+                self._record_usage(chunk["usage"], usage)
+
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                yield content
+
+    def get_model_stats(self) -> Dict[str, Dict]:
+        """Get circuit breaker state and latency percentiles per model"""
+        return {
+            model: {
+                'breaker': self._breakers[model].state,
+                'p50': self._latency[model].percentile(50),
+                'p95': self._latency[model].percentile(95),
+                'samples': len(self._latency[model])
+            }
+            for model in self.fast_models
+        }
+
+    def get_pool_stats(self) -> Dict[str, float]:
+        """Get HTTP request and connection reuse statistics"""
+        stats = dict(self._pool_stats)
+        connections = stats['connections_created'] + stats['connections_reused']
+        stats['reuse_ratio'] = stats['connections_reused'] / connections if connections else 0.0
+        return stats
+
     async def close(self):
-        """Close the aiohttp session"""
+        """Close the aiohttp session and its connection pool"""
         if self.session and not self.session.closed:
             await self.session.close()
-    
-    def __del__(self):
-        """Cleanup on destruction"""
-        if self.session and not self.session.closed:
-            try:
-                asyncio.get_event_loop().run_until_complete(self.close())
-            except:
-                pass
+            logger.info("OpenRouter connection pool closed")
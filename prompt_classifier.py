@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lightweight classification of prompts that do not need a reasoning model
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Signs that a prompt asks for thinking rather than banter: numbers, code or
+# math symbols, and verbs asking to explain, compute or write something
+_REASONING_HINTS = re.compile(
+    r'\d|[=+*/^%<>{}\[\]`]'
+    r'|почему|зачем|объясн|расскаж|посчита|вычисл|сравни|докаж|реши|напиши|составь|переведи|код'
+    r'|как (?:сделать|работает|устроен|решить)|в чем разница|что лучше'
+    r'|why|explain|how (?:to|do|does)|calculat|compar|prove|solve|write|translate|code',
+    re.IGNORECASE
+)
+
+def is_small_talk(text: str, max_chars: int = 80) -> bool:
+    """Check whether a prompt is short chit-chat a fast model can answer.
+
+    Costs one bounded regex search; long prompts are rejected before it.
+    """
+    text = text.strip()
+    if not text or len(text) > max_chars or text.count('?') > 1:
+        return False
+    return _REASONING_HINTS.search(text) is None
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-user and per-chat rate limits and rolling daily token quotas
+"""
+
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+QUOTA_SLOTS = 24
+QUOTA_SLOT_SECONDS = 3600
+
+# Reasons returned by RateLimiter.check
+USER_RATE, CHAT_RATE, USER_QUOTA, CHAT_QUOTA = 'user_rate', 'chat_rate', 'user_quota', 'chat_quota'
+
+class LimitTier:
+    """Limits applied to a user or chat; 0 disables a limit"""
+
+    FIELDS = ('user_rate_per_minute', 'user_burst', 'chat_rate_per_minute', 'chat_burst',
+              'user_daily_tokens', 'chat_daily_tokens')
+
+    def __init__(self, name: str, user_rate_per_minute: float = 5, user_burst: int = 3,
+                 chat_rate_per_minute: float = 20, chat_burst: int = 10,
+                 user_daily_tokens: int = 50000, chat_daily_tokens: int = 300000):
+        self.name = name
+        self.user_rate_per_minute = user_rate_per_minute
+        self.user_burst = user_burst
+        self.chat_rate_per_minute = chat_rate_per_minute
+        self.chat_burst = chat_burst
+        self.user_daily_tokens = user_daily_tokens
+        self.chat_daily_tokens = chat_daily_tokens
+
+    def derive(self, name: str, overrides: Dict[str, Any]) -> 'LimitTier':
+        """Create a tier from this one with some limits overridden"""
+        values = {field: getattr(self, field) for field in self.FIELDS}
+        for field, value in overrides.items():
+            if field not in values:
+                logger.warning(f"Unknown limit {field!r} in tier {name}")
+                continue
+            values[field] = value
+        return LimitTier(name, **values)
+
+class TokenBucket:
+    """Token bucket refilled lazily on access.
+
+    Rate and capacity come from the tier at call time, so a bucket is just
+    two floats.
+    """
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, rate_per_second: float, capacity: float, now: float) -> float:
+        """Add tokens accrued since the last access and return the balance"""
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate_per_second)
+        self.updated = now
+        return self.tokens
+
+class DailyQuota:
+    """Tokens used over the last 24 hours, kept in hourly slots.
+
+    Advancing the window clears at most QUOTA_SLOTS slots, so every
+    operation is O(1).
+    """
+
+    __slots__ = ('slots', 'hour', 'total')
+
+    def __init__(self):
+        self.slots = [0] * QUOTA_SLOTS
+        self.hour = 0
+        self.total = 0
+
+    def _advance(self, now: float):
+        """Drop slots that fell out of the window"""
+        hour = int(now // QUOTA_SLOT_SECONDS)
+        if hour <= self.hour:
+            return
+        for step in range(1, min(hour - self.hour, QUOTA_SLOTS) + 1):
+            index = (self.hour + step) % QUOTA_SLOTS
+            self.total -= self.slots[index]
+            self.slots[index] = 0
+        self.hour = hour
+
+    def used(self, now: float) -> int:
+        """Tokens used in the window ending now"""
+        self._advance(now)
+        return self.total
+
+    def add(self, tokens: int, now: float):
+        """Record used tokens"""
+        self._advance(now)
+        self.slots[self.hour % QUOTA_SLOTS] += tokens
+        self.total += tokens
+
+    def merge(self, other: 'DailyQuota', now: float):
+        """Add the usage recorded in another quota"""
+        self._advance(now)
+        other._advance(now)
+        for index, tokens in enumerate(other.slots):
+            self.slots[index] += tokens
+        self.total += other.total
+
+class RateLimiter:
+    """Admission control for generations.
+
+    check() runs before any upstream call and consumes one request from
+    the user's and the chat's token buckets. record_usage() charges the
+    tokens a generation actually used against the rolling daily quotas.
+    Users and chats get the default tier unless assigned another one.
+    The owner calls prune() every idle_prune_interval seconds.
+
+    With storage, usage is saved as deltas that storage adds to the stored
+    totals, and each save adopts the resulting totals. Processes sharing
+    the database (cluster workers) thus enforce one daily quota per user
+    and chat, lagging by at most the save interval.
+    """
+
+    def __init__(self, default_tier: LimitTier, tiers: Optional[Dict[str, LimitTier]] = None,
+                 user_tiers: Optional[Dict[int, str]] = None, chat_tiers: Optional[Dict[int, str]] = None,
+                 storage=None, idle_prune_interval: float = 600, notice_interval: float = 60):
+        self.default_tier = default_tier
+        self.tiers = dict(tiers or {})
+        self.user_tiers = dict(user_tiers or {})
+        self.chat_tiers = dict(chat_tiers or {})
+        self.storage = storage
+        self.idle_prune_interval = idle_prune_interval
+        self.notice_interval = notice_interval
+
+        self._user_buckets: Dict[int, TokenBucket] = {}
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._user_quotas: Dict[int, DailyQuota] = {}
+        self._chat_quotas: Dict[int, DailyQuota] = {}
+        self._notices: Dict[Tuple[int, str], float] = {}
+        # (scope, entity_id) -> usage recorded since the last save
+        self._unsaved: Dict[Tuple[str, int], DailyQuota] = {}
+        self._stats = {'allowed': 0, USER_RATE: 0, CHAT_RATE: 0, USER_QUOTA: 0, CHAT_QUOTA: 0}
+
+        for name in {*self.user_tiers.values(), *self.chat_tiers.values()} - self.tiers.keys():
+            logger.warning(f"Unknown rate limit tier {name!r}, using {default_tier.name}")
+
+        # Quotas saved by a previous run are restored by restore() after startup;
+        # until then nothing is saved, so a save cannot race the restore
+        self.restored = storage is None
+
+    def _tier(self, assignments: Dict[int, str], entity_id: int) -> LimitTier:
+        """Get the tier assigned to a user or chat"""
+        name = assignments.get(entity_id)
+        return self.tiers.get(name, self.default_tier) if name else self.default_tier
+
+    def _take(self, buckets: Dict[int, TokenBucket], entity_id: int, rate_per_minute: float,
+              burst: int, now: float) -> Optional[TokenBucket]:
+        """Get a bucket holding at least one token, or None if it is empty"""
+        bucket = buckets.get(entity_id)
+        if bucket is None:
+            bucket = buckets[entity_id] = TokenBucket(burst, now)
+        if bucket.refill(rate_per_minute / 60, burst, now) < 1:
+            return None
+        return bucket
+
+    def check(self, chat_id: int, user_id: int) -> Optional[str]:
+        """Admit a generation request.
+
+        Returns None and consumes a request token from both buckets if the
+        request is allowed, otherwise the reason it was rejected.
+        """
+        now = time.time()
+        user_tier = self._tier(self.user_tiers, user_id)
+        chat_tier = self._tier(self.chat_tiers, chat_id)
+
+        reason = None
+        if user_tier.user_daily_tokens and user_id in self._user_quotas \
+                and self._user_quotas[user_id].used(now) >= user_tier.user_daily_tokens:
+            reason = USER_QUOTA
+        elif self.chat_over_quota(chat_id, now):
+            reason = CHAT_QUOTA
+        else:
+            user_bucket = chat_bucket = None
+            if user_tier.user_rate_per_minute:
+                user_bucket = self._take(self._user_buckets, user_id, user_tier.user_rate_per_minute,
+                                         user_tier.user_burst, now)
+                if user_bucket is None:
+                    reason = USER_RATE
+            if reason is None and chat_tier.chat_rate_per_minute:
+                chat_bucket = self._take(self._chat_buckets, chat_id, chat_tier.chat_rate_per_minute,
+                                         chat_tier.chat_burst, now)
+                if chat_bucket is None:
+                    reason = CHAT_RATE
+
+            # Consume only when both buckets admit the request
+            if reason is None:
+                for bucket in (user_bucket, chat_bucket):
+                    if bucket is not None:
+                        bucket.tokens -= 1
+
+        self._stats['allowed' if reason is None else reason] += 1
+        return reason
+
+    def should_notify(self, user_id: int, reason: str) -> bool:
+        """Check whether a user should be told about a rejection.
+
+        At most one notice per user and reason is sent per notice_interval,
+        so a flood of rejected triggers does not turn into a flood of replies.
+        """
+        now = time.time()
+        key = (user_id, reason)
+        if now - self._notices.get(key, 0) < self.notice_interval:
+            return False
+        self._notices[key] = now
+        return True
+
+    def chat_over_quota(self, chat_id: int, now: Optional[float] = None) -> bool:
+        """Check whether a chat has used up its daily token quota"""
+        daily_tokens = self._tier(self.chat_tiers, chat_id).chat_daily_tokens
+        quota = self._chat_quotas.get(chat_id)
+        if not daily_tokens or quota is None:
+            return False
+        return quota.used(time.time() if now is None else now) >= daily_tokens
+
+    def record_usage(self, chat_id: int, user_ids: Sequence[int], tokens: int):
+        """Charge tokens used by a generation to the chat and split them between users.
+
+        With no user_ids only the chat is charged, e.g. for its summaries.
+        """
+        if tokens <= 0:
+            return
+        now = time.time()
+        charges = [('chat', self._chat_quotas, chat_id, tokens)]
+        user_ids = list(dict.fromkeys(user_ids))
+        charges.extend(('user', self._user_quotas, user_id, -(-tokens // len(user_ids))) for user_id in user_ids)
+
+        for scope, quotas, entity_id, amount in charges:
+            quota = quotas.get(entity_id)
+            if quota is None:
+                quota = quotas[entity_id] = DailyQuota()
+            quota.add(amount, now)
+            if self.storage is not None:
+                unsaved = self._unsaved.get((scope, entity_id))
+                if unsaved is None:
+                    unsaved = self._unsaved[(scope, entity_id)] = DailyQuota()
+                unsaved.add(amount, now)
+
+    def get_usage(self, chat_id: int, user_id: int) -> Dict[str, int]:
+        """Get tokens used in the last 24 hours by a user and a chat"""
+        now = time.time()
+        user_quota = self._user_quotas.get(user_id)
+        chat_quota = self._chat_quotas.get(chat_id)
+        return {
+            'user_tokens': user_quota.used(now) if user_quota else 0,
+            'chat_tokens': chat_quota.used(now) if chat_quota else 0
+        }
+
+    def prune(self, now: Optional[float] = None):
+        """Forget full buckets and empty quotas, which carry no state"""
+        now = time.time() if now is None else now
+        removed = 0
+
+        for buckets, assignments, rate_field, burst_field in (
+                (self._user_buckets, self.user_tiers, 'user_rate_per_minute', 'user_burst'),
+                (self._chat_buckets, self.chat_tiers, 'chat_rate_per_minute', 'chat_burst')):
+            for entity_id, bucket in list(buckets.items()):
+                tier = self._tier(assignments, entity_id)
+                burst = getattr(tier, burst_field)
+                if bucket.refill(getattr(tier, rate_field) / 60, burst, now) >= burst:
+                    del buckets[entity_id]
+                    removed += 1
+
+        for quotas in (self._user_quotas, self._chat_quotas):
+            for entity_id, quota in list(quotas.items()):
+                if quota.used(now) <= 0:
+                    del quotas[entity_id]
+                    removed += 1
+
+        for key, noticed_at in list(self._notices.items()):
+            if now - noticed_at >= self.notice_interval:
+                del self._notices[key]
+
+        if removed:
+            logger.debug(f"Pruned {removed} idle rate limit entries")
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get admission counters and tracked entity counts"""
+        return {
+            **self._stats,
+            'tracked_users': len(self._user_buckets.keys() | self._user_quotas.keys()),
+            'tracked_chats': len(self._chat_buckets.keys() | self._chat_quotas.keys())
+        }
+
+    @staticmethod
+    def _quota_from_row(hour: int, slots: Sequence[int]) -> DailyQuota:
+        """Build a quota from a stored row"""
+        quota = DailyQuota()
+        quota.hour = hour
+        quota.slots = list(slots)[:QUOTA_SLOTS] + [0] * (QUOTA_SLOTS - len(slots))
+        quota.total = sum(quota.slots)
+        return quota
+
+    def restore(self, rows: Optional[Sequence[Tuple[str, int, int, List[int]]]] = None):
+        """Restore daily quotas saved in storage.
+
+        Usage recorded since startup is kept and added to the saved quotas.
+        rows can be read beforehand with storage.load_quotas(), e.g. off the
+        event loop; by default they are read here.
+        """
+        try:
+            if rows is None:
+                rows = self.storage.load_quotas()
+            self.adopt_saved(rows)
+            logger.info(f"Restored {len(rows)} token quotas")
+        except Exception as e:
+            logger.error(f"Error loading token quotas: {e}")
+        self.restored = True
+
+    def adopt_saved(self, rows: Sequence[Tuple[str, int, int, List[int]]]):
+        """Take saved quota totals, which include other processes' usage.
+
+        Each quota becomes the saved total plus the usage recorded here
+        since that total was saved.
+        """
+        now = time.time()
+        for scope, entity_id, hour, slots in rows:
+            quota = self._quota_from_row(hour, slots)
+            unsaved = self._unsaved.get((scope, entity_id))
+            if unsaved is not None:
+                quota.merge(unsaved, now)
+            (self._user_quotas if scope == 'user' else self._chat_quotas)[entity_id] = quota
+
+    def snapshot_quotas(self) -> Tuple[List[Tuple[str, int, int, List[int]]], int]:
+        """Take the usage recorded since the last snapshot for persisting.
+
+        Returns the usage deltas as rows and the first hour still inside the
+        window; stored quotas older than that can be deleted. Taking the
+        snapshot is cheap, so the write itself can run off the event loop.
+        After the write, pass the saved totals to adopt_saved(), or the rows
+        to requeue_quotas() if it failed.
+        """
+        now = time.time()
+        unsaved, self._unsaved = self._unsaved, {}
+        rows = [(scope, entity_id, quota.hour, list(quota.slots))
+                for (scope, entity_id), quota in unsaved.items() if quota.used(now) > 0]
+        # Empty deltas for the other tracked quotas, so their totals are refreshed too
+        hour = int(now // QUOTA_SLOT_SECONDS)
+        for scope, quotas in (('user', self._user_quotas), ('chat', self._chat_quotas)):
+            for entity_id, quota in quotas.items():
+                if (scope, entity_id) not in unsaved and quota.used(now) > 0:
+                    rows.append((scope, entity_id, hour, [0] * QUOTA_SLOTS))
+        return rows, hour - QUOTA_SLOTS + 1
+
+    def requeue_quotas(self, rows: Sequence[Tuple[str, int, int, List[int]]]):
+        """Put back usage deltas whose save failed, to be saved next time"""
+        now = time.time()
+        for scope, entity_id, hour, slots in rows:
+            quota = self._quota_from_row(hour, slots)
+            unsaved = self._unsaved.get((scope, entity_id))
+            if unsaved is not None:
+                quota.merge(unsaved, now)
+            self._unsaved[(scope, entity_id)] = quota
+
+    def save(self):
+        """Persist daily quotas"""
+        if self.storage is None or not self.restored:
+            return
+        rows, expired_before_hour = self.snapshot_quotas()
+        try:
+            saved = self.storage.save_quotas(rows, expired_before_hour)
+        except Exception as e:
+            self.requeue_quotas(rows)
+            logger.error(f"Error saving token quotas: {e}")
+            return
+        self.adopt_saved(saved)
+        logger.info(f"Saved {len(rows)} token quotas")
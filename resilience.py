@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Retry, circuit breaker and latency tracking helpers for upstream calls
+"""
+
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class UpstreamError(Exception):
+    """A failed upstream request, with retry hints"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = True,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class StreamInterrupted(UpstreamError):
+    """A streamed response that failed after some of it was already delivered"""
+
+    def __init__(self, message: str, received_chars: int):
+        super().__init__(message, retryable=False)
+        self.received_chars = received_chars
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with full jitter for the given zero-based attempt"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given as seconds or an HTTP date"""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+class CircuitBreaker:
+    """Stops sending requests to a failing upstream for a cool-down period.
+
+    After failure_threshold consecutive failures the breaker opens and
+    rejects requests for reset_timeout seconds. It then lets a single trial
+    request through (half-open); success closes it, failure opens it again.
+    Callers must end every allowed request with record_success(),
+    record_failure() or release_trial(), or the breaker stays half-open
+    with its trial slot taken.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow_request(self) -> bool:
+        """Check whether a request may be sent now"""
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+
+        # Half-open: allow exactly one trial request
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        """Record a successful request"""
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit breaker for {self.name} closed")
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """Release a half-open trial that ended without an outcome, e.g. when cancelled"""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        """Record a failed request"""
+        self._failures += 1
+        self._trial_in_flight = False
+
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker for {self.name} opened after {self._failures} failures")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+class LatencyTracker:
+    """Sliding window of recent request latencies"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        """Record a request latency"""
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """Get the latency at a percentile (0-100), or None without samples"""
+        if not self._samples:
+            return None
+
+        ordered = sorted(self._samples)
+        index = min(int(len(ordered) * percentile / 100), len(ordered) - 1)
+        return ordered[index]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Response cache for repeated prompts with in-flight deduplication
+"""
+
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from message_record import MessageRecord
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_prompt(text: str) -> str:
+    """Normalize a prompt so trivially different repeats share a cache key"""
+    text = _PUNCTUATION_RE.sub(" ", text.casefold())
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+class ResponseCache:
+    """LRU cache of generated responses with TTL expiry.
+
+    Keys combine the normalized prompt with a fingerprint of the newest
+    context messages, and with the chat id when scope is 'chat'. Identical
+    requests that arrive while one is being generated wait for that
+    generation instead of starting their own upstream call.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, scope: str = 'chat',
+                 context_messages: int = 2):
+        if scope not in ('chat', 'global'):
+            raise ValueError(f"Unknown response cache scope: {scope}")
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.scope = scope
+        self.context_messages = context_messages
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'shared': 0,
+            'expired': 0,
+            'evicted': 0
+        }
+
+        logger.info(f"ResponseCache initialized: {max_entries} entries, {ttl}s TTL, {scope} scope")
+
+    def make_key(self, chat_id: int, prompt: str, history: Sequence[MessageRecord],
+                 current_message_ids: Iterable[int] = ()) -> str:
+        """Build the cache key for a prompt in its chat context"""
+        excluded = set(current_message_ids)
+        fingerprint = []
+        if self.context_messages > 0:
+            for record in reversed(history):
+                if record.message_id in excluded and not record.is_bot:
+                    continue
+                fingerprint.append(normalize_prompt(record.text))
+                if len(fingerprint) >= self.context_messages:
+                    break
+
+        scope_part = str(chat_id) if self.scope == 'chat' else '*'
+        material = "\x1f".join([scope_part, normalize_prompt(prompt), *fingerprint])
+        return hashlib.blake2b(material.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get a cached response, or None when missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._stats['expired'] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key: str, response: str):
+        """Store a response, evicting the least recently used entries over capacity"""
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evicted'] += 1
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Return a cached response or compute it once for all concurrent callers"""
+        cached = self.get(key)
+        if cached is not None:
+            self._stats['hits'] += 1
+            logger.info("Response cache hit")
+            return cached
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._stats['shared'] += 1
+            logger.info("Sharing in-flight generation for identical request")
+            return await asyncio.shield(future)
+
+        self._stats['misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        result = None
+        try:
+            result = await compute()
+            if result:
+                self.put(key, result)
+            return result
+        finally:
+            # Waiters get None if the owner failed and will report an error themselves
+            del self._in_flight[key]
+            if not future.done():
+                future.set_result(result)
+
+    def purge_expired(self) -> int:
+        """Remove expired entries, returning how many were removed"""
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at < now]
+        for key in expired:
+            del self._entries[key]
+
+        self._stats['expired'] += len(expired)
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        lookups = self._stats['hits'] + self._stats['misses'] + self._stats['shared']
+        return {
+            **self._stats,
+            'entries': len(self._entries),
+            'in_flight': len(self._in_flight),
+            'hit_ratio': (self._stats['hits'] + self._stats['shared']) / lookups if lookups else 0.0
+        }
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for ChatScheduler admission and shedding
+"""
+
+import asyncio
+
+from chat_scheduler import SHED_QUEUE_FULL, ChatScheduler, trigger_priority
+
+GROUP_MENTION = trigger_priority('mention', private=False)
+PRIVATE_REPLY = trigger_priority('reply', private=True)
+
+class Recorder:
+    """Handler pair that records batches and blocks generations until released"""
+
+    def __init__(self):
+        self.handled = []
+        self.shed = []
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+
+    async def handler(self, chat_id, items):
+        self.started.set()
+        await self.release.wait()
+        self.handled.append((chat_id, items))
+
+    async def shed_handler(self, chat_id, items, reason):
+        self.shed.append((chat_id, items, reason))
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_queue_full_sheds_follow_ups_before_more_urgent_trigger():
+    async def scenario():
+        recorder = Recorder()
+        scheduler = ChatScheduler(recorder.handler, max_concurrent=1, max_queue_size=3,
+                                  shed_handler=recorder.shed_handler)
+        scheduler.submit(1, 'first', GROUP_MENTION)
+        await recorder.started.wait()
+
+        # Follow-ups coalesced behind the in-flight generation fill the queue
+        for index in range(3):
+            scheduler.submit(1, f'follow-up {index}', GROUP_MENTION)
+        scheduler.submit(2, 'urgent', PRIVATE_REPLY)
+        await _settle()
+
+        recorder.release.set()
+        await asyncio.wait_for(asyncio.gather(*scheduler._workers.values()), 1.0)
+        await _settle()
+        return recorder
+
+    recorder = asyncio.run(scenario())
+    assert (2, ['urgent']) in recorder.handled
+    assert recorder.shed == [(1, ['follow-up 0', 'follow-up 1', 'follow-up 2'], SHED_QUEUE_FULL)]
+
+def test_queue_full_sheds_incoming_trigger_when_it_is_least_urgent():
+    async def scenario():
+        recorder = Recorder()
+        scheduler = ChatScheduler(recorder.handler, max_concurrent=1, max_queue_size=3,
+                                  shed_handler=recorder.shed_handler)
+        scheduler.submit(1, 'first', PRIVATE_REPLY)
+        await recorder.started.wait()
+
+        for index in range(3):
+            scheduler.submit(1, f'follow-up {index}', PRIVATE_REPLY)
+        scheduler.submit(2, 'mention', GROUP_MENTION)
+        await _settle()
+
+        recorder.release.set()
+        await asyncio.wait_for(asyncio.gather(*scheduler._workers.values()), 1.0)
+        await _settle()
+        return recorder
+
+    recorder = asyncio.run(scenario())
+    assert recorder.shed == [(2, ['mention'], SHED_QUEUE_FULL)]
+    assert recorder.handled == [(1, ['first']), (1, ['follow-up 0', 'follow-up 1', 'follow-up 2'])]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for OpenRouterClient retries, fallback, circuit breaking and hedging
+
+Runs the client against the local OpenRouter stub from the benchmarks with
+scripted failures.
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from openrouter_client import OpenRouterClient
+from resilience import CircuitBreaker
+from stub_servers import StubOpenRouter
+
+MESSAGES = [{'role': 'user', 'content': 'привет'}]
+
+def run(scenario, stub_options=None, **client_options):
+    """Run scenario(stub, client) against a fresh stub and client"""
+    async def main():
+        stub = StubOpenRouter(**{'latency': 0.01, 'ttft': 0.0, 'tokens': 5, **(stub_options or {})})
+        await stub.start()
+        options = {'fallback_models': ['backup'], 'max_retries': 2, 'retry_base_delay': 0.01,
+                   'retry_max_delay': 0.5, 'breaker_threshold': 5, 'breaker_reset_timeout': 30.0}
+        client = OpenRouterClient('test', base_url=stub.url, model='main', **{**options, **client_options})
+        try:
+            return await scenario(stub, client)
+        finally:
+            await client.close()
+            await stub.stop()
+    return asyncio.run(main())
+
+def models(stub):
+    return [model for model, _ in stub.log]
+
+def test_retries_transient_errors():
+    async def scenario(stub, client):
+        stub.script('main', 500, 503)
+        assert await client.generate_response(MESSAGES)
+        assert models(stub) == ['main', 'main', 'main']
+    run(scenario)
+
+def test_waits_for_retry_after():
+    async def scenario(stub, client):
+        stub.script('main', 429)
+        assert await client.generate_response(MESSAGES)
+        (_, first), (_, second) = stub.log
+        assert second - first >= 0.3
+    run(scenario, {'retry_after': '0.3'})
+
+def test_long_retry_after_moves_to_fallback():
+    async def scenario(stub, client):
+        stub.script('main', 429)
+        started = asyncio.get_running_loop().time()
+        assert await client.generate_response(MESSAGES)
+        assert asyncio.get_running_loop().time() - started < 1.0
+        assert models(stub) == ['main', 'backup']
+    run(scenario, {'retry_after': '5'})
+
+def test_falls_back_after_retries_are_exhausted():
+    async def scenario(stub, client):
+        stub.script('main', 500, 500, 500)
+        usage = {}
+        assert await client.generate_response(MESSAGES, usage=usage)
+        assert models(stub) == ['main', 'main', 'main', 'backup']
+        assert usage['completion_tokens'] == 5
+    run(scenario)
+
+def test_fatal_status_gives_up_without_fallback():
+    async def scenario(stub, client):
+        stub.script('main', 401)
+        assert await client.generate_response(MESSAGES) is None
+        assert models(stub) == ['main']
+        assert client._breakers['main'].state == CircuitBreaker.CLOSED
+    run(scenario)
+
+def test_returns_none_when_every_model_fails():
+    async def scenario(stub, client):
+        stub.script('main', 500)
+        stub.script('backup', 500)
+        assert await client.generate_response(MESSAGES) is None
+        assert models(stub) == ['main', 'backup']
+    run(scenario, max_retries=0)
+
+def test_open_breaker_skips_model():
+    async def scenario(stub, client):
+        stub.script('main', 500, 500)
+        for _ in range(2):
+            assert await client.generate_response(MESSAGES)
+        assert client._breakers['main'].state == CircuitBreaker.OPEN
+
+        stub.log.clear()
+        assert await client.generate_response(MESSAGES)
+        assert models(stub) == ['backup']
+    run(scenario, max_retries=0, breaker_threshold=2)
+
+def test_half_open_trial_closes_breaker_on_success():
+    async def scenario(stub, client):
+        stub.script('main', 500)
+        assert await client.generate_response(MESSAGES)
+        assert client._breakers['main'].state == CircuitBreaker.OPEN
+
+        await asyncio.sleep(0.25)
+        stub.log.clear()
+        assert await client.generate_response(MESSAGES)
+        assert models(stub) == ['main']
+        assert client._breakers['main'].state == CircuitBreaker.CLOSED
+    run(scenario, max_retries=0, breaker_threshold=1, breaker_reset_timeout=0.2)
+
+def test_half_open_trial_failure_reopens_breaker():
+    async def scenario(stub, client):
+        stub.script('main', 500, 500)
+        assert await client.generate_response(MESSAGES)
+        await asyncio.sleep(0.25)
+
+        stub.log.clear()
+        assert await client.generate_response(MESSAGES)
+        assert models(stub) == ['main', 'backup']
+        assert client._breakers['main'].state == CircuitBreaker.OPEN
+    run(scenario, max_retries=0, breaker_threshold=1, breaker_reset_timeout=0.2)
+
+def test_cancelled_trial_is_released():
+    async def scenario(stub, client):
+        stub.script('main', 500, 1.0)
+        assert await client.generate_response(MESSAGES)
+        await asyncio.sleep(0.25)
+
+        task = asyncio.create_task(client.generate_response(MESSAGES))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert client._breakers['main'].allow_request()
+    run(scenario, max_retries=0, breaker_threshold=1, breaker_reset_timeout=0.2)
+
+def test_hedges_slow_requests():
+    async def scenario(stub, client):
+        # Enough fast samples to make hedging kick in
+        for _ in range(3):
+            assert await client.generate_response(MESSAGES)
+
+        stub.script('main', 2.0, 0.01)
+        stub.log.clear()
+        started = asyncio.get_running_loop().time()
+        assert await client.generate_response(MESSAGES)
+        assert asyncio.get_running_loop().time() - started < 1.0
+        assert models(stub) == ['main', 'main']
+    run(scenario, hedge_percentile=50, hedge_min_samples=3)
+
+def test_hedge_failure_falls_back_to_other_request():
+    async def scenario(stub, client):
+        for _ in range(3):
+            assert await client.generate_response(MESSAGES)
+
+        # The original request succeeds slowly after the hedged one fails
+        stub.script('main', 0.3, 500)
+        assert await client.generate_response(MESSAGES)
+        assert models(stub)[-2:] == ['main', 'main']
+    run(scenario, hedge_percentile=50, hedge_min_samples=3, max_retries=0)
+
+def test_stream_retries_before_first_token():
+    async def scenario(stub, client):
+        stub.script('main', 503)
+        deltas = [delta async for delta in client.stream_response(MESSAGES)]
+        assert len(deltas) == 5
+        assert models(stub) == ['main', 'main']
+    run(scenario)
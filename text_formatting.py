@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Post-processing of model output for Telegram: reasoning removal, MarkdownV2 and splitting
+"""
+
+import logging
+import re
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+MARKDOWN_V2 = 'MarkdownV2'
+
+# Characters that must be escaped everywhere outside entities in MarkdownV2
+_SPECIAL_CHARS = '_*[]()~`>#+-=|{}.!\\'
+_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in _SPECIAL_CHARS})
+_CODE_ESCAPE_TABLE = str.maketrans({'`': '\\`', '\\': '\\\\'})
+_URL_ESCAPE_TABLE = str.maketrans({')': '\\)', '\\': '\\\\'})
+
+# Reasoning some providers inline into the content; an unclosed block hides
+# everything after it (the answer has not started yet while streaming)
+_THINK_PATTERN = re.compile(r'<think>.*?(?:</think>|$)', re.DOTALL)
+
+# One alternation over every construct the model writes, tried left to right
+# in a single re.sub pass; anything else that is special gets escaped
+_MARKDOWN_PATTERN = re.compile(
+    r'```(?P<lang>[\w+#-]*)[^\n`]*\n?(?P<pre>.*?)```'
+    r'|`(?P<code>[^`\n]+)`'
+    r'|\*\*(?P<bold>\S(?:[^\n]*?\S)?)\*\*'
+    r'|__(?P<bold2>\S(?:[^\n]*?\S)?)__'
+    r'|~~(?P<strike>\S(?:[^\n]*?\S)?)~~'
+    r'|(?<![\w*])\*(?P<italic>[^\s*](?:[^*\n]*?[^\s*])?)\*(?![\w*])'
+    r'|(?<![\w_])_(?P<italic2>[^\s_](?:[^_\n]*?[^\s_])?)_(?![\w_])'
+    r'|\[(?P<link_text>[^\]\n]+)\]\((?P<url>https?://[^)\s]+)\)'
+    r'|^#{1,6}[ \t]+(?P<heading>[^\n]+)'
+    r'|(?P<special>[_*\[\]()~`>#+\-=|{}.!\\])',
+    re.DOTALL | re.MULTILINE
+)
+
+def strip_reasoning(text: str) -> str:
+    """Remove <think> reasoning blocks from model output"""
+    if '<think>' not in text:
+        return text
+    return _THINK_PATTERN.sub('', text).strip()
+
+def escape_markdown_v2(text: str) -> str:
+    """Escape text so MarkdownV2 shows it literally"""
+    return text.translate(_ESCAPE_TABLE)
+
+def _render_entity(match: re.Match) -> str:
+    """Convert one matched construct to MarkdownV2"""
+    kind = match.lastgroup
+    if kind == 'special':
+        return '\\' + match.group('special')
+    if kind == 'pre':
+        return f"```{match.group('lang')}\n" + match.group('pre').translate(_CODE_ESCAPE_TABLE) + '```'
+    if kind == 'code':
+        return '`' + match.group('code').translate(_CODE_ESCAPE_TABLE) + '`'
+    if kind == 'url':
+        text = escape_markdown_v2(match.group('link_text'))
+        return f"[{text}]({match.group('url').translate(_URL_ESCAPE_TABLE)})"
+
+    wrappers = {'bold': '*', 'bold2': '*', 'heading': '*', 'strike': '~', 'italic': '_', 'italic2': '_'}
+    wrapper = wrappers[kind]
+    return wrapper + escape_markdown_v2(match.group(kind)) + wrapper
+
+def to_markdown_v2(text: str) -> str:
+    """Convert the model's Markdown to Telegram MarkdownV2 in a single pass.
+
+    Bold, italic, strikethrough, inline code, code blocks, links and
+    headings are converted; every other special character is escaped, so
+    stray brackets or dots no longer force a plain-text fallback. Unpaired
+    markers are shown literally.
+    """
+    return _MARKDOWN_PATTERN.sub(_render_entity, text)
+
+def split_message(text: str, limit: int) -> List[str]:
+    """Split text into chunks of at most limit characters.
+
+    Prefers paragraph breaks, then line breaks, then spaces, so code blocks
+    and sentences stay together when possible.
+    """
+    chunks = []
+    remaining = text.strip()
+    while len(remaining) > limit:
+        window = remaining[:limit]
+        cut = -1
+        for separator in ('\n\n', '\n', ' '):
+            cut = window.rfind(separator)
+            # Avoid tiny chunks when the only separator is near the start
+            if cut >= limit // 2:
+                break
+        if cut < limit // 2:
+            cut = limit
+        chunks.append(remaining[:cut].rstrip())
+        remaining = remaining[cut:].lstrip()
+    if remaining:
+        chunks.append(remaining)
+    return chunks
+
+def format_reply(text: str, limit: int) -> List[Tuple[str, Optional[str], str]]:
+    """Prepare a reply for sending as (text, parse_mode, plain_text) parts.
+
+    The plain text is split first and each chunk is converted on its own,
+    so no entity straddles two messages. A chunk whose escaped form
+    exceeds Telegram's limit is sent as plain text (parse_mode None);
+    plain_text is the fallback if Telegram rejects the formatting.
+    """
+    parts = []
+    for chunk in split_message(text, limit):
+        formatted = to_markdown_v2(chunk)
+        if len(formatted) <= TELEGRAM_MESSAGE_LIMIT:
+            parts.append((formatted, MARKDOWN_V2, chunk))
+        else:
+            parts.append((chunk, None, chunk))
+    return parts
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precompiled matching of the words that make the bot respond
+"""
+
+import asyncio
+import logging
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Pattern, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRIGGER_WORDS = ['братик', 'bratik']
+
+# Letters allowed after a trigger word so inflected forms still match
+# ("братику", "братиком") while longer words containing it do not
+MAX_SUFFIX_CHARS = 3
+
+def _case_class(text: str) -> str:
+    """Regex matching text in any letter case, e.g. 'ab' -> '[aA][bB]'"""
+    parts = []
+    for char in text:
+        lower, upper = char.lower(), char.upper()
+        if lower == upper or len(lower) != 1 or len(upper) != 1:
+            parts.append(re.escape(char))
+        else:
+            parts.append(f"[{re.escape(lower)}{re.escape(upper)}]")
+    return ''.join(parts)
+
+def compile_triggers(words: Iterable[str]) -> Optional[Pattern]:
+    """Compile trigger words into one case-insensitive pattern, or None if empty.
+
+    The pattern starts with a single character class of every word's first
+    letter, which lets the regex engine skip ahead in C to candidate
+    positions; re.IGNORECASE and a leading lookbehind would both disable
+    that scan. Each word is then checked against its first letter and for
+    a word boundary before it, so only real candidates pay for it.
+    """
+    by_first_letter: Dict[str, List[str]] = {}
+    for word in sorted({word.strip() for word in words if word.strip()}, key=len, reverse=True):
+        by_first_letter.setdefault(word[0].lower(), []).append(word)
+    if not by_first_letter:
+        return None
+
+    alternatives = []
+    for first_letter, group in by_first_letter.items():
+        tails = '|'.join(f"{_case_class(word[1:])}(?<!\\w.{{{len(word)}}})" for word in group)
+        alternatives.append(f"(?<={_case_class(first_letter)})(?:{tails})")
+
+    first_letters = ''.join(sorted({case for letter in by_first_letter for case in (letter, letter.upper())}))
+    return re.compile(f"[{re.escape(first_letters)}](?:{'|'.join(alternatives)})\\w{{0,{MAX_SUFFIX_CHARS}}}(?!\\w)")
+
+def compile_prefilter(words: Iterable[str]) -> Optional[Pattern]:
+    """Compile a cheap pattern that matches wherever compile_triggers' pattern can.
+
+    It is a plain sequence of character classes, one per letter of the
+    shortest word, each holding that letter of every word in either case
+    (e.g. '[бБbB][рРrR]...' for 'братик' and 'bratik'). Without lookbehinds
+    or alternation it rejects the typical message, which mentions nothing,
+    faster than the full pattern does.
+    """
+    words = {word.strip() for word in words if word.strip()}
+    if not words:
+        return None
+
+    classes = []
+    for position in range(min(len(word) for word in words)):
+        chars = set()
+        for word in words:
+            char = word[position]
+            chars.update(case for case in (char, char.lower(), char.upper()) if len(case) == 1)
+        classes.append('[' + ''.join(re.escape(char) for char in sorted(chars)) + ']')
+    return re.compile(''.join(classes))
+
+class TriggerEngine:
+    """Decides whether a message mentions the bot.
+
+    All trigger words of a chat are matched in a single regex pass that
+    works on the original text, so the cost stays one search however many
+    words and inflections a chat uses. A prefilter (compile_prefilter)
+    rejects most messages before that search. For the default words it
+    costs about the same as lower() + 'in' for each of them (0.95-1.0x on
+    messages that mostly do not mention the bot, benchmarks/bench_triggers.py).
+
+    Chats can override the default words. With storage, the overrides
+    survive restarts: a chat's words are read on its first message
+    (load_chat) and written when changed. At most max_loaded_chats chats
+    without overrides are remembered as checked; past that they are
+    simply read again.
+    """
+
+    def __init__(self, trigger_words: Iterable[str] = DEFAULT_TRIGGER_WORDS, storage=None,
+                 max_loaded_chats: int = 100000):
+        self.default_words = list(trigger_words)
+        self.storage = storage
+        self.max_loaded_chats = max_loaded_chats
+        self._default_searches = self._compile(self.default_words)
+        self._chat_words: Dict[int, List[str]] = {}
+        # chat_id -> search methods of (prefilter, pattern), or None when the chat has no words
+        self._chat_searches: Dict[int, Optional[Tuple[Callable, Callable]]] = {}
+        self._loaded: Set[int] = set()
+
+    def matches(self, chat_id: int, text: str) -> bool:
+        """Check whether text contains a trigger word of the chat"""
+        searches = self._chat_searches.get(chat_id, self._default_searches)
+        return searches is not None and searches[0](text) is not None and searches[1](text) is not None
+
+    @staticmethod
+    def _compile(words: List[str]) -> Optional[Tuple[Callable, Callable]]:
+        """Compile a word list into the search methods of its prefilter and full pattern"""
+        pattern = compile_triggers(words)
+        if pattern is None:
+            return None
+        return compile_prefilter(words).search, pattern.search
+
+    def get_chat_triggers(self, chat_id: int) -> List[str]:
+        """Get the trigger words used in a chat"""
+        return list(self._chat_words.get(chat_id, self.default_words))
+
+    async def load_chat(self, chat_id: int):
+        """Load a chat's saved trigger words on first use, reading off the event loop"""
+        if self.storage is None or chat_id in self._loaded:
+            return
+        try:
+            words = await asyncio.to_thread(self.storage.load_chat_triggers, chat_id)
+        except Exception as e:
+            logger.error(f"Error loading trigger words for chat {chat_id}: {e}")
+            return
+
+        # The words may have been changed by /triggers while loading
+        if chat_id in self._loaded:
+            return
+        if len(self._loaded) >= self.max_loaded_chats:
+            self._loaded = set(self._chat_words)
+        self._loaded.add(chat_id)
+        if words is not None:
+            self._apply(chat_id, words)
+
+    def _apply(self, chat_id: int, words: List[str]):
+        """Use custom trigger words in a chat without saving them"""
+        self._chat_words[chat_id] = words
+        self._chat_searches[chat_id] = self._compile(words)
+
+    async def _save(self, chat_id: int, words: Optional[List[str]]):
+        """Persist a chat's trigger words; None returns it to the defaults"""
+        self._loaded.add(chat_id)
+        if self.storage is None:
+            return
+        try:
+            await asyncio.to_thread(self.storage.save_chat_triggers, chat_id, words)
+        except Exception as e:
+            logger.error(f"Error saving trigger words for chat {chat_id}: {e}")
+
+    async def set_chat_triggers(self, chat_id: int, words: Iterable[str]):
+        """Use custom trigger words in a chat"""
+        words = [word.strip() for word in words if word.strip()]
+        self._apply(chat_id, words)
+        await self._save(chat_id, words)
+        logger.info(f"Set {len(words)} trigger words for chat {chat_id}")
+
+    async def reset_chat_triggers(self, chat_id: int):
+        """Return a chat to the default trigger words"""
+        self._chat_words.pop(chat_id, None)
+        self._chat_searches.pop(chat_id, None)
+        await self._save(chat_id, None)
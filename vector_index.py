@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-chat vector index for retrieving relevant older messages
+"""
+
+import logging
+import re
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from message_record import MessageRecord
+
+logger = logging.getLogger(__name__)
+
+# NumPy is optional and slow to import, so it is loaded by load_numpy(),
+# usually in the background after startup. Until then, and without it,
+# pure-Python sparse vectors are used.
+np = None
+_numpy_checked = False
+
+_WORD_PATTERN = re.compile(r'\w{3,}')
+
+# Frequent words that say nothing about the topic
+STOP_WORDS = frozenset("""
+что как это так вот все всё там тут мне меня тебя тебе его она они оно был была было были есть для или
+тоже если когда чтобы только уже еще ещё кто где нет даже очень просто может можно надо будет этот эта
+the and you for that this with are was have not but what all can
+""".split())
+
+def load_numpy() -> bool:
+    """Import NumPy if installed; returns whether the NumPy backend is available"""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            logger.info("NumPy is not installed, retrieval uses pure-Python vectors")
+        _numpy_checked = True
+    return np is not None
+
+class HashingEmbedder:
+    """Embeds text as a normalized hashed bag of word stems.
+
+    Words are cut to their first stem_chars characters, a cheap stand-in
+    for stemming that makes Russian word forms match, and hashed into dim
+    signed buckets. No model, no vocabulary, no state.
+    """
+
+    def __init__(self, dim: int = 128, stem_chars: int = 5, stop_words: Iterable[str] = ()):
+        self.dim = dim
+        self.stem_chars = stem_chars
+        self.stop_words = STOP_WORDS | {word.lower() for word in stop_words}
+
+    def embed(self, text: str) -> Dict[int, float]:
+        """Get the sparse unit vector of a text as {bucket: weight}"""
+        vector: Dict[int, float] = {}
+        for word in _WORD_PATTERN.findall(text.lower()):
+            if word in self.stop_words or word.isdigit():
+                continue
+            digest = zlib.crc32(word[:self.stem_chars].encode('utf-8'))
+            bucket = digest % self.dim
+            vector[bucket] = vector.get(bucket, 0.0) + (1.0 if digest & 0x80000000 else -1.0)
+
+        norm = sum(weight * weight for weight in vector.values()) ** 0.5
+        if not norm:
+            return {}
+        return {bucket: weight / norm for bucket, weight in vector.items() if weight}
+
+class ChatVectors:
+    """Vectors of one chat's messages in a ring that mirrors its message buffer.
+
+    With NumPy the vectors are rows of a float32 matrix that grows by
+    doubling up to capacity, so a search is one matrix-vector product;
+    without it they are kept as sparse dicts. The backend is fixed when
+    the chat is indexed.
+    """
+
+    __slots__ = ('capacity', 'dense', 'vectors', 'records', 'appended')
+
+    def __init__(self, capacity: int, dim: int):
+        self.capacity = capacity
+        self.dense = np is not None
+        self.vectors = np.zeros((min(capacity, 16), dim), dtype=np.float32) if self.dense else []
+        self.records: List[Optional[MessageRecord]] = []
+        self.appended = 0
+
+    def add(self, record: MessageRecord, vector: Dict[int, float]):
+        """Store a message's vector, overwriting the oldest one when full"""
+        position = self.appended % self.capacity
+        if position == len(self.records):
+            self.records.append(record)
+            if not self.dense:
+                self.vectors.append(vector)
+            elif position == len(self.vectors):
+                grown = np.zeros((min(2 * position, self.capacity), self.vectors.shape[1]), dtype=np.float32)
+                grown[:position] = self.vectors
+                self.vectors = grown
+        else:
+            self.records[position] = record
+            if not self.dense:
+                self.vectors[position] = vector
+
+        if self.dense:
+            row = self.vectors[position]
+            row[:] = 0.0
+            if vector:
+                row[list(vector)] = list(vector.values())
+        self.appended += 1
+
+    def scores(self, query: Dict[int, float]) -> Sequence[float]:
+        """Get the cosine similarity of every stored message to the query"""
+        if not self.dense:
+            return [sum(query.get(bucket, 0.0) * weight for bucket, weight in vector.items())
+                    for vector in self.vectors]
+
+        dense = np.zeros(self.vectors.shape[1], dtype=np.float32)
+        dense[list(query)] = list(query.values())
+        return self.vectors[:len(self.records)] @ dense
+
+    def newest_positions(self, count: int) -> List[int]:
+        """Get the ring positions of the newest count messages"""
+        count = min(count, len(self.records))
+        return [(self.appended - 1 - offset) % self.capacity for offset in range(count)]
+
+class VectorIndex:
+    """Retrieval index over the messages of recently active chats.
+
+    MessageMemory feeds it every new message and drops a chat when the
+    chat is cleared or evicted. A chat that is not indexed yet is built
+    from its history on the first search. At most max_chats chats are
+    indexed, least recently searched first out, so memory stays bounded
+    by max_chats x capacity x dim floats.
+    """
+
+    def __init__(self, capacity: int = 200, dim: int = 128, max_chats: int = 200,
+                 embedder: Optional[HashingEmbedder] = None):
+        self.capacity = capacity
+        self.max_chats = max_chats
+        self.embedder = embedder or HashingEmbedder(dim)
+        self._chats: "OrderedDict[int, ChatVectors]" = OrderedDict()
+        self._stats = {'searches': 0, 'builds': 0, 'hits': 0}
+
+        logger.info(f"VectorIndex initialized with {self.embedder.dim} dims")
+
+    def add(self, chat_id: int, record: MessageRecord):
+        """Index a new message of a chat that is already indexed"""
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.add(record, self.embedder.embed(record.text))
+
+    def drop(self, chat_id: int):
+        """Forget a chat's vectors"""
+        self._chats.pop(chat_id, None)
+
+    def _build(self, chat_id: int, history: Iterable[MessageRecord]) -> ChatVectors:
+        """Index a chat's history, evicting the least recently searched chat over the cap"""
+        chat = ChatVectors(self.capacity, self.embedder.dim)
+        for record in history:
+            chat.add(record, self.embedder.embed(record.text))
+
+        self._chats[chat_id] = chat
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        self._stats['builds'] += 1
+        return chat
+
+    def search(self, chat_id: int, text: str, history: Sequence[MessageRecord], k: int = 5,
+               exclude_recent: int = 0, min_score: float = 0.2) -> List[MessageRecord]:
+        """Get up to k older messages most similar to a text, best first.
+
+        The newest exclude_recent messages are skipped, since the prompt
+        includes them anyway. history is the chat's current message view,
+        used to build the index on first search.
+        """
+        try:
+            self._stats['searches'] += 1
+            query = self.embedder.embed(text)
+            if not query or k <= 0:
+                return []
+
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._build(chat_id, history)
+            else:
+                self._chats.move_to_end(chat_id)
+            if len(chat.records) <= exclude_recent:
+                return []
+
+            scores = chat.scores(query)
+            if chat.dense:
+                scores[chat.newest_positions(exclude_recent)] = -1.0
+                candidates = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+                ranked = sorted(candidates.tolist(), key=lambda position: -scores[position])
+            else:
+                for position in chat.newest_positions(exclude_recent):
+                    scores[position] = -1.0
+                ranked = sorted(range(len(scores)), key=lambda position: -scores[position])[:k]
+
+            found = [chat.records[position] for position in ranked if scores[position] >= min_score]
+            self._stats['hits'] += len(found)
+            return found
+
+        except Exception as e:
+            logger.error(f"Error searching chat {chat_id}: {e}")
+            return []
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get search counters and the number of indexed chats"""
+        return {**self._stats, 'indexed_chats': len(self._chats)}
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asyncio HTTP server for Telegram webhook updates, health checks and metrics
+"""
+
+import hmac
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class WebhookServer:
+    """Receives Telegram updates and serves /health, /ready and /metrics.
+
+    Runs on the bot's own event loop, so updates go straight into the
+    Application's update queue without extra threads. /health reports that
+    the process is alive; /ready reports whether it should receive traffic,
+    which lets a load balancer route around replicas that are starting up
+    or shutting down. With a dispatch callable, raw update payloads are
+    handed to it instead (used by the cluster ingest process). Without a
+    webhook_path only the probe and metrics routes are served. With a
+    path the server listens on that Unix socket instead of host and port,
+    and render_metrics, when given, replaces the local registry as the
+    source of /metrics.
+    """
+
+    def __init__(self, application: Optional[Application], host: str = '0.0.0.0', port: int = 5000,
+                 webhook_path: Optional[str] = '/telegram/webhook', secret_token: Optional[str] = None,
+                 dispatch: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+                 path: Optional[str] = None, render_metrics: Optional[Callable[[], Awaitable[str]]] = None):
+        self.application = application
+        self.dispatch = dispatch
+        self.host = host
+        self.port = port
+        self.path = path
+        self.render_metrics = render_metrics
+        self.webhook_path = webhook_path
+        self.secret_token = secret_token
+        self._ready = False
+        self._runner = None
+
+    def set_ready(self, ready: bool):
+        """Mark the server as ready or not ready for traffic"""
+        self._ready = ready
+        logger.info(f"Webhook server readiness: {'ready' if ready else 'not ready'}")
+
+    @property
+    def running(self) -> bool:
+        """Whether the server is listening"""
+        return self._runner is not None
+
+    def build_app(self) -> web.Application:
+        """Build the aiohttp application with all routes"""
+        app = web.Application()
+        if self.webhook_path:
+            app.router.add_post(self.webhook_path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        app.router.add_get('/ready', self.handle_ready)
+        app.router.add_get('/metrics', self.handle_metrics)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Validate a webhook request and queue its update"""
+        if self.secret_token is not None:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                logger.warning("Rejected webhook request with invalid secret token")
+                return web.Response(status=403)
+
+        if not self._ready:
+            # Telegram retries failed deliveries, so nothing is lost
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+            if self.dispatch is None:
+                update = Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, ValueError) as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+
+        if self.dispatch is not None:
+            try:
+                await self.dispatch(data)
+            except Exception as e:
+                logger.error(f"Error dispatching update: {e}")
+                return web.Response(status=503)
+        else:
+            await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Liveness probe"""
+        return web.Response(text='OK')
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        """Readiness probe"""
+        if self._ready:
+            return web.Response(text='READY')
+        return web.Response(status=503, text='NOT READY')
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """Metrics in the Prometheus text exposition format"""
+        if self.render_metrics is not None:
+            return web.Response(text=await self.render_metrics(), content_type='text/plain')
+        return web.Response(text=metrics.REGISTRY.render(), content_type='text/plain')
+
+    async def start(self):
+        """Start listening; raises OSError if the port cannot be bound"""
+        runner = web.AppRunner(self.build_app(), access_log=None)
+        await runner.setup()
+        if self.path is not None:
+            site, address = web.UnixSite(runner, self.path), self.path
+        else:
+            site, address = web.TCPSite(runner, self.host, self.port), f"{self.host}:{self.port}"
+        try:
+            await site.start()
+        except BaseException:
+            await runner.cleanup()
+            raise
+        self._runner = runner
+        logger.info(f"Webhook server listening on {address}")
+
+    async def stop(self):
+        """Stop listening and close open connections"""
+        self._ready = False
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        logger.info("Webhook server stopped")